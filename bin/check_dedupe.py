@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Regression check of `geometry.instancing.dedupe_meshes` on copies stored
+in float32 at detector coordinates.
+
+Places an icosahedron at offsets of several hundred mm, with and without a
+rotation, rounds the vertices to float32 like an STL file, and checks that
+all copies share one base while a scaled icosahedron does not.
+
+Usage:
+```bash
+python bin/check_dedupe.py
+```
+"""
+import os
+import sys
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from chroma.geometry import Mesh
+from chroma.transform import make_rotation_matrix
+
+from geometry.instancing import dedupe_meshes
+
+
+def icosahedron(radius: float = 3.0):
+    phi = (1 + 5**0.5) / 2
+    vertices = np.array(
+        [(-1, phi, 0), (1, phi, 0), (-1, -phi, 0), (1, -phi, 0),
+         (0, -1, phi), (0, 1, phi), (0, -1, -phi), (0, 1, -phi),
+         (phi, 0, -1), (phi, 0, 1), (-phi, 0, -1), (-phi, 0, 1)],
+        dtype=float,
+    )
+    triangles = np.array(
+        [(0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11),
+         (1, 5, 9), (5, 11, 4), (11, 10, 2), (10, 7, 6), (7, 1, 8),
+         (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9),
+         (4, 9, 5), (2, 4, 11), (6, 2, 10), (8, 6, 7), (9, 8, 1)],
+    )
+    return vertices * radius / np.linalg.norm(vertices[0]), triangles
+
+
+def main():
+    vertices, triangles = icosahedron()
+    R = make_rotation_matrix(0.7, [1.0, 2.0, 3.0])
+    placements = [
+        (np.eye(3), (30.123, 0, 0)),
+        (np.eye(3), (300.123, 0, 0)),
+        (np.eye(3), (0, 412.77, -250.5)),
+        (np.eye(3), (100, 0, 0)),
+        (np.eye(3), (350.3, 0, 0)),
+        (R, (-320.4, 150.25, 280.0)),
+    ]
+    meshes = [
+        Mesh((vertices @ rotation.T + offset).astype(np.float32), triangles) for rotation, offset in placements
+    ]
+    meshes.append(Mesh((1.01 * vertices + (300.123, 0, 0)).astype(np.float32), triangles))
+
+    bases, base_index, rotations, translations = dedupe_meshes(meshes)
+    if len(bases) != 2 or list(base_index) != [0] * len(placements) + [1]:
+        raise RuntimeError(f"expected 2 bases, got {len(bases)} with base index {list(base_index)}")
+    for mesh, j, rotation, translation in zip(meshes, base_index, rotations, translations):
+        placed = np.asarray(bases[j].vertices, dtype=float) @ rotation.T + translation
+        if not np.allclose(placed, mesh.vertices, rtol=0, atol=1e-3):
+            raise RuntimeError("a placed base does not reproduce its mesh")
+    print(f"{len(meshes)} meshes deduplicated to {len(bases)} bases")
+
+
+if __name__ == "__main__":
+    main()
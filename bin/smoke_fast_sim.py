@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Smoke check that the fast S2 simulation runs on a machine without chroma.
+
+Writes a small random lightmap, positions and site table to a temporary
+directory and runs `pyrat macros/s2_sim.py` with `fast_lightmap` set, once
+with the two position files and once with the site table. chroma is blocked
+from being imported, so the check fails if any module on the fast path
+imports it at module level.
+
+Usage:
+```bash
+python bin/smoke_fast_sim.py
+```
+"""
+import os
+import runpy
+import sys
+import tempfile
+
+import h5py
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_inputs(tmp: str, n_events: int = 20, n_channels: int = 8):
+    rng = np.random.default_rng(0)
+    shape = np.array([10, 10, 10])
+    with h5py.File(os.path.join(tmp, "el.plib"), "w") as f:
+        f["numvox"] = shape
+        f["min"] = np.array([-10.0, -10.0, 0.0])
+        f["max"] = np.array([10.0, 10.0, 20.0])
+        f.create_dataset("vis", data=rng.uniform(0, 0.01, (shape.prod(), n_channels)).astype(np.float32))
+
+    positions = np.column_stack((rng.uniform(-5, 5, (n_events, 2)), np.full(n_events, 2.0)))
+    np.save(os.path.join(tmp, "positions.npy"), positions)
+    np.save(os.path.join(tmp, "positions_2.npy"), positions[::-1].copy())
+
+    sites = np.zeros(2 * n_events, dtype=[("event", np.int64), ("x", float), ("y", float), ("z", float), ("n", np.int64)])
+    sites["event"] = np.repeat(np.arange(n_events), 2)
+    sites["x"], sites["y"] = rng.uniform(-5, 5, (2, len(sites)))
+    sites["z"] = 2.0
+    sites["n"] = rng.integers(1_000, 10_000, len(sites))
+    np.save(os.path.join(tmp, "sites.npy"), sites)
+
+
+def run_pyrat(*evalset):
+    argv = ["pyrat", "macros/s2_sim.py"]
+    for field, value in evalset:
+        argv += ["-es", field, value]
+    sys.argv = argv
+    runpy.run_path(os.path.join(REPO, "pyrat"), run_name="__main__")
+
+
+def main():
+    # a None entry makes every `import chroma...` raise ImportError
+    sys.modules["chroma"] = None
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        write_inputs(tmp)
+        common = [("fast_lightmap", repr(os.path.join(tmp, "el.plib"))), ("num_events", "20")]
+        run_pyrat(
+            *common,
+            ("positions_path", repr(os.path.join(tmp, "positions.npy"))),
+            ("positions_path_2", repr(os.path.join(tmp, "positions_2.npy"))),
+            ("output_file", repr(os.path.join(tmp, "positions.h5"))),
+        )
+        run_pyrat(
+            *common,
+            ("sites_file", repr(os.path.join(tmp, "sites.npy"))),
+            ("output_file", repr(os.path.join(tmp, "sites.h5"))),
+        )
+        for name in ("positions.h5", "sites.h5"):
+            with h5py.File(os.path.join(tmp, name), "r") as f:
+                if not len(f["posX"]):
+                    raise RuntimeError(f"the fast simulation wrote no events to {name}")
+    print("fast simulation ran without chroma")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from chroma.event import Photons
+
+__all__ = ["PhotonBuffer", "PhotonBufferPool", "pool_size", "fill_uniform_sphere", "cross_into"]
+
+
+class PhotonBuffer:
+    """Preallocated float32 photon arrays that generators fill in place.
+
+    `photons` wraps them in a chroma `Photons` without copying, and a slice of a
+    buffer is a buffer viewing the same rows.
+    """
+
+    def __init__(self, capacity: int, _arrays=None):
+        if _arrays is None:
+            capacity = int(capacity)
+            _arrays = (
+                np.empty((capacity, 3), dtype=np.float32),
+                np.empty((capacity, 3), dtype=np.float32),
+                np.empty((capacity, 3), dtype=np.float32),
+                np.empty(capacity, dtype=np.float32),
+                np.empty(capacity, dtype=np.float32),
+                # float64 random numbers, drawn in place before being stored
+                np.empty((3, capacity), dtype=np.float64),
+            )
+        self.pos, self.dir, self.pol, self.wavelengths, self.t, self.scratch = _arrays
+        self.capacity = len(self.pos)
+
+    def __getitem__(self, rows: slice) -> "PhotonBuffer":
+        if not isinstance(rows, slice) or rows.step not in (None, 1):
+            raise TypeError("photon buffers can only be sliced into contiguous rows")
+        arrays = (self.pos, self.dir, self.pol, self.wavelengths, self.t)
+        return PhotonBuffer(None, _arrays=tuple(a[rows] for a in arrays) + (self.scratch[:, rows],))
+
+    def reserve(self, n: int) -> "PhotonBuffer":
+        """The first `n` rows, raising if the buffer is too small."""
+        if n > self.capacity:
+            raise ValueError(f"{n} photons do not fit into a buffer of {self.capacity}")
+        return self[:n]
+
+    def photons(self, n: int = None) -> "Photons":
+        """The first `n` (default all) photons, sharing memory with the buffer."""
+        # chroma is imported on use so that CPU-only tools can import the generators
+        from chroma.event import Photons
+
+        n = self.capacity if n is None else n
+        return Photons(self.pos[:n], self.dir[:n], self.pol[:n], self.wavelengths[:n], t=self.t[:n])
+
+
+class PhotonBufferPool:
+    """A round-robin pool of `size` photon buffers, reused for consecutive events.
+
+    A buffer is handed out again after `size` further requests, so `size` must
+    exceed the number of events chroma queues at once (see `pool_size`). Buffers
+    grow when an event needs more photons.
+    """
+
+    def __init__(self, capacity: int, size: int = 2):
+        self.buffers = [PhotonBuffer(capacity) for _ in range(max(int(size), 1))]
+        self._next = 0
+
+    def get(self, n: int) -> PhotonBuffer:
+        """The next buffer, viewing its first `n` rows."""
+        buffer = self.buffers[self._next]
+        if buffer.capacity < n:
+            buffer = self.buffers[self._next] = PhotonBuffer(n)
+        self._next = (self._next + 1) % len(self.buffers)
+        return buffer[:n]
+
+
+def pool_size(photons_per_batch: int, photons_per_event: int) -> int:
+    """The number of buffers a pool needs when chroma queues events until
+    `photons_per_batch` photons are collected."""
+    return int(photons_per_batch) // max(int(photons_per_event), 1) + 2
+
+
+def fill_uniform_sphere(out: np.ndarray, scratch: np.ndarray, rng: np.random.Generator = None) -> np.ndarray:
+    """Fills the (n, 3) `out` with random unit vectors, like
+    `chroma.sample.uniform_sphere` but drawing from `rng` if given.
+
+    `scratch` is a (3, n) float64 work array whose rows are contiguous, e.g.
+    `PhotonBuffer.scratch`.
+    """
+    n = len(out)
+    if rng is None:
+        from chroma.sample import uniform_sphere
+
+        out[:] = uniform_sphere(n)
+        return out
+    theta, u, c = scratch[0, :n], scratch[1, :n], scratch[2, :n]
+    rng.random(out=theta)
+    theta *= 2 * np.pi
+    rng.random(out=u)
+    u *= 2
+    u -= 1
+    # c = sqrt(1 - u^2)
+    np.multiply(u, u, out=c)
+    np.subtract(1, c, out=c)
+    np.sqrt(c, out=c)
+    out[:, 2] = u
+    np.sin(theta, out=u)
+    np.multiply(u, c, out=out[:, 1])
+    np.cos(theta, out=theta)
+    np.multiply(theta, c, out=out[:, 0])
+    return out
+
+
+def cross_into(a: np.ndarray, b: np.ndarray, scratch: np.ndarray) -> np.ndarray:
+    """Overwrites the (n, 3) `b` with the cross product `a x b`, using the
+    (3, n) float64 `scratch` instead of allocating temporaries."""
+    n = len(a)
+    x, y, z = scratch[0, :n], scratch[1, :n], scratch[2, :n]
+    # z = a0 b1 - a1 b0, with x as temporary
+    np.multiply(a[:, 0], b[:, 1], out=z)
+    np.multiply(a[:, 1], b[:, 0], out=x)
+    z -= x
+    # x = a1 b2 - a2 b1, with y as temporary
+    np.multiply(a[:, 1], b[:, 2], out=x)
+    np.multiply(a[:, 2], b[:, 1], out=y)
+    x -= y
+    # y = a2 b0 - a0 b2; b1 is no longer needed and serves as temporary
+    np.multiply(a[:, 2], b[:, 0], out=y)
+    np.multiply(a[:, 0], b[:, 2], out=b[:, 1])
+    y -= b[:, 1]
+    b[:] = scratch[:, :n].T
+    return b
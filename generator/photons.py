@@ -1,9 +1,41 @@
+import math
+from typing import TYPE_CHECKING
+
 import numpy as np
-from chroma.sample import uniform_sphere
-from chroma.event import Photons
 
+from generator.buffers import PhotonBuffer, cross_into, fill_uniform_sphere
+from generator.profile import ELProfile
+from generator.rng import RandomStreams, fan_out
+from generator.sites import event_bounds
+
+if TYPE_CHECKING:
+    from chroma.event import Photons
+
+
+def _fill_isotropic(out: PhotonBuffer, wavelength: float, rng: np.random.Generator = None):
+    """Fills the directions, polarizations and wavelengths of isotropically
+    emitted photons."""
+    fill_uniform_sphere(out.dir, out.scratch, rng)
+    fill_uniform_sphere(out.pol, out.scratch, rng)
+    cross_into(out.dir, out.pol, out.scratch)
+    out.wavelengths[:] = wavelength
 
-def create_photon_bomb(n: int, wavelength: float, pos: np.ndarray) -> Photons:
+
+def _fill_electroluminescence(
+    out: PhotonBuffer, wavelength: float, profile: ELProfile, diffusion: float, rng: np.random.Generator = None
+):
+    """Moves photons placed at their sites up the EL column and fills their
+    directions, polarizations and wavelengths."""
+    draw = np.random if rng is None else rng
+    out.pos[:, 2] += profile.sample(len(out.pos), draw)
+    if diffusion > 0:
+        out.pos[:, :2] += draw.normal(0, diffusion, (len(out.pos), 2))
+    _fill_isotropic(out, wavelength, rng)
+
+
+def create_photon_bomb(
+    n: int, wavelength: float, pos: np.ndarray, rng: np.random.Generator = None, out: PhotonBuffer = None
+) -> "Photons":
     """Create a collection of photons at a given position with random directions.
     
     Parameters
@@ -14,6 +46,12 @@ def create_photon_bomb(n: int, wavelength: float, pos: np.ndarray) -> Photons:
         The wavelength of the photons.
     pos : array-like
         The position of the photons.
+    rng : np.random.Generator, optional
+        The generator to draw the directions from, e.g. one seeded per
+        position. Defaults to numpy's global random state.
+    out : PhotonBuffer, optional
+        The buffer to fill, e.g. from a `PhotonBufferPool`. The photons
+        returned share its memory.
         
     Returns
     -------
@@ -22,52 +60,248 @@ def create_photon_bomb(n: int, wavelength: float, pos: np.ndarray) -> Photons:
 
     """
 
-    pos = np.tile(pos, (n, 1))
-    dir = uniform_sphere(n)
-    pol = np.cross(dir, uniform_sphere(n))
-    wavelengths = np.repeat(wavelength, n)
-    return Photons(pos, dir, pol, wavelengths)
+    out = PhotonBuffer(n) if out is None else out.reserve(n)
+    out.pos[:] = pos
+    _fill_isotropic(out, wavelength, rng)
+    out.t[:] = 0
+    return out.photons()
 
 
-def create_electroluminescence_photons(n: int, wavelength: float, pos: np.ndarray, height: float) -> Photons:
-    """Create a collection of photons at a given position with random directions.
-    
+def create_photon_bombs(
+    n: int,
+    wavelength: float,
+    positions: np.ndarray,
+    time_offset: float,
+    rngs=None,
+    out: PhotonBuffer = None,
+    workers: int = 1,
+) -> "Photons":
+    """Create photon bombs at several positions packed into a single collection of photons.
+
+    Photons from the k-th bomb start at time `k * time_offset`, which tags every
+    photon with the index of its source. As long as `time_offset` is much longer
+    than the propagation time of a photon, the source of a hit is recovered from
+    its time with `source_index`.
+
     Parameters
     ----------
     n : int
-        The number of photons to create.
+        The number of photons per bomb.
+    wavelength : float
+        The wavelength of the photons.
+    positions : array-like
+        The (K, 3) positions of the bombs.
+    time_offset : float
+        The time between the start of consecutive bombs in ns.
+    rngs : sequence of np.random.Generator, optional
+        One generator per bomb. Each bomb then draws the same photons as
+        `create_photon_bomb` with that generator.
+    out : PhotonBuffer, optional
+        The buffer to fill.
+    workers : int
+        The number of threads filling bombs with their own generators in
+        parallel. The photons do not depend on it.
+
+    Returns
+    -------
+    photons : chroma.event.Photons
+        The collection of K * n photons, ordered by bomb.
+    """
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    n_total = n * len(positions)
+    out = PhotonBuffer(n_total) if out is None else out.reserve(n_total)
+
+    def fill(k):
+        bomb = out[k * n : (k + 1) * n]
+        bomb.pos[:] = positions[k]
+        bomb.t[:] = k * time_offset
+        if rngs is not None:
+            _fill_isotropic(bomb, wavelength, rngs[k])
+
+    if rngs is None:
+        _fill_isotropic(out, wavelength)
+        workers = 1
+    fan_out(fill, range(len(positions)), workers)
+    return out.photons()
+
+
+def source_index(t: np.ndarray, time_offset: float) -> np.ndarray:
+    """Index of the packed source each photon or hit belongs to, given its time.
+
+    Inverse of the time tagging done by `create_photon_bombs`.
+    """
+    return (np.asarray(t, dtype=np.float64) // time_offset).astype(np.intp)
+
+
+def max_time_tags(time_offset: float, max_travel_time: float, max_steps: int = 100) -> int:
+    """The largest number of sources that can be packed `time_offset` ns apart
+    and recovered with `source_index`.
+
+    Chroma keeps photon times in float32, so the start time `k * time_offset`
+    of every source must be exact in float32, and the rounding of up to
+    `max_steps` additions of travel time must not carry a hit that arrives
+    within `max_travel_time` past the start of the next source. A power of two
+    such as `2.0**20` (about 1 ms) is exact for any k below 2**24.
+    """
+    if np.float32(time_offset) != time_offset or time_offset <= 0:
+        raise ValueError(f"time offset {time_offset} ns is not a positive float32 number")
+    if not 0 <= max_travel_time < time_offset:
+        raise ValueError(f"time offset {time_offset} ns does not exceed the travel time {max_travel_time} ns")
+    # k * time_offset is exact while k times the odd part of its significand fits in 24 bits
+    odd = int(math.frexp(time_offset)[0] * 2**24)
+    while odd % 2 == 0:
+        odd //= 2
+    n_exact = 2**24 // odd
+    # every addition rounds by at most half the float32 spacing, which is at
+    # most 2**e below 2**(e + 24)
+    spacing = 2 * (time_offset - max_travel_time) / max_steps
+    n_rounding = int(2.0 ** (math.floor(math.log2(spacing)) + 24) // time_offset)
+    return min(n_exact, n_rounding)
+
+
+def create_electroluminescence_photons(
+    n,
+    wavelength: float,
+    pos: np.ndarray,
+    height: float,
+    profile: ELProfile = None,
+    diffusion: float = 0.0,
+    rng: np.random.Generator = None,
+    time_offset: float = None,
+    out: PhotonBuffer = None,
+    rngs=None,
+    workers: int = 1,
+) -> "Photons":
+    """Create the electroluminescence photons of one or many sites.
+
+    Photons are emitted isotropically at a height above each site drawn from
+    the longitudinal yield `profile`, optionally smeared transversely. With a
+    `time_offset`, photons of the k-th site start at time `k * time_offset`
+    and the site of a hit is recovered with `source_index`, as for
+    `create_photon_bombs`.
+    
+    Parameters
+    ----------
+    n : int or array-like
+        The number of photons per site, a scalar or one count per site.
     wavelength : float
         The wavelength of the photons.
     pos : array-like
-        The (x, y, z) position on the liquid surface where electroluminesence begins.
-    height : float:
+        The (x, y, z) position on the liquid surface where electroluminesence
+        begins, or an (M, 3) array of such positions.
+    height : float
         The height of the electroluminescence region.
+    profile : ELProfile, optional
+        The distribution of the emission height. Defaults to uniform over `height`.
+    diffusion : float
+        The standard deviation in mm of a Gaussian transverse smearing of the
+        emission points.
+    rng : np.random.Generator, optional
+        The generator to draw from. Defaults to numpy's global random state.
+    time_offset : float, optional
+        The time between the start of consecutive sites in ns.
+    out : PhotonBuffer, optional
+        The buffer to fill.
+    rngs : sequence of np.random.Generator, optional
+        One generator per site, replacing `rng`. The photons of a site then
+        do not depend on the other sites.
+    workers : int
+        The number of threads filling sites with their own generators in
+        parallel. The photons do not depend on it.
         
     Returns
     -------
     photons : chroma.event.Photons
-        The collection of photons
+        The collection of photons, ordered by site.
+    """
+    sites = np.asarray(pos, dtype=float).reshape(-1, 3)
+    n_per_site = np.broadcast_to(np.asarray(n, dtype=np.int64), (len(sites),))
+    n_total = int(n_per_site.sum())
+    profile = ELProfile.uniform(height) if profile is None else profile
+
+    out = PhotonBuffer(n_total) if out is None else out.reserve(n_total)
+
+    if rngs is None:
+        out.pos[:] = np.repeat(sites, n_per_site, axis=0)
+        out.t[:] = 0 if time_offset is None else np.repeat(np.arange(len(sites)) * time_offset, n_per_site)
+        _fill_electroluminescence(out, wavelength, profile, diffusion, rng)
+        return out.photons()
+
+    first = np.concatenate(([0], np.cumsum(n_per_site)))
+
+    def fill(k):
+        site = out[first[k] : first[k + 1]]
+        site.pos[:] = sites[k]
+        site.t[:] = 0 if time_offset is None else k * time_offset
+        _fill_electroluminescence(site, wavelength, profile, diffusion, rngs[k])
+
+    fan_out(fill, range(len(sites)), workers)
+    return out.photons()
+
+
+def create_event_photons(
+    sites: np.ndarray,
+    wavelength: float,
+    height: float,
+    time_offset: float,
+    profile: ELProfile = None,
+    diffusion: float = 0.0,
+    rng: np.random.Generator = None,
+    out: PhotonBuffer = None,
+    streams: RandomStreams = None,
+    workers: int = 1,
+) -> "Photons":
+    """Create the electroluminescence photons of a batch of events in one go.
+
+    Every photon is tagged with the row of its site in `sites` through its
+    start time (see `create_electroluminescence_photons`), so the hits of the
+    batch are split back into sites and events with `source_index` and
+    `sites["event"]`.
+
+    Parameters
+    ----------
+    sites : np.ndarray
+        A site table of `generator.sites.SITE_DTYPE`, one row per site with
+        its event id, position and number of photons.
+    wavelength : float
+        The wavelength of the photons.
+    height : float
+        The height of the electroluminescence region.
+    time_offset : float
+        The time between the start of consecutive sites in ns, much longer
+        than the propagation time of a photon.
+    profile, diffusion, rng, out, workers
+        As in `create_electroluminescence_photons`.
+    streams : RandomStreams, optional
+        Draws every site from the stream of its (event id, index within the
+        event), like the sources of the two-site generator, so events get the
+        same photons however they are batched. Sites are then filled by
+        `workers` threads in parallel.
+
+    Returns
+    -------
+    photons : chroma.event.Photons
+        The collection of photons, ordered by site.
     """
-    point_spacing = 0.1 # mm
-    n_per_point = int(n/np.round(height/point_spacing))
-    pos = np.tile(pos, (n, 1))
-    z_offsets = np.zeros_like(pos)
-    z_points = np.linspace(0, height, int(np.round(height/point_spacing)))
-    for i in range(int(np.round(height/point_spacing))):
-        z_offsets[i*n_per_point:(i+1)*n_per_point, 2] = z_points[i]
-    pos = pos + z_offsets
-    dirs = np.zeros_like(pos)
-    pols = np.zeros_like(pos)
-    wavelengths = np.repeat(wavelength, n)
-    for i in range(int(np.round(height/point_spacing))):
-        dirs[i*n_per_point:(i+1)*n_per_point] = uniform_sphere(n_per_point)
-        pols[i*n_per_point:(i+1)*n_per_point] = np.cross(dirs[i*n_per_point:(i+1)*n_per_point], uniform_sphere(n_per_point))
-    return Photons(pos, dirs, pols, wavelengths)
+    if streams is None:
+        return create_electroluminescence_photons(
+            sites["n"], wavelength, sites["pos"], height, profile, diffusion, rng,
+            time_offset=time_offset, out=out,
+        )
+
+    bounds = event_bounds(sites)
+    site_index = np.arange(len(sites)) - np.repeat(bounds[:-1], np.diff(bounds))
+    return create_electroluminescence_photons(
+        sites["n"], wavelength, sites["pos"], height, profile, diffusion,
+        time_offset=time_offset, out=out, workers=workers,
+        rngs=[streams.stream(event, k) for event, k in zip(sites["event"], site_index)],
+    )
 
 
 def create_multisite_electroluminescence_photons(n: int, wavelength: float, pos_1: np.ndarray, \
-                                                 pos_2: np.ndarray, height: float) -> Photons:
-    """Create a collection of photons at a given position with random directions.
+                                                 pos_2: np.ndarray, height: float, **kwargs) -> "Photons":
+    """Create the electroluminescence photons of a two-site event, half of the
+    photons at each site (the odd one at the second).
     
     Parameters
     ----------
@@ -75,10 +309,12 @@ def create_multisite_electroluminescence_photons(n: int, wavelength: float, pos_
         The number of photons to create.
     wavelength : float
         The wavelength of the photons.
-    pos : array-like
-        The (x, y, z) position on the liquid surface where electroluminesence begins.
+    pos_1, pos_2 : array-like
+        The (x, y, z) positions on the liquid surface where electroluminesence begins.
     height : float:
         The height of the electroluminescence region.
+    **kwargs
+        Passed to `create_electroluminescence_photons`.
         
     Returns
     -------
@@ -86,14 +322,10 @@ def create_multisite_electroluminescence_photons(n: int, wavelength: float, pos_
         The collection of photons
     """
     n_1 = int(n/2)
-    n_2 = n - n_1
-    site_1_photons = create_electroluminescence_photons(n_1, wavelength, pos_1, height)
-    site_2_photons = create_electroluminescence_photons(n_2, wavelength, pos_2, height)
-
-    return site_1_photons + site_2_photons
+    return create_electroluminescence_photons([n_1, n - n_1], wavelength, np.stack((pos_1, pos_2)), height, **kwargs)
 
 
-def plot_photons(photons: Photons):
+def plot_photons(photons: "Photons"):
     """Plot the photons with direction and polarization vectors"""
     import matplotlib.pyplot as plt
     plt.style.use('~/styles/clarke-default.mplstyle')
@@ -0,0 +1,77 @@
+import numpy as np
+
+__all__ = ["ELProfile"]
+
+
+class ELProfile:
+    """Distribution of the height above the liquid surface at which EL photons are emitted.
+
+    Profiles are tabulated as their cumulative distribution `cdf` at heights `z`
+    from 0 to `height`, so sampling and quadrature are vectorized lookups.
+    """
+
+    # number of points the cumulative distribution of analytic profiles is tabulated at
+    TABLE_SIZE = 1025
+
+    def __init__(self, height: float, z: np.ndarray, cdf: np.ndarray):
+        self.height = float(height)
+        self.z = np.asarray(z, dtype=float)
+        self.cdf = np.asarray(cdf, dtype=float)
+
+    @classmethod
+    def uniform(cls, height: float) -> "ELProfile":
+        """Photons emitted uniformly along the column."""
+        return cls(height, [0.0, height], [0.0, 1.0])
+
+    @classmethod
+    def linear(cls, height: float, gradient: float) -> "ELProfile":
+        """A yield varying linearly with height, as in a field with a linear
+        gradient: the yield at the top is `1 + gradient` times the yield at the
+        liquid surface."""
+        if gradient <= -1:
+            raise ValueError("the yield must stay positive, i.e. gradient > -1")
+        t = np.linspace(0, 1, cls.TABLE_SIZE)
+        cdf = (t + gradient * t**2 / 2) / (1 + gradient / 2)
+        return cls(height, t * height, cdf)
+
+    @classmethod
+    def from_table(cls, z: np.ndarray, weights: np.ndarray) -> "ELProfile":
+        """A yield given at heights `z` (starting at 0), interpolated linearly
+        in between. The column ends at the last height."""
+        z = np.asarray(z, dtype=float)
+        weights = np.asarray(weights, dtype=float)
+        if z[0] != 0 or np.any(np.diff(z) <= 0) or np.any(weights < 0):
+            raise ValueError("profile heights must increase from 0 and weights must be non-negative")
+        # tabulate the cumulative distribution finely, so that the linear
+        # interpolation of the yield carries over to the sampled heights
+        fine = np.union1d(z, np.linspace(0, z[-1], cls.TABLE_SIZE))
+        weights = np.interp(fine, z, weights)
+        cdf = np.concatenate(([0.0], np.cumsum((weights[1:] + weights[:-1]) / 2 * np.diff(fine))))
+        return cls(fine[-1], fine, cdf / cdf[-1])
+
+    @classmethod
+    def from_config(cls, height: float, kind: str = "uniform", gradient: float = 0.0, table: str = None) -> "ELProfile":
+        """Builds a profile from macro settings. `table` is a .npy file with the
+        (n, 2) heights and yields of a tabulated profile."""
+        if kind == "uniform":
+            return cls.uniform(height)
+        if kind == "linear":
+            return cls.linear(height, gradient)
+        if kind == "table":
+            z, weights = np.load(table).T
+            return cls.from_table(z, weights)
+        raise ValueError(f"unknown EL profile {kind!r}")
+
+    def icdf(self, u: np.ndarray) -> np.ndarray:
+        """Heights at the quantiles `u`."""
+        return np.interp(u, self.cdf, self.z)
+
+    def sample(self, n: int, rng=None) -> np.ndarray:
+        """Draws `n` emission heights."""
+        rng = np.random if rng is None else rng
+        return self.icdf(rng.uniform(0, 1, n))
+
+    def quadrature(self, n: int):
+        """`n` heights at equally spaced quantiles, each with weight 1 / n, so
+        that averages over the profile become plain means."""
+        return self.icdf((np.arange(n) + 0.5) / n), np.full(n, 1 / n)
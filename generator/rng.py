@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Callable, Iterable, List
+
+import numpy as np
+
+from utils.log import logger
+
+__all__ = ["RandomStreams", "fan_out"]
+
+
+class RandomStreams:
+    """Independent random number streams keyed by (event, source).
+
+    Every stream is seeded from the run seed and its key alone, so photons do not
+    depend on event order, batching, sharding or threads. Without a seed, fresh
+    entropy is drawn and logged.
+    """
+
+    def __init__(self, seed: int = None):
+        self.seed = np.random.SeedSequence(seed).entropy
+        if seed is None:
+            logger.info(f"Random streams seeded with {self.seed}.")
+
+    def stream(self, event: int, source: int = 0) -> np.random.Generator:
+        """The generator of one source of an event."""
+        key = (int(event), int(source))
+        return np.random.Generator(np.random.PCG64(np.random.SeedSequence(self.seed, spawn_key=key)))
+
+    def streams(self, event: int, n_sources: int) -> List[np.random.Generator]:
+        """The generators of the first `n_sources` sources of an event."""
+        return [self.stream(event, source) for source in range(n_sources)]
+
+
+@lru_cache(maxsize=None)
+def _executor(workers: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photon-generator")
+
+
+def fan_out(fn: Callable, items: Iterable, workers: int = 1) -> list:
+    """Calls `fn` on every item, on a pool of `workers` threads, and returns
+    the results in item order.
+
+    Meant for filling disjoint slices of a photon buffer with their own
+    streams: numpy releases the GIL in its array and sampling loops, and the
+    result is the same for any number of workers.
+    """
+    if workers <= 1:
+        return [fn(item) for item in items]
+    return list(_executor(int(workers)).map(fn, items))
@@ -0,0 +1,105 @@
+import numpy as np
+
+__all__ = ["SITE_DTYPE", "make_sites", "load_sites", "event_bounds", "site_ids", "batch_events"]
+
+# one row per interaction site; the sites of an event are consecutive rows
+SITE_DTYPE = np.dtype([("event", np.int64), ("pos", np.float64, (3,)), ("n", np.int64)])
+
+
+def make_sites(positions: np.ndarray, n, event: np.ndarray = None) -> np.ndarray:
+    """Builds a site table.
+
+    Parameters
+    ----------
+    positions : np.ndarray
+        (n_events, n_sites, 3) positions of events with the same number of
+        sites, or (M, 3) positions of sites belonging to the events `event`.
+    n : int or array-like
+        The number of photons per site, broadcastable to the sites.
+    event : array-like, optional
+        The event id of each of the (M, 3) sites.
+
+    Returns
+    -------
+    np.ndarray
+        The sites as a structured array of `SITE_DTYPE`, sorted by event.
+    """
+    positions = np.asarray(positions, dtype=float)
+    if event is None:
+        if positions.ndim != 3:
+            raise ValueError("sites without event ids need positions of shape (n_events, n_sites, 3)")
+        event = np.repeat(np.arange(len(positions)), positions.shape[1])
+    n = np.broadcast_to(n, positions.shape[:-1]).reshape(-1)
+    positions = positions.reshape(-1, 3)
+    sites = np.empty(len(positions), dtype=SITE_DTYPE)
+    sites["event"] = event
+    sites["pos"] = positions
+    sites["n"] = n
+    return sites[np.argsort(sites["event"], kind="stable")]
+
+
+def load_sites(path: str, photons_per_kev: float = None) -> np.ndarray:
+    """Loads a site table from a structured .npy file.
+
+    The file has an `event` field, the positions as a (3,) `pos` field or as
+    `x`, `y` and `z` fields, and either the photon counts `n` or the deposited
+    energies `energy` in keV, which are converted to photons with
+    `photons_per_kev`.
+    """
+    table = np.load(path)
+    names = table.dtype.names or ()
+    if "pos" in names:
+        positions = table["pos"]
+    elif {"x", "y", "z"} <= set(names):
+        positions = np.column_stack((table["x"], table["y"], table["z"]))
+    else:
+        raise ValueError(f"{path} has neither a 'pos' field nor 'x', 'y' and 'z' fields")
+    if "n" in names:
+        n = table["n"]
+    elif "energy" in names:
+        if photons_per_kev is None:
+            raise ValueError(f"{path} gives site energies, converting them to photons needs photons_per_kev")
+        n = np.rint(table["energy"] * photons_per_kev)
+    else:
+        raise ValueError(f"{path} has neither an 'n' nor an 'energy' field")
+    if "event" not in names:
+        raise ValueError(f"{path} has no 'event' field")
+    return make_sites(positions, n, event=table["event"])
+
+
+def event_bounds(sites: np.ndarray) -> np.ndarray:
+    """Row offsets of the events in a site table, i.e. event k has the sites
+    `sites[bounds[k]:bounds[k + 1]]`."""
+    starts = np.flatnonzero(np.diff(sites["event"])) + 1
+    return np.concatenate(([0], starts, [len(sites)]))
+
+
+def site_ids(sites: np.ndarray) -> np.ndarray:
+    """Index of each site within its event."""
+    bounds = event_bounds(sites)
+    return np.arange(len(sites)) - np.repeat(bounds[:-1], np.diff(bounds))
+
+
+def batch_events(sites: np.ndarray, max_photons: int, max_sites: int = None) -> list:
+    """Splits a site table into slices of whole events with at most
+    `max_photons` photons each (an event with more photons gets a batch to
+    itself) and, if given, at most `max_sites` sites each, e.g. the number of
+    sources that can be time tagged (see `generator.photons.max_time_tags`)."""
+    bounds = event_bounds(sites)
+    if max_sites is not None and len(bounds) > 1 and np.diff(bounds).max() > max_sites:
+        k = int(np.argmax(np.diff(bounds)))
+        raise ValueError(
+            f"event {sites['event'][bounds[k]]} has {bounds[k + 1] - bounds[k]} sites, "
+            f"a batch holds at most {max_sites}"
+        )
+    photons = np.concatenate(([0], np.cumsum(sites["n"])))[bounds]
+    batches = []
+    first = 0
+    for k in range(1, len(bounds)):
+        too_many_sites = max_sites is not None and bounds[k] - bounds[first] > max_sites
+        if k - 1 > first and (photons[k] - photons[first] > max_photons or too_many_sites):
+            batches.append(slice(bounds[first], bounds[k - 1]))
+            first = k - 1
+    if len(bounds) > 1:
+        batches.append(slice(bounds[first], bounds[-1]))
+    return batches
@@ -1,3 +1,5 @@
+import itertools
+
 import numpy as np
 from chroma import make
 
@@ -26,6 +28,11 @@ class BBox:
         new_max = np.c_[self.max, other.max].max(axis=1)
         return BBox(new_min, new_max)
 
+    def transformed(self, rotation, translation):
+        """The bounding box of this box rotated about the origin, then translated."""
+        corners = np.array(list(itertools.product(*zip(self.min, self.max))))
+        return BBox(corners @ np.transpose(rotation) + translation)
+
     def as_mesh(self):
         box_center = (self.min + self.max) / 2
         dx, dy, dz = self.extent
@@ -6,7 +6,7 @@ import glob
 import logging
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Any, List
 
 import chroma.make as make
 import numpy as np
@@ -15,17 +15,20 @@ import yaml
 from chroma import geometry
 from chroma.camera import EventViewer
 from chroma.detector import Detector
-from chroma.loader import create_geometry_from_obj, mesh_from_stl
+from chroma.loader import create_geometry_from_obj
 from chroma.transform import make_rotation_matrix
 
 from geometry.bbox import BBox
+from geometry.bundle import is_bundle, open_bundle
 import geometry.surfaces as surfaces
 import geometry.materials as materials
-from geometry.cache import GeometryCache
+from geometry.cache import GeometryCache, MeshCache, content_hash, file_hash
+from geometry.instancing import dedupe_meshes, load_instances
+from geometry.stl import load_meshes
 from utils.color import format_color
 from utils.mesh import gen_rot
 
-__all__ = ["build_detector_from_yaml", "build_detector_from_config"]
+__all__ = ["build_detector_from_yaml", "build_detector_from_config", "geometry_key"]
 
 log = logging.getLogger(__file__.split("/")[-1].split(".")[0])
 log.setLevel(logging.INFO)
@@ -52,12 +55,16 @@ class PartConfig:
     scale: float
     material: Material
     is_detector: bool
+    members: str = None
+    instances: Any = None
+    dedupe: bool = False
 
 @dataclass
 class DetectorConfig:
     target: str
     parts: List[PartConfig]
     log: bool
+    workers: int = None
 
 
 def load_config_from_yaml(config_path: Path) -> DetectorConfig:
@@ -68,14 +75,24 @@ def load_config_from_yaml(config_path: Path) -> DetectorConfig:
         
         ```yaml
         target: vacuum
+        workers: 8      # optional, processes parsing STLs (default: all cores)
         parts:
             - name: ...
               path: ...
+              members: ...      # optional, if path is a mesh bundle (see geometry/bundle.py)
+              instances: ...    # optional, placements of the part's single mesh (see below)
+              dedupe: ...       # optional, share the mesh of translated or rotated copies
               rotation: ...
               translation: ...
               scale: ...
               material: ...
               is_detector: ...
+
+    `instances` places copies of one mesh, each a solid (and a channel, for
+    detectors) of its own, without loading the mesh again. It is a list of
+    `translation`/`rotation` placements like those of a part, or a file of
+    them (see `geometry.instancing.load_instances`). Placements apply in the
+    frame of the STL file, before the part's rotation and translation.
     """
 
     with open(config_path, "r") as f:
@@ -85,6 +102,7 @@ def load_config_from_yaml(config_path: Path) -> DetectorConfig:
         target=config_dict.get("target", "vacuum"),
         parts=[PartConfig(**part) for part in config_dict["parts"]],
         log=config_dict.get("log", False),
+        workers=config_dict.get("workers"),
     )
 
 
@@ -92,6 +110,7 @@ def build_detector_from_yaml(
     config_path: str | Path,
     flat: bool = True,
     load_cache: bool | str = True,
+    workers: int = None,
 ) -> Detector:
     """Builds a detector from a yaml file.
 
@@ -105,35 +124,77 @@ def build_detector_from_yaml(
         If `True`, it will attempt to load the detector from the cache to save time.
         If the detector is not in the cache, it will build the detector and save it
         to the cache. If a string is provided, it will be used as the cache path.
-        The default cache path is `~/.chroma/cache`.
+        The default cache path is `~/.chroma/cache`. Detectors are cached by the
+        contents of their STL files, placements, materials and surfaces (see
+        `geometry_key`), and the parsed meshes of STL files are cached in
+        `meshes/` of the cache path, so a rebuild only parses changed files.
+    workers : int
+        The number of processes parsing STL files, overriding `workers` in
+        the yaml file. Defaults to the number of cores.
         
     Returns
     -------
     chroma.Detector
         The detector object.
     """
+    config = load_config_from_yaml(config_path)
+    if workers is not None:
+        config.workers = workers
+
+    mesh_cache = None
     if load_cache:
-        cache = GeometryCache()
-        cached_detector = cache.load(config_path)
+        cache_path = Path("~/.chroma/" if load_cache is True else load_cache).expanduser()
+        cache = GeometryCache(cache_path)
+        mesh_cache = MeshCache(cache_path / "meshes")
+        key = geometry_key(config, flat)
+        cached_detector = cache.load(key)
         if cached_detector:
             return create_geometry_from_obj(cached_detector, auto_build_bvh=False)
 
-    config = load_config_from_yaml(config_path)
-    detector = build_detector_from_config(config, flat)
+    detector = build_detector_from_config(config, flat, mesh_cache)
 
     if load_cache:
-        cache.save(detector, config_path)
+        cache.save(detector, key)
 
     return detector
 
 
-def build_detector_from_config(config: DetectorConfig, flat: bool = True) -> Detector:
-    """Builds a detector from a DetectorConfig object."""
+def geometry_key(config: DetectorConfig, flat: bool = True) -> str:
+    """A content hash of a detector definition.
+
+    Each part contributes the hashes of its STL files, its placement and the
+    properties of its materials and surface, so the key changes whenever
+    anything the built detector depends on does, not only the yaml file.
+    """
+
+    parts = [
+        content_hash(
+            (open_bundle(part.path).hash, part.members)
+            if is_bundle(part.path)
+            else [file_hash(p) for p in sorted(glob.glob(part.path))],
+            part.rotation,
+            part.translation,
+            part.scale,
+            part.is_detector,
+            file_hash(part.instances) if isinstance(part.instances, str) else part.instances,
+            part.dedupe,
+            prepare_material_kwargs(part.material),
+        )
+        for part in config.parts
+    ]
+    return content_hash(getattr(materials, config.target), flat, parts)
+
+
+def build_detector_from_config(
+    config: DetectorConfig, flat: bool = True, mesh_cache: MeshCache = None
+) -> Detector:
+    """Builds a detector from a DetectorConfig object, reading parsed STL
+    files from `mesh_cache` if given."""
 
     target_material = getattr(materials, config.target)
     detector = Detector(target_material)
 
-    solid_bbox = build_detector_parts(detector, config)
+    solid_bbox = build_detector_parts(detector, config, mesh_cache)
     add_cavity_from_bbox(detector, solid_bbox)
 
     if flat:
@@ -142,11 +203,29 @@ def build_detector_from_config(config: DetectorConfig, flat: bool = True) -> Det
     return detector
 
 
-def build_detector_parts(detector: Detector, config: DetectorConfig) -> BBox:
-    """Builds and adds individual parts to the detector. Returns the bounding box of all parts."""
+def build_detector_parts(detector: Detector, config: DetectorConfig, mesh_cache: MeshCache = None) -> BBox:
+    """Builds and adds individual parts to the detector. Returns the bounding box of all parts.
+
+    The STL files of all parts are parsed up front by a pool of `config.workers`
+    processes. Solids are added in the order of the parts and, within a part,
+    of the sorted file names, so channel ids do not depend on the pool. Files
+    whose meshes are in `mesh_cache` are not parsed again.
+
+    A part whose `path` is a mesh bundle takes the meshes of the bundle whose
+    names match `members` (default all), in sorted name order, instead of
+    parsing STL files.
+
+    A part with `instances` adds one solid per placement of its mesh; with
+    `dedupe`, meshes that are translated or rotated copies of each other share
+    one solid. Either way, the solids are added in the order of the placements
+    or meshes.
+    """
+
+    paths = [[] if is_bundle(part.path) else sorted(glob.glob(part.path)) for part in config.parts]
+    stl_meshes = iter(load_meshes([p for part_paths in paths for p in part_paths], config.workers, mesh_cache))
 
     solid_bbox = BBox()
-    for i, part in enumerate(config.parts, 1):
+    for i, (part, part_paths) in enumerate(zip(config.parts, paths), 1):
         log.info(f"[{i}/{len(config.parts)}] building part {part.name}")
 
         rotation = (
@@ -157,18 +236,44 @@ def build_detector_parts(detector: Detector, config: DetectorConfig) -> BBox:
 
         material_kwargs = prepare_material_kwargs(part.material)
 
-        for p in sorted(glob.glob(part.path)):
-            if config.log:
+        if is_bundle(part.path):
+            bundle = open_bundle(part.path)
+            indices = bundle.select(part.members)
+            sources = [f"{part.path}:{bundle.names[j]}" for j in indices]
+            meshes = [bundle.mesh(j) for j in indices]
+        else:
+            sources = part_paths
+            meshes = [next(stl_meshes) for _ in part_paths]
+
+        if config.log:
+            for p in sources:
                 log.info(f"\tloading {p}")
 
-            mesh = mesh_from_stl(p)
-            solid = geometry.Solid(mesh, **material_kwargs)
-            solid_bbox += BBox(mesh.vertices)
+        # every solid is one of `bases` placed by (R, t) in the frame of the STL files
+        if part.instances is not None:
+            if len(meshes) != 1:
+                raise ValueError(f"part {part.name} has instances, so its path must match one mesh, not {len(meshes)}")
+            bases, placements = meshes, load_instances(part.instances)
+            base_index = np.zeros(len(placements), dtype=np.intp)
+        elif part.dedupe:
+            bases, base_index, rotations, translations = dedupe_meshes(meshes)
+            placements = list(zip(rotations, translations))
+            log.info(f"\t{len(meshes)} meshes are copies of {len(bases)}")
+        else:
+            bases, base_index = meshes, np.arange(len(meshes))
+            placements = [(np.eye(3), np.zeros(3))] * len(meshes)
+
+        solids = [geometry.Solid(mesh, **material_kwargs) for mesh in bases]
+        bboxes = [BBox(mesh.vertices) for mesh in bases]
+        translation = np.asarray(part.translation, dtype=float)
+
+        for j, (R, t) in zip(base_index, placements):
+            solid_bbox += bboxes[j].transformed(R, t)
 
             if part.is_detector:
-                detector.add_pmt(solid, rotation, part.translation)
+                detector.add_pmt(solids[j], rotation @ R, rotation @ t + translation)
             else:
-                detector.add_solid(solid, rotation, part.translation)
+                detector.add_solid(solids[j], rotation @ R, rotation @ t + translation)
 
     return solid_bbox
 
@@ -212,13 +317,16 @@ if __name__ == "__main__":
     parser.add_argument(
         "--no-cache", action="store_true", help="do not load from cache"
     )
+    parser.add_argument(
+        "-j", "--workers", type=int, help="number of processes parsing STL files"
+    )
     parser.add_argument(
         "-i", "--input_root", type=str, help="path to the event file (ROOT) to visualize"
     )
 
     args = parser.parse_args()
 
-    g = build_detector_from_yaml(args.yaml, load_cache=not args.no_cache)
+    g = build_detector_from_yaml(args.yaml, load_cache=not args.no_cache, workers=args.workers)
 
     if args.input_root is None:
         from chroma.camera import Camera
@@ -0,0 +1,143 @@
+import fnmatch
+import hashlib
+import json
+import os
+from collections import Counter
+from functools import lru_cache
+from pathlib import Path
+from typing import List, Sequence
+
+import numpy as np
+from chroma.geometry import Mesh
+
+from geometry.stl import load_meshes
+from utils.files import atomic_path
+
+__all__ = ["MeshBundle", "write_bundle", "is_bundle", "open_bundle"]
+
+INDEX = "index.json"
+
+
+def is_bundle(path: str) -> bool:
+    """Whether `path` is a mesh bundle directory written by `write_bundle`."""
+    return os.path.isfile(os.path.join(path, INDEX))
+
+
+def write_bundle(path: str, stl_files: Sequence[str], workers: int = None) -> "MeshBundle":
+    """Packs STL files into a mesh bundle.
+
+    A bundle is a directory of `.npy` arrays holding the vertices and
+    triangles of all meshes back to back, the offsets of each mesh into them,
+    and an `index.json` with the mesh names (the STL file names without
+    extension) and a hash of the contents. Loading it is a few large reads
+    instead of opening and parsing one file per mesh.
+
+    Usage:
+    ```python
+    write_bundle("data/stl/electrode.bundle", sorted(glob.glob("data/stl/electrode/*.stl")))
+    ```
+
+    Parameters
+    ----------
+    path : str
+        The bundle directory, replaced if it exists.
+    stl_files : sequence of str
+        The STL files, in the order they are stored.
+    workers : int, optional
+        The number of processes parsing the STL files, see `geometry.stl.load_meshes`.
+
+    Returns
+    -------
+    MeshBundle
+        The bundle written.
+    """
+    names = [os.path.splitext(os.path.basename(p))[0] for p in stl_files]
+    duplicates = sorted(name for name, count in Counter(names).items() if count > 1)
+    if duplicates:
+        raise ValueError(f"mesh names must be unique, got several files named {duplicates}")
+
+    meshes = load_meshes(list(stl_files), workers)
+    arrays = {
+        "vertices": np.concatenate([m.vertices for m in meshes]),
+        "triangles": np.concatenate([m.triangles for m in meshes]),
+        "vertex_offsets": np.cumsum([0] + [len(m.vertices) for m in meshes]),
+        "triangle_offsets": np.cumsum([0] + [len(m.triangles) for m in meshes]),
+    }
+    h = hashlib.sha1()
+    for key, array in arrays.items():
+        h.update(key.encode())
+        h.update(array.tobytes())
+
+    with atomic_path(path) as tmp:
+        os.makedirs(tmp)
+        for key, array in arrays.items():
+            np.save(os.path.join(tmp, f"{key}.npy"), array)
+        with open(os.path.join(tmp, INDEX), "w") as f:
+            json.dump({"names": names, "hash": h.hexdigest()}, f, indent=2)
+    return MeshBundle(path)
+
+
+def open_bundle(path: str) -> "MeshBundle":
+    """The `MeshBundle` at `path`, opened once and shared by later calls.
+
+    Bundles are memoized by path and the modification time of their index,
+    so a bundle rewritten by `write_bundle` is opened again.
+    """
+    path = os.path.abspath(path)
+    return _open_bundle(path, os.stat(os.path.join(path, INDEX)).st_mtime_ns)
+
+
+@lru_cache(maxsize=32)
+def _open_bundle(path: str, mtime: int) -> "MeshBundle":
+    return MeshBundle(path)
+
+
+class MeshBundle:
+    """A memory-mapped mesh bundle written by `write_bundle`. Triangles index the
+    vertices of their own mesh, so a mesh is a pair of slices of the arrays.
+    """
+
+    def __init__(self, path: str):
+        self.path = Path(path)
+        with open(self.path / INDEX) as f:
+            index = json.load(f)
+        self.names: List[str] = index["names"]
+        self.hash: str = index["hash"]
+        self._order = sorted(range(len(self.names)), key=self.names.__getitem__)
+        self._index = {name: i for i, name in enumerate(self.names)}
+        self.vertices = np.load(self.path / "vertices.npy", mmap_mode="r")
+        self.triangles = np.load(self.path / "triangles.npy", mmap_mode="r")
+        self.vertex_offsets = np.load(self.path / "vertex_offsets.npy")
+        self.triangle_offsets = np.load(self.path / "triangle_offsets.npy")
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def select(self, members: str = None) -> List[int]:
+        """The indices of the meshes whose names match the glob `members`
+        (default all), in sorted name order like the files of a globbed part."""
+        if members is None:
+            return list(self._order)
+        members = str(members)
+        if not any(c in members for c in "*?["):
+            return [self._index[members]] if members in self._index else []
+        return [i for i in self._order if fnmatch.fnmatchcase(self.names[i], members)]
+
+    def mesh(self, i: int) -> Mesh:
+        """The i-th mesh."""
+        v0, v1 = self.vertex_offsets[i], self.vertex_offsets[i + 1]
+        t0, t1 = self.triangle_offsets[i], self.triangle_offsets[i + 1]
+        return Mesh(np.array(self.vertices[v0:v1]), np.array(self.triangles[t0:t1]))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Pack STL files into a mesh bundle")
+    parser.add_argument("bundle", type=str, help="path of the bundle directory to write")
+    parser.add_argument("files", type=str, nargs="+", help="STL files")
+    parser.add_argument("-j", "--workers", type=int, help="number of processes parsing STL files")
+    args = parser.parse_args()
+
+    bundle = write_bundle(args.bundle, sorted(args.files), args.workers)
+    print(f"Wrote {len(bundle)} meshes to {args.bundle}")
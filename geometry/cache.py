@@ -1,51 +1,127 @@
 import hashlib
 import logging
 import os
+from functools import lru_cache
 from pathlib import Path
+from typing import Tuple
 
+import numpy as np
 from chroma.cache import Cache as ChromaCache
 from chroma.detector import Detector
 
-__all__ = ["GeometryCache"]
+from utils.files import atomic_write
+
+__all__ = ["GeometryCache", "MeshCache", "content_hash", "file_hash"]
 
 log = logging.getLogger(__name__)
 
+
+def _update(h, value):
+    if isinstance(value, np.ndarray):
+        h.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        h.update(f"dict{len(value)}".encode())
+        for key in sorted(value, key=str):
+            _update(h, key)
+            _update(h, value[key])
+    elif isinstance(value, (list, tuple)):
+        h.update(f"seq{len(value)}".encode())
+        for item in value:
+            _update(h, item)
+    elif hasattr(value, "__dict__"):
+        # e.g. chroma materials and surfaces, hashed by their properties
+        h.update(type(value).__name__.encode())
+        _update(h, vars(value))
+    else:
+        h.update(f"{type(value).__name__}:{value!r}".encode())
+
+
+def content_hash(*values) -> str:
+    """A hash of nested arrays, containers, scalars and the attributes of
+    objects such as chroma materials and surfaces."""
+    h = hashlib.sha1()
+    for value in values:
+        _update(h, value)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path: str, mtime_ns: int, size: int) -> str:
+    return hashlib.sha1(Path(path).read_bytes()).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """The hash of a file's contents, computed once per version of the file."""
+    stat = os.stat(path)
+    return _file_hash(str(path), stat.st_mtime_ns, stat.st_size)
+
+
 class GeometryCache:
     """A cache for detector geometries.
-    
+
     This utilizes chroma's cache system to store detector geometries. This thin wrapper
     loads and saves detector geometries to the cache based on chroma-lxe based
-    detector specifications.
+    detector specifications. Geometries are keyed by a content hash of the
+    specification (see `geometry.builder.geometry_key`), so editing an STL file,
+    material or surface invalidates them.
     """
-    
+
     def __init__(self, cache_path: Path = Path("~/.chroma/").expanduser()):
         """Initializes the cache.
-        
+
         Parameters
         ----------
         cache_path : Path
             The path to the cache directory. Default is ~/.chroma/.
         """
-        
+
         self.chroma_cache = ChromaCache(cache_path)
 
-    def load(self, config_path: Path) -> Detector:
-        md5 = self._calculate_md5(config_path)
-        if md5 in self.chroma_cache.list_geometry():
+    def load(self, key: str) -> Detector:
+        if key in self.chroma_cache.list_geometry():
             log.info("Loading geometry from cache")
-            return self.chroma_cache.load_geometry(md5)
+            return self.chroma_cache.load_geometry(key)
         else:
             log.info("Geometry not in cache")
             return None
 
-    def save(self, detector: Detector, config_path: Path):
+    def save(self, detector: Detector, key: str):
         log.info("Saving geometry to cache")
-        md5 = self._calculate_md5(config_path)
-        self.chroma_cache.save_geometry(md5, detector)
-
-    @staticmethod
-    def _calculate_md5(path: Path) -> str:
-        if isinstance(path, str):
-            path = Path(path)
-        
-        return hashlib.md5(path.read_bytes()).hexdigest()
+        self.chroma_cache.save_geometry(key, detector)
+
+
+class MeshCache:
+    """A cache for parsed STL meshes, keyed by the hash of the STL contents.
+
+    Rebuilding a detector after a change to one part only parses the STL
+    files that changed; the meshes of all others are read back from their
+    vertex and triangle arrays.
+    """
+
+    def __init__(self, cache_path: Path = Path("~/.chroma/meshes").expanduser()):
+        """Initializes the cache.
+
+        Parameters
+        ----------
+        cache_path : Path
+            The path to the cache directory. Default is ~/.chroma/meshes.
+        """
+
+        self.cache_path = Path(cache_path).expanduser()
+        self.cache_path.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, key: str) -> Path:
+        return self.cache_path / f"{key}.npz"
+
+    def load(self, key: str) -> Tuple[np.ndarray, np.ndarray]:
+        """The (vertices, triangles) of a mesh, or None if not cached."""
+        try:
+            with np.load(self._path(key)) as f:
+                return f["vertices"], f["triangles"]
+        except (OSError, KeyError, ValueError):
+            return None
+
+    def save(self, key: str, vertices: np.ndarray, triangles: np.ndarray):
+        with atomic_write(self._path(key), "wb") as f:
+            np.savez(f, vertices=vertices, triangles=triangles)
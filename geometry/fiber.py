@@ -1,5 +1,3 @@
-import pickle
-
 import numpy as np
 from geometry.fiberbase import BaseFiber
 
@@ -31,10 +29,9 @@ class M114L01(BaseFiber):
     diameter = 600
     numerical_aperture = 0.22
     mode = "cladding"
-    wavelength, intensity = pickle.load(
-        open("/home/sam/sw/chroma-lxe/data/xe-spectrum.p", "rb")
-    )
-    
+    spectrum = "xe-spectrum"
+
+
 def main():
     fiber = M114L01(position=[0, 0, 0], direction=[0, 0, 1])
     photons = fiber.generate_photons(1e5)
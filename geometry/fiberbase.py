@@ -1,15 +1,87 @@
+import hashlib
+from functools import lru_cache
+
 import numpy as np
 from chroma.event import Photons
 from chroma.sample import uniform_sphere
-from pydantic import BaseModel, Field, field_validator, model_validator
+from pydantic import BaseModel, Field, PrivateAttr, field_validator, model_validator
 from typing import Tuple, List, Literal
-from scipy.interpolate import interp1d
+import yaml
 from scipy.special import jn
 
+from generator.buffers import PhotonBuffer, cross_into, fill_uniform_sphere
+from geometry.spectra import load_spectrum
 from utils.mesh import cylinder
 from utils.mesh import um2mm, mm2um
 from utils.mesh import gen_rot
 
+class InverseCDF:
+    """Samples a tabulated distribution from its inverse cumulative distribution,
+    tabulated at `size` equally spaced quantiles so that no search is needed.
+    """
+
+    def __init__(self, x: np.ndarray, cdf: np.ndarray, size: int = 4096):
+        self.cdf = np.asarray(cdf, dtype=float)
+        self.values = np.interp(np.linspace(0, 1, size), self.cdf, x)
+
+    def __call__(self, u: np.ndarray) -> np.ndarray:
+        """The values at the quantiles `u` in [0, 1)."""
+        position = u * (len(self.values) - 1)
+        i = position.astype(np.intp)
+        lower = self.values[i]
+        return lower + (position - i) * (self.values[i + 1] - lower)
+
+
+_WAVELENGTH_TABLES = {}
+
+
+def wavelength_table(wavelength: np.ndarray, intensity: np.ndarray) -> InverseCDF:
+    """The wavelength sampling table of a spectrum, built once per spectrum."""
+    wavelength = np.asarray(wavelength, dtype=float)
+    intensity = np.asarray(intensity, dtype=float)
+    key = hashlib.sha1(wavelength.tobytes() + intensity.tobytes()).hexdigest()
+    if key not in _WAVELENGTH_TABLES:
+        cdf = np.cumsum(intensity)
+        _WAVELENGTH_TABLES[key] = InverseCDF(wavelength, cdf / cdf[-1])
+    return _WAVELENGTH_TABLES[key]
+
+
+@lru_cache(maxsize=None)
+def spectrum_table(name: str) -> InverseCDF:
+    """The wavelength sampling table of a spectrum of the registry in
+    `geometry.spectra`, built from its precomputed cumulative distribution."""
+    spectrum = load_spectrum(name)
+    return InverseCDF(spectrum.wavelength, spectrum.cdf)
+
+
+@lru_cache(maxsize=None)
+def cladding_radius_table(radius: float) -> InverseCDF:
+    """The radius sampling table of the cladding mode of a fiber core of
+    radius `radius` in mm.
+
+    We use the Bessel function of the first kind of order 5 to generate an
+    intensity distribution that emperically looks like a cladding mode, and
+    tabulate the inverse of its cumulative distribution.
+    """
+    r = np.linspace(0, radius, 500)
+    intensity = np.abs(jn(5, r * 8.5 / radius)) ** 2
+    cdf = np.cumsum(intensity)
+    return InverseCDF(r, cdf / cdf[-1])
+
+
+def rotate_into(out: np.ndarray, components, axes, offset: np.ndarray = None) -> np.ndarray:
+    """Sums `components[i][:, None] * axes[i]` (plus `offset`) into the (n, 3)
+    `out`, allocating it if None. The axes, i.e. columns of rotation matrices,
+    and the offset are either shared (3,) vectors or per-row (n, 3) arrays."""
+    out = np.empty((len(components[0]), 3)) if out is None else out
+    np.multiply(components[0][:, None], axes[0], out=out)
+    for component, axis in zip(components[1:], axes[1:]):
+        out += component[:, None] * axis
+    if offset is not None:
+        out += offset
+    return out
+
+
 class FiberMeta(type(BaseModel)):
     def __new__(mcs, name, bases, namespace):
         annotations = namespace.get("__annotations__", {})
@@ -40,6 +112,14 @@ class BaseFiber(BaseModel, metaclass=FiberMeta):
 
     numerical_aperture: float = Field(...)
     mode: Literal["cladding", "gaussian"] = "cladding"
+
+    # name of a spectrum in data/ (see geometry.spectra), loaded on first
+    # instantiation in place of `wavelength` and `intensity`
+    spectrum: str = None
+
+    _rotation_matrix: np.ndarray = PrivateAttr(None)
+    _wavelength_table: InverseCDF = PrivateAttr(None)
+    _radius_table: InverseCDF = PrivateAttr(None)
     
     # millimeters
     position: Tuple[float, float, float] = (0, 0, 0)
@@ -60,145 +140,114 @@ class BaseFiber(BaseModel, metaclass=FiberMeta):
         return self
 
     def __init__(self, **data):
-        # Load wavelength and intensity from class attributes if not provided
-        if "wavelength" not in data and hasattr(self.__class__, "wavelength"):
-            data["wavelength"] = self.__class__.wavelength
-        if "intensity" not in data and hasattr(self.__class__, "intensity"):
-            data["intensity"] = self.__class__.intensity
+        # Load wavelength and intensity from the spectrum registry if not provided
+        spectrum = data.get("spectrum", type(self).model_fields["spectrum"].default)
+        if spectrum is not None and "wavelength" not in data and "intensity" not in data:
+            spectrum = load_spectrum(spectrum)
+            data["wavelength"], data["intensity"] = spectrum.wavelength, spectrum.intensity
 
         super().__init__(**data)
         self._initialize_properties()
 
     @property
     def cdf(self):
-        if not hasattr(self.__class__, "_cdf"):
-            _cdf = np.cumsum(self.intensity)
-            _cdf /= _cdf[-1]
-            self._cdf = _cdf
-        return self._cdf
+        """Cumulative distribution of the wavelength spectrum."""
+        return self._wavelength_table.cdf
 
     @property
     def rotation_matrix(self):
-        if not hasattr(self.__class__, "_rotation_matrix"):
-            _rotation_matrix = gen_rot([0, 0, 1], self.direction)
-            self._rotation_matrix = _rotation_matrix
         return self._rotation_matrix
 
     def _initialize_properties(self):
         self.diameter = um2mm(self.diameter)  # chroma uses mm
         self.direction = np.array(self.direction)
         self.position = np.array(self.position)
+        self._rotation_matrix = gen_rot([0, 0, 1], self.direction)
+        # fibers of the same model share their sampling tables
+        if self.spectrum is not None and self.wavelength is load_spectrum(self.spectrum).wavelength:
+            self._wavelength_table = spectrum_table(self.spectrum)
+        else:
+            self._wavelength_table = wavelength_table(self.wavelength, self.intensity)
+        if self.mode == "cladding":
+            self._radius_table = cladding_radius_table(self.diameter / 2)
+
+    def wavelength_sampler(self, num_samples: int, rng: np.random.Generator = None) -> np.ndarray:
+        rng = np.random if rng is None else rng
+        return self._wavelength_table(rng.random(num_samples))
 
-    def wavelength_sampler(self, num_samples: int) -> np.ndarray:
-        random_values = np.random.rand(num_samples)
-        sampled_wavelengths = np.interp(random_values, self.cdf, self.wavelength)
-        return sampled_wavelengths
+    def sample_positions(self, num_samples: int, rng: np.random.Generator = None, out: np.ndarray = None) -> np.ndarray:
+        """Sample emission points on the fiber face, written into the (n, 3)
+        `out` if given."""
+        R = self.rotation_matrix
+        x, y = self._sample_face(num_samples, np.random if rng is None else rng)
+        return rotate_into(out, (x, y), (R[:, 0], R[:, 1]), self.position + 1e-3 * self.direction)
 
-    def sample_positions(self, num_samples: int) -> np.ndarray:        
+    def _sample_face(self, num_samples: int, rng=np.random):
+        """Sample points (x, y) on the face of a fiber pointing along z."""
         if self.mode == "cladding":
-            return self._sample_positions_cladding(num_samples)
+            r = self._radius_table(rng.random(num_samples))
         else:
-            return self._sample_positions_gaussian(num_samples)
+            r = self._sample_radii_gaussian(num_samples, rng)
+        theta = 2 * np.pi * rng.random(num_samples)
+        return r * np.cos(theta), r * np.sin(theta)
+
+    def _sample_radii_gaussian(self, num_samples: int, rng=np.random) -> np.ndarray:
+        """Sample radii from a radially symmetric Gaussian beam truncated at the core.
 
-    def _sample_positions_gaussian(self, num_samples: int) -> np.ndarray:
-        """Sample positions from a radially symmetric Gaussian distribution via Box-Muller method
+        The radius of a Box-Muller pair, r = w_0 sqrt(-ln(U) / 2), is at most w_0
+        for U >= exp(-2), so U is drawn uniformly from [exp(-2), 1) instead of
+        rejecting the radii outside the core.
 
         See: https://en.wikipedia.org/wiki/Box%E2%80%93Muller_transform
         """
         
         w_0 = self.diameter / 2
-        U = np.random.rand(num_samples)
-        r = w_0 * np.sqrt(-np.log(U) / 2)
-        r = r[r <= w_0]
-
-        theta = 2 * np.pi * np.random.rand(len(r))
-        x = r * np.cos(theta)
-        y = r * np.sin(theta)
-        z = np.zeros(len(r))
-        pos = np.stack((x, y, z), axis=-1)
-
-        def transform(x):
-            return np.dot(x, self.rotation_matrix.T) \
-            + self.position \
-            + 1e-3 * self.direction
-
-        while len(pos) < num_samples:
-            return np.vstack(
-                (
-                    transform(pos),
-                    self._sample_positions_gaussian(num_samples - len(pos)),
-                )
-            )
-
-        return transform(pos)
-
-    def _sample_positions_cladding(self, num_samples: int) -> np.ndarray:
-        """Sample positions from an intensity distribution that emperically looks
-        like a cladding mode.
-        
-        We use the Bessel function of the first kind of order 5 to generate the intensity
-        distribution. The radial positions are sampled by inverting the cumulative
-        distribution function of the intensity distribution.
-        """
-        
-        r = np.linspace(0, self.diameter / 2, 500)
-        intensity = np.abs(jn(5, r * 8.5 / (self.diameter / 2))) ** 2
-        cdf_intensity = np.cumsum(intensity)
-        cdf_intensity /= cdf_intensity[-1]
-
-        random_values = np.random.rand(num_samples)
-        interp_r = interp1d(
-            cdf_intensity, r, fill_value="extrapolate", bounds_error=False
-        )
-        sampled_r = interp_r(random_values)
-
-        theta = 2 * np.pi * np.random.rand(num_samples)
-        x = sampled_r * np.cos(theta)
-        y = sampled_r * np.sin(theta)
-        z = np.zeros(num_samples)
-        pos = np.stack((x, y, z), axis=-1)
-
-        def transform(x):
-            return (
-                np.dot(x, self.rotation_matrix.T)
-                + self.position
-                + 1e-3 * self.direction
-            )
+        U = 1 - (1 - np.exp(-2)) * rng.random(num_samples)
+        return w_0 * np.sqrt(-np.log(U) / 2)
 
-        return transform(pos)
-
-    def direction_sampler(self, num_samples: int) -> np.ndarray:
+    def direction_sampler(
+        self, num_samples: int, rng: np.random.Generator = None, out: np.ndarray = None
+    ) -> np.ndarray:
         """Sample directions from a uniform distribution within the numerical aperture of the fiber."""
         
-        divergence_angle = np.arcsin(self.numerical_aperture)
-        phi = 2 * np.pi * np.random.rand(num_samples)
-        theta = divergence_angle * np.sqrt(np.random.rand(num_samples))
-        directions = np.stack(
-            (np.sin(theta) * np.cos(phi), \
-             np.sin(theta) * np.sin(phi), \
-             np.cos(theta)),
-            axis=-1,
-        )
-        dirr = np.dot(directions, self.rotation_matrix.T)
-        print('sampled direction pre-rotation\n', directions[0])
-        print('sampled direction post-rotation\n', dirr[0])
-        return np.dot(directions, self.rotation_matrix.T)
+        R = self.rotation_matrix
+        components = self._sample_angles(num_samples, np.random if rng is None else rng)
+        return rotate_into(out, components, (R[:, 0], R[:, 1], R[:, 2]))
 
-    def generate_photons(self, num_photons: int) -> Photons:
+    def _sample_angles(self, num_samples: int, rng=np.random):
+        """Sample the (x, y, z) components of directions within the numerical
+        aperture of a fiber pointing along z."""
+        divergence_angle = np.arcsin(self.numerical_aperture)
+        phi = 2 * np.pi * rng.random(num_samples)
+        theta = divergence_angle * np.sqrt(rng.random(num_samples))
+        sin_theta = np.sin(theta)
+        return sin_theta * np.cos(phi), sin_theta * np.sin(phi), np.cos(theta)
+
+    def generate_photons(
+        self, num_photons: int, out: PhotonBuffer = None, rng: np.random.Generator = None
+    ) -> Photons:
         """Generate photons with random positions, directions, polarizations, and wavelengths.
         
         Directions are sampled from a uniform distribution within the numerical aperture of the fiber.
         Polarizations are generated by taking the cross product of the direction and a random vector.
         Positions are sampled from a radially symmetric Gaussian distribution or an empirical cladding mode.
         Wavelengths are sampled from the intensity distribution of the fiber.
+
+        The photons are written into `out` if given, e.g. a slice of a pooled
+        `generator.buffers.PhotonBuffer` holding the photons of several fibers.
+        Random numbers are drawn from `rng` (e.g. a `generator.rng.RandomStreams`
+        stream), or numpy's global random state.
         """
 
         num_photons = int(num_photons)
-        positions = self.sample_positions(num_photons)
-        directions = self.direction_sampler(num_photons)
-        polarizations = np.cross(directions, uniform_sphere(num_photons))
-        initial_wavelengths = self.wavelength_sampler(num_photons)
-        return Photons(positions, directions, polarizations, initial_wavelengths)
+        out = PhotonBuffer(num_photons) if out is None else out.reserve(num_photons)
+        self.sample_positions(num_photons, rng, out=out.pos)
+        self.direction_sampler(num_photons, rng, out=out.dir)
+        fill_uniform_sphere(out.pol, out.scratch, rng)
+        cross_into(out.dir, out.pol, out.scratch)
+        out.wavelengths[:] = self.wavelength_sampler(num_photons, rng)
+        out.t[:] = 0
+        return out.photons()
 
     def generate_photons_mesh(self, num_photons: int = 1000, concatenate: bool = True) -> List:
         """Generate photons and return them as a mesh of cylinders to quickly visualize them in trimesh.
@@ -238,6 +287,89 @@ class BaseFiber(BaseModel, metaclass=FiberMeta):
             cyls.append(cyl)
         return trimesh.util.concatenate(cyls) + axis if concatenate else cyls + [axis]
 
+class FiberArray:
+    """An array of identical `model` fibers whose photons are sampled together.
+
+    The fibers share their model's sampling tables and photons of all fibers are
+    drawn in one pass, ordered by fiber (see `fiber_ids`).
+    """
+
+    def __init__(self, model, positions: np.ndarray, directions: np.ndarray, names: List[str] = None, **kwargs):
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+        if len(positions) != len(directions):
+            raise ValueError(f"got {len(positions)} fiber positions but {len(directions)} directions")
+        self.fibers = [model(position=p, direction=d, **kwargs) for p, d in zip(positions, directions)]
+        self.names = list(names) if names is not None else [f"fiber_{i}" for i in range(len(positions))]
+        # the first fiber samples the face and angles of all fibers
+        self.model = self.fibers[0]
+        self.positions = np.stack([fiber.position for fiber in self.fibers])
+        self.directions = np.stack([fiber.direction for fiber in self.fibers])
+        self.rotation_matrices = np.stack([fiber.rotation_matrix for fiber in self.fibers])
+        self._offsets = self.positions + 1e-3 * self.directions
+
+    @classmethod
+    def from_yaml(cls, path: str, model, **kwargs) -> "FiberArray":
+        """Reads fibers from a YAML file mapping fiber names to their `position`
+        and `direction`, in file order."""
+        with open(path) as f:
+            config = yaml.safe_load(f)
+        names = list(config)
+        positions = [config[name]["position"] for name in names]
+        directions = [config[name]["direction"] for name in names]
+        return cls(model, positions, directions, names=names, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.fibers)
+
+    def photon_counts(self, num_photons) -> np.ndarray:
+        """Photons per fiber, given a count per fiber or a scalar for all."""
+        return np.broadcast_to(np.asarray(num_photons, dtype=np.int64), (len(self),))
+
+    def fiber_ids(self, num_photons) -> np.ndarray:
+        """The fiber index of every photon generated with `num_photons`."""
+        return np.repeat(np.arange(len(self)), self.photon_counts(num_photons))
+
+    def generate_photons(
+        self, num_photons, out: PhotonBuffer = None, rng: np.random.Generator = None, time_offset: float = None
+    ) -> Photons:
+        """Generate the photons of all fibers, sampled as by `BaseFiber.generate_photons`.
+
+        Parameters
+        ----------
+        num_photons : int or array-like
+            The number of photons per fiber, a scalar or one count per fiber.
+        out : PhotonBuffer, optional
+            The buffer to fill.
+        rng : np.random.Generator, optional
+            The generator to draw from. Defaults to numpy's global random state.
+        time_offset : float, optional
+            Photons of the k-th fiber start at `k * time_offset`, so the fiber of
+            a hit is recovered with `generator.photons.source_index`.
+
+        Returns
+        -------
+        photons : chroma.event.Photons
+            The photons, ordered by fiber.
+        """
+        counts = self.photon_counts(num_photons)
+        n = int(counts.sum())
+        out = PhotonBuffer(n) if out is None else out.reserve(n)
+        draw = np.random if rng is None else rng
+
+        # photons are ordered by fiber, so repeating each fiber's rotation axes
+        # is a contiguous copy rather than a gather
+        axes = [np.repeat(self.rotation_matrices[:, :, i], counts, axis=0) for i in range(3)]
+        x, y = self.model._sample_face(n, draw)
+        rotate_into(out.pos, (x, y), axes[:2], np.repeat(self._offsets, counts, axis=0))
+        rotate_into(out.dir, self.model._sample_angles(n, draw), axes)
+        fill_uniform_sphere(out.pol, out.scratch, rng)
+        cross_into(out.dir, out.pol, out.scratch)
+        out.wavelengths[:] = self.model.wavelength_sampler(n, rng)
+        out.t[:] = 0 if time_offset is None else np.repeat(np.arange(len(self)) * time_offset, counts)
+        return out.photons()
+
+
 def main():
     
     class DummyFiber(BaseFiber):
@@ -0,0 +1,117 @@
+from typing import List, Tuple
+
+import numpy as np
+import yaml
+from chroma.geometry import Mesh
+from chroma.transform import make_rotation_matrix
+
+__all__ = ["load_instances", "dedupe_meshes"]
+
+
+def _placement(instance: dict) -> Tuple[np.ndarray, np.ndarray]:
+    rotation = instance.get("rotation")
+    R = (
+        make_rotation_matrix(rotation["angle"] * np.pi / 180.0, rotation["dir"])
+        if rotation and rotation["angle"]
+        else np.eye(3)
+    )
+    return R, np.asarray(instance.get("translation", [0, 0, 0]), dtype=float)
+
+
+def load_instances(instances) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Reads the placements of the instances of a part.
+
+    `instances` is either a list of placements, each with an optional
+    `translation` and `rotation` (an `angle` in degrees about `dir`) like a
+    part, or the path of a file holding them: a yaml file with such a list,
+    or a `.npy` file with an (N, 3) array of translations or an (N, 4, 4)
+    array of homogeneous transformation matrices.
+
+    Returns
+    -------
+    list of (np.ndarray, np.ndarray)
+        The (3, 3) rotation matrix and (3,) translation of every instance.
+    """
+    if isinstance(instances, str):
+        if instances.endswith(".npy"):
+            transforms = np.load(instances)
+            if transforms.ndim == 2 and transforms.shape[1] == 3:
+                return [(np.eye(3), t) for t in transforms.astype(float)]
+            if transforms.ndim == 3 and transforms.shape[1:] == (4, 4):
+                return [(m[:3, :3], m[:3, 3]) for m in transforms.astype(float)]
+            raise ValueError(f"{instances} holds an array of shape {transforms.shape}, expected (N, 3) or (N, 4, 4)")
+        with open(instances, "r") as f:
+            instances = yaml.safe_load(f)
+    return [_placement(instance) for instance in instances]
+
+
+def dedupe_meshes(
+    meshes: List[Mesh], atol: float = 1e-5
+) -> Tuple[List[Mesh], np.ndarray, np.ndarray, np.ndarray]:
+    """Finds meshes that are translated or rotated copies of each other.
+
+    Two meshes are copies if they have the same triangles and a rotation and
+    translation take the vertices of one to those of the other, e.g. SiPM
+    tiles exported from CAD one file each. Vertices must agree to `atol` in mm
+    or, for STL vertices far from the origin, to a few float32 ulps.
+
+    Returns
+    -------
+    bases : list of chroma.geometry.Mesh
+        The distinct meshes.
+    base_index : np.ndarray
+        The index into `bases` of every mesh.
+    rotations, translations : np.ndarray
+        The (N, 3, 3) rotation and (N, 3) translation taking its base to every mesh.
+    """
+    bases, base_index, rotations, translations = [], [], [], []
+    # vertices are not binned into the key: float32 rounding noise at detector
+    # coordinates straddles any bin fine enough to tell meshes apart
+    candidates = {}
+    for mesh in meshes:
+        vertices = np.asarray(mesh.vertices, dtype=float)
+        key = (len(vertices), np.asarray(mesh.triangles).tobytes())
+        for i in candidates.get(key, []):
+            base = np.asarray(bases[i].vertices, dtype=float)
+            tol = max(atol, _float32_tolerance(vertices), _float32_tolerance(base))
+            R, t = _rigid_transform(base, vertices, tol)
+            if R is not None:
+                base_index.append(i)
+                rotations.append(R)
+                translations.append(t)
+                break
+        else:
+            candidates.setdefault(key, []).append(len(bases))
+            base_index.append(len(bases))
+            rotations.append(np.eye(3))
+            translations.append(np.zeros(3))
+            bases.append(mesh)
+    return (
+        bases,
+        np.array(base_index, dtype=np.intp),
+        np.array(rotations).reshape(-1, 3, 3),
+        np.array(translations).reshape(-1, 3),
+    )
+
+
+def _float32_tolerance(vertices: np.ndarray) -> float:
+    # a few ulps of the largest coordinate the vertices were stored at
+    return 8 * np.finfo(np.float32).eps * np.abs(vertices).max(initial=0)
+
+
+def _rigid_transform(base: np.ndarray, vertices: np.ndarray, tol: float):
+    """The rotation R and translation t with `vertices = base @ R.T + t` to
+    `tol`, or (None, None) if there is none. Vertices correspond by index."""
+    t = vertices[0] - base[0]
+    if np.allclose(base + t, vertices, rtol=0, atol=tol):
+        return np.eye(3), t
+
+    # Kabsch: the rotation best aligning the centered vertices, without reflections
+    base_center, center = base.mean(axis=0), vertices.mean(axis=0)
+    U, _, Vt = np.linalg.svd((base - base_center).T @ (vertices - center))
+    d = np.sign(np.linalg.det(Vt.T @ U.T)) or 1.0
+    R = Vt.T @ np.diag([1.0, 1.0, d]) @ U.T
+    t = center - R @ base_center
+    if np.allclose(base @ R.T + t, vertices, rtol=0, atol=tol):
+        return R, t
+    return None, None
@@ -0,0 +1,75 @@
+import os
+import pickle
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+
+from utils.files import atomic_write
+from utils.log import logger
+
+__all__ = ["DATA_DIR", "Spectrum", "load_spectrum", "save_spectrum"]
+
+# spectra are resolved relative to the repository's data directory
+DATA_DIR = Path(__file__).resolve().parent.parent / "data"
+
+
+@dataclass(frozen=True)
+class Spectrum:
+    """An emission spectrum (wavelengths in nm) with its cumulative distribution.
+
+    Spectra are stored as memory-mapped `.npy` files, so processes loading the
+    same spectrum share its pages. Negative intensities count as zero in `cdf`.
+    """
+
+    name: str
+    wavelength: np.ndarray
+    intensity: np.ndarray
+    cdf: np.ndarray
+
+
+def _cdf(wavelength: np.ndarray, intensity: np.ndarray) -> np.ndarray:
+    cdf = np.cumsum(np.clip(intensity, 0, None))
+    return cdf / cdf[-1]
+
+
+def save_spectrum(path, wavelength: np.ndarray, intensity: np.ndarray):
+    """Writes a spectrum file with its precomputed cumulative distribution."""
+    wavelength = np.asarray(wavelength, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    if wavelength.shape != intensity.shape or wavelength.ndim != 1:
+        raise ValueError("wavelength and intensity must be 1-D arrays of the same length")
+    table = np.stack((wavelength, intensity, _cdf(wavelength, intensity)))
+    with atomic_write(path, "wb") as f:
+        np.save(f, table)
+
+
+@lru_cache(maxsize=None)
+def load_spectrum(name: str) -> Spectrum:
+    """Loads a spectrum by name, once per process.
+
+    `name` is a file name in `DATA_DIR` without extension, or a path. The
+    `.npy` file is memory-mapped. If only a legacy pickle (`<name>.p`, a
+    `[wavelength, intensity]` pair) exists, it is converted to `.npy` on
+    first use.
+    """
+    base = Path(name) if os.sep in name else DATA_DIR / name
+    path = base.with_suffix(".npy")
+    if not path.exists():
+        legacy = base.with_suffix(".p")
+        if not legacy.exists():
+            raise FileNotFoundError(f"no spectrum {name!r}, looked for {path} and {legacy}")
+        with open(legacy, "rb") as f:
+            wavelength, intensity = pickle.load(f)
+        try:
+            save_spectrum(path, wavelength, intensity)
+            logger.info(f"Converted spectrum {legacy} to {path}.")
+        except OSError as e:
+            logger.warning(f"Could not write {path} ({e}), keeping spectrum {name!r} in memory.")
+            wavelength = np.asarray(wavelength, dtype=np.float64)
+            intensity = np.asarray(intensity, dtype=np.float64)
+            return Spectrum(name, wavelength, intensity, _cdf(wavelength, intensity))
+
+    table = np.load(path, mmap_mode="r")
+    return Spectrum(name, table[0], table[1], table[2])
@@ -0,0 +1,73 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Sequence, Tuple
+
+import numpy as np
+from chroma.geometry import Mesh
+from chroma.loader import mesh_from_stl
+
+from geometry.cache import MeshCache, file_hash
+
+__all__ = ["read_stl", "load_meshes"]
+
+log = logging.getLogger(__name__)
+
+
+def read_stl(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """Parses an STL file into its (vertices, triangles) arrays.
+
+    The arrays, rather than a chroma `Mesh`, are returned so that they are
+    cheap to send back from a worker process.
+    """
+    mesh = mesh_from_stl(path)
+    return mesh.vertices, mesh.triangles
+
+
+def load_meshes(paths: Sequence[str], workers: int = None, cache: MeshCache = None) -> List[Mesh]:
+    """Parses STL files into chroma meshes, in parallel.
+
+    Parsing thousands of STLs is CPU bound, so the files are spread over a
+    pool of `workers` processes. The meshes are returned in the order of
+    `paths` for any number of workers. With a `cache`, only files whose
+    contents are not cached yet are parsed.
+
+    Parameters
+    ----------
+    paths : sequence of str
+        The STL files.
+    workers : int, optional
+        The number of processes. Defaults to the number of cores; with 1 the
+        files are parsed in this process.
+    cache : MeshCache, optional
+        The cache to read meshes from and store newly parsed meshes in.
+
+    Returns
+    -------
+    list of chroma.geometry.Mesh
+        One mesh per file.
+    """
+    arrays = [None] * len(paths)
+    if cache is not None:
+        keys = [file_hash(p) for p in paths]
+        arrays = [cache.load(key) for key in keys]
+        log.info(f"{sum(a is not None for a in arrays)} of {len(paths)} meshes cached")
+    missing = [i for i, a in enumerate(arrays) if a is None]
+
+    for i, a in zip(missing, _parse([paths[i] for i in missing], workers)):
+        arrays[i] = a
+        if cache is not None:
+            cache.save(keys[i], *a)
+    return [Mesh(vertices, triangles) for vertices, triangles in arrays]
+
+
+def _parse(paths: Sequence[str], workers: int = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+    workers = (os.cpu_count() or 1) if workers is None else int(workers)
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        return [read_stl(p) for p in paths]
+    log.info(f"Parsing {len(paths)} STL files with {workers} processes")
+    # large chunks keep the per-file overhead of the pool small
+    chunksize = max(1, len(paths) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(read_stl, paths, chunksize=chunksize))
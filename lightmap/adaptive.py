@@ -0,0 +1,70 @@
+from typing import Literal
+
+import numpy as np
+
+__all__ = ["relative_binomial_error", "AdaptiveBudget"]
+
+
+def relative_binomial_error(detected, n) -> np.ndarray:
+    """Relative binomial uncertainty of an efficiency `detected / n`.
+
+    For p = detected / n the standard error is sqrt(p (1 - p) / n), so the
+    relative error is sqrt((1 - p) / detected). Zero counts give an infinite
+    relative error.
+    """
+    detected = np.asarray(detected, dtype=float)
+    p = detected / n
+    with np.errstate(divide="ignore", invalid="ignore"):
+        err = np.sqrt((1 - p) / detected)
+    return np.where(detected > 0, err, np.inf)
+
+
+class AdaptiveBudget:
+    """Accumulates the counts of one lightmap position over several photon bombs
+    until the relative binomial error of its total (or brightest channel) PTE is
+    below `target`, or `max_photons` have been simulated.
+    """
+
+    def __init__(
+        self,
+        n_channels: int,
+        target: float,
+        max_photons: int,
+        min_photons: int = 0,
+        metric: Literal["total", "max_channel"] = "total",
+    ):
+        if metric not in ("total", "max_channel"):
+            raise ValueError(f"unknown adaptive metric {metric!r}")
+        self.n_channels = n_channels
+        self.target = target
+        self.max_photons = max_photons
+        self.min_photons = min_photons
+        self.metric = metric
+        self.reset()
+
+    def reset(self):
+        """Starts a new position."""
+        self.counts = np.zeros(self.n_channels, dtype=np.int64)
+        self.n = 0
+
+    def add(self, channel_counts: np.ndarray, n: int):
+        """Adds the per-channel counts of `n` more simulated photons."""
+        self.counts += channel_counts
+        self.n += n
+
+    @property
+    def error(self) -> float:
+        """The current relative error of the monitored PTE."""
+        if self.n == 0:
+            return np.inf
+        if self.metric == "total":
+            detected = self.counts.sum()
+        else:
+            detected = self.counts.max()
+        return float(relative_binomial_error(detected, self.n))
+
+    @property
+    def done(self) -> bool:
+        if self.n >= self.max_photons:
+            return True
+        return self.n >= self.min_photons and self.error <= self.target
@@ -0,0 +1,341 @@
+from functools import partial
+from typing import Dict, Iterator, List, Tuple
+
+import h5py
+import numpy as np
+
+from utils.log import logger
+from utils.output import print_table
+
+__all__ = ["LogQuantizer", "lightmap_errors", "compress_lightmap", "compression_report"]
+
+# default memory used by one block of the table in bytes
+BLOCK_BYTES = 2**28
+# PTE below this value is not resolved by the relative error metric
+ERROR_FLOOR = 1e-6
+
+
+class LogQuantizer:
+    """Stores positive values as 16-bit codes uniformly spaced in log(value).
+
+    Code 0 is reserved for zero; codes 1..65535 cover [exp(lo), exp(hi)], so the
+    relative error of every non-zero value is at most (hi - lo) / 2 / 65534.
+    """
+
+    LEVELS = 2**16 - 2
+
+    def __init__(self, lo: float, hi: float):
+        self.lo = lo
+        self.hi = max(hi, lo + 1e-12)
+        self.step = (self.hi - self.lo) / self.LEVELS
+
+    @property
+    def max_relative_error(self) -> float:
+        return float(np.expm1(self.step / 2))
+
+    def encode(self, values: np.ndarray) -> np.ndarray:
+        values = np.asarray(values, dtype=np.float64)
+        codes = np.zeros(values.shape, dtype=np.uint16)
+        positive = values > 0
+        log = np.clip(np.log(values[positive]), self.lo, self.hi)
+        codes[positive] = 1 + np.round((log - self.lo) / self.step).astype(np.uint16)
+        return codes
+
+    def decode(self, codes: np.ndarray) -> np.ndarray:
+        codes = np.asarray(codes)
+        values = np.exp(self.lo + (codes.astype(np.float32) - 1) * np.float32(self.step)).astype(np.float32)
+        values[codes == 0] = 0
+        return values
+
+    @property
+    def attrs(self) -> dict:
+        return dict(log_lo=self.lo, log_hi=self.hi)
+
+    @classmethod
+    def from_attrs(cls, attrs) -> "LogQuantizer":
+        return cls(float(attrs["log_lo"]), float(attrs["log_hi"]))
+
+
+def _block_rows(n_channels: int, block_bytes: int) -> int:
+    return max(1, block_bytes // (8 * n_channels))
+
+
+def _blocks(vis: h5py.Dataset, block_rows: int) -> Iterator[Tuple[int, np.ndarray]]:
+    for start in range(0, vis.shape[0], block_rows):
+        yield start, vis[start : start + block_rows].astype(np.float64)
+
+
+def channel_basis(vis: h5py.Dataset, k: int, center: bool = True, block_bytes: int = BLOCK_BYTES):
+    """The leading right singular vectors of the (optionally centered) table.
+
+    The (n_channels, n_channels) Gram matrix is accumulated block by block, so
+    the table is read once and never held in memory.
+
+    Returns
+    -------
+    mean : np.ndarray
+        (n_channels,) channel means, zero unless `center`.
+    basis : np.ndarray
+        (n_channels, k) orthonormal channel basis.
+    singular_values : np.ndarray
+        All (n_channels,) singular values in decreasing order.
+    """
+    n_voxels, n_channels = vis.shape
+    gram = np.zeros((n_channels, n_channels))
+    total = np.zeros(n_channels)
+    for _, block in _blocks(vis, _block_rows(n_channels, block_bytes)):
+        gram += block.T @ block
+        total += block.sum(axis=0)
+    mean = total / n_voxels if center else np.zeros(n_channels)
+    gram -= n_voxels * np.outer(mean, mean)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    order = np.argsort(eigenvalues)[::-1]
+    singular_values = np.sqrt(np.clip(eigenvalues[order], 0, None))
+    return mean, eigenvectors[:, order[:k]], singular_values
+
+
+def _quantize(values: np.ndarray, dtype) -> np.ndarray:
+    return values.astype(dtype).astype(np.float64)
+
+
+def _log_roundtrip(quantizer: LogQuantizer, values: np.ndarray) -> np.ndarray:
+    return quantizer.decode(quantizer.encode(values))
+
+
+def lightmap_errors(
+    vis: h5py.Dataset,
+    decoders: Dict[str, callable],
+    floor: float = ERROR_FLOOR,
+    block_bytes: int = BLOCK_BYTES,
+) -> Dict[str, dict]:
+    """Reconstruction errors of several compressed representations of a table,
+    evaluated in a single pass.
+
+    Parameters
+    ----------
+    vis : h5py.Dataset
+        The (n_voxels, n_channels) PTE table.
+    decoders : dict
+        Maps a label to a function returning the reconstruction of a block of
+        rows given the rows.
+    floor : float
+        The smallest PTE the relative error is normalized to.
+
+    Returns
+    -------
+    dict
+        Maps each label to the `max_relative_error`, i.e. the largest error of a
+        voxel relative to the PTE of its brightest channel, and the
+        `rms_error` over all entries.
+    """
+    max_error = {label: 0.0 for label in decoders}
+    sum_sq = {label: 0.0 for label in decoders}
+    for _, block in _blocks(vis, _block_rows(vis.shape[1], block_bytes)):
+        norm = np.maximum(block.max(axis=1), floor)
+        for label, decode in decoders.items():
+            diff = decode(block) - block
+            max_error[label] = max(max_error[label], float((np.abs(diff).max(axis=1) / norm).max()))
+            sum_sq[label] += float((diff**2).sum())
+    n = vis.shape[0] * vis.shape[1]
+    return {
+        label: dict(max_relative_error=max_error[label], rms_error=float(np.sqrt(sum_sq[label] / n)))
+        for label in decoders
+    }
+
+
+def _lowrank_decoder(mean: np.ndarray, basis: np.ndarray, k: int, dtype):
+    return partial(_lowrank_roundtrip, mean=mean, basis=basis[:, :k], W=_quantize(basis[:, :k], dtype), dtype=dtype)
+
+
+def _lowrank_roundtrip(block: np.ndarray, mean: np.ndarray, basis: np.ndarray, W: np.ndarray, dtype) -> np.ndarray:
+    U = _quantize((block - mean) @ basis, dtype)
+    return np.clip(U @ W.T + mean, 0, None)
+
+
+def _choose_rank(vis, mean, basis, max_error, dtype, floor, block_bytes) -> int:
+    """The smallest rank whose reconstruction meets `max_error`, by bisection."""
+    lo, hi = 1, basis.shape[1]
+    errors = lightmap_errors(vis, {hi: _lowrank_decoder(mean, basis, hi, dtype)}, floor, block_bytes)
+    if errors[hi]["max_relative_error"] > max_error:
+        logger.warning(f"rank {hi} does not reach a max. relative error of {max_error}, using it anyway")
+        return hi
+    while lo < hi:
+        k = (lo + hi) // 2
+        errors = lightmap_errors(vis, {k: _lowrank_decoder(mean, basis, k, dtype)}, floor, block_bytes)
+        logger.info(f"rank {k}: max. relative error {errors[k]['max_relative_error']:.3g}")
+        if errors[k]["max_relative_error"] <= max_error:
+            hi = k
+        else:
+            lo = k + 1
+    return lo
+
+
+def compress_lightmap(
+    plib_path: str,
+    output_path: str,
+    method: str = "svd",
+    k: int = None,
+    max_error: float = None,
+    max_rank: int = 256,
+    dtype: str = "float32",
+    center: bool = True,
+    floor: float = ERROR_FLOOR,
+    block_bytes: int = BLOCK_BYTES,
+) -> dict:
+    """Writes a compressed copy of a PhotonLib file.
+
+    Three methods are available:
+
+    - ``svd``: a truncated SVD of the (voxels, channels) table, stored as
+      ``voxel_factors`` (n_voxels, k), ``channel_factors`` (n_channels, k) and the
+      channel ``mean``, in float32 or float16. The rank is either `k` or, with
+      `max_error`, the smallest rank up to `max_rank` whose max. relative error
+      is below `max_error`.
+    - ``log``: the full table as 16-bit codes uniform in log(PTE).
+    - ``float16``: the full table in half precision.
+
+    The output keeps `numvox`, `min` and `max`, so `lightmap.query.LightmapQuery`
+    evaluates it directly. Returns the compression ratio and errors.
+    """
+    with h5py.File(plib_path, "r") as f, h5py.File(output_path, "w") as out:
+        vis = f["vis"]
+        n_voxels, n_channels = vis.shape
+        for key in ("numvox", "min", "max"):
+            out.create_dataset(key, data=f[key][()])
+        block_rows = _block_rows(n_channels, block_bytes)
+
+        if method == "svd":
+            if k is None and max_error is None:
+                raise ValueError("the svd method needs a rank or a max. error")
+            rank = min(k or max_rank, n_channels)
+            mean, basis, _ = channel_basis(vis, rank, center=center, block_bytes=block_bytes)
+            if k is None:
+                rank = _choose_rank(vis, mean, basis, max_error, dtype, floor, block_bytes)
+                basis = basis[:, :rank]
+            logger.info(f"storing rank {rank} factors in {dtype}")
+
+            out.attrs["format"] = "lowrank"
+            out.create_dataset("mean", data=mean.astype(np.float32))
+            out.create_dataset("channel_factors", data=basis.astype(dtype))
+            U = out.create_dataset("voxel_factors", (n_voxels, rank), dtype=dtype)
+            for start, block in _blocks(vis, block_rows):
+                U[start : start + len(block)] = (block - mean) @ basis
+            decoder = _lowrank_decoder(mean, basis, rank, dtype)
+            stored = out["voxel_factors"].nbytes + out["channel_factors"].nbytes + out["mean"].nbytes
+
+        elif method == "log":
+            lo, hi = np.inf, -np.inf
+            for _, block in _blocks(vis, block_rows):
+                positive = block[block > 0]
+                if len(positive):
+                    lo, hi = min(lo, np.log(positive.min())), max(hi, np.log(positive.max()))
+            quantizer = LogQuantizer(lo if np.isfinite(lo) else 0.0, hi if np.isfinite(hi) else 0.0)
+            out.attrs["format"] = "log"
+            out.attrs.update(quantizer.attrs)
+            codes = out.create_dataset("vis_log", vis.shape, dtype=np.uint16, chunks=vis.chunks)
+            for start, block in _blocks(vis, block_rows):
+                codes[start : start + len(block)] = quantizer.encode(block)
+            decoder = partial(_log_roundtrip, quantizer)
+            stored = codes.nbytes
+
+        elif method == "float16":
+            # a plain `vis` table stays readable by PhotonLib, the attribute
+            # tells LightmapQuery to evaluate it in float32
+            out.attrs["format"] = "float16"
+            half = out.create_dataset("vis", vis.shape, dtype=np.float16, chunks=vis.chunks)
+            for start, block in _blocks(vis, block_rows):
+                half[start : start + len(block)] = block
+            decoder = partial(_quantize, dtype=np.float16)
+            stored = half.nbytes
+
+        else:
+            raise ValueError(f"unknown compression method {method!r}")
+
+        errors = lightmap_errors(vis, {method: decoder}, floor, block_bytes)[method]
+        return dict(compression_ratio=vis.nbytes / stored, **errors)
+
+
+def compression_report(
+    plib_path: str,
+    ranks: List[int] = (1, 2, 4, 8, 16, 32, 64, 128),
+    floor: float = ERROR_FLOOR,
+    block_bytes: int = BLOCK_BYTES,
+) -> List[dict]:
+    """Compression ratio against reconstruction error of every method, and of the
+    svd method at several ranks, without writing any files."""
+    with h5py.File(plib_path, "r") as f:
+        vis = f["vis"]
+        n_voxels, n_channels = vis.shape
+        ranks = [k for k in ranks if k <= n_channels]
+        mean, basis, singular_values = channel_basis(vis, max(ranks), block_bytes=block_bytes)
+
+        configs = {}
+        for k in ranks:
+            for dtype in ("float32", "float16"):
+                stored = (n_voxels + n_channels) * k * np.dtype(dtype).itemsize + 4 * n_channels
+                configs[("svd", k, dtype)] = (stored, _lowrank_decoder(mean, basis, k, dtype))
+
+        lo, hi = np.inf, -np.inf
+        for _, block in _blocks(vis, _block_rows(n_channels, block_bytes)):
+            positive = block[block > 0]
+            if len(positive):
+                lo, hi = min(lo, np.log(positive.min())), max(hi, np.log(positive.max()))
+        quantizer = LogQuantizer(lo if np.isfinite(lo) else 0.0, hi if np.isfinite(hi) else 0.0)
+        configs[("log", None, "uint16")] = (2 * vis.size, partial(_log_roundtrip, quantizer))
+        configs[("float16", None, "float16")] = (2 * vis.size, partial(_quantize, dtype=np.float16))
+
+        errors = lightmap_errors(vis, {key: decode for key, (_, decode) in configs.items()}, floor, block_bytes)
+        total_variance = float((singular_values**2).sum())
+        report = []
+        for (method, k, dtype), (stored, _) in configs.items():
+            row = dict(method=method, rank=k, dtype=dtype, compression_ratio=vis.nbytes / stored)
+            if k is not None:
+                row["explained_variance"] = float((singular_values[:k] ** 2).sum() / max(total_variance, 1e-300))
+            row.update(errors[(method, k, dtype)])
+            report.append(row)
+        return report
+
+
+def main():
+    import argparse
+
+    from rich.console import Console
+    from rich.table import Table
+
+    parser = argparse.ArgumentParser(description="Compress a PhotonLib lightmap")
+    parser.add_argument("plib", type=str, help="Path to the PhotonLib file")
+    parser.add_argument("output", type=str, nargs="?", default=None, help="Path to the compressed file")
+    parser.add_argument("--method", type=str, default="svd", choices=["svd", "log", "float16"])
+    parser.add_argument("-k", type=int, default=None, help="Rank of the svd")
+    parser.add_argument("--max-error", type=float, default=None, help="Choose the smallest rank with this max. relative error")
+    parser.add_argument("--max-rank", type=int, default=256, help="Largest rank considered with --max-error")
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "float16"], help="Storage type of the svd factors")
+    parser.add_argument("--report", action="store_true", help="Print compression ratio against error of all methods")
+
+    args = parser.parse_args()
+
+    console = Console()
+    if args.report:
+        report = compression_report(args.plib)
+        table = Table(title="Lightmap Compression Report")
+        for key in report[0]:
+            table.add_column(key, style="bold red")
+        for row in report:
+            table.add_row(*(str(row.get(key, "")) for key in report[0]))
+        console.print(table)
+    if args.output is not None:
+        results = compress_lightmap(
+            args.plib,
+            args.output,
+            method=args.method,
+            k=args.k,
+            max_error=args.max_error,
+            max_rank=args.max_rank,
+            dtype=args.dtype,
+        )
+        print_table(**results)
+
+
+if __name__ == "__main__":
+    main()
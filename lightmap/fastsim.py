@@ -0,0 +1,213 @@
+from typing import Literal
+
+import numpy as np
+
+from generator.profile import ELProfile
+from generator.sites import event_bounds, make_sites
+from lightmap.io import LightmapFile
+from lightmap.query import LightmapQuery
+from utils.log import logger
+
+__all__ = ["FastS2Sim", "validate_fast_sim"]
+
+
+class FastS2Sim:
+    """Samples per-channel S2 photon counts from a lightmap instead of propagating photons.
+
+    A photon's detection probability in a channel is the PTE averaged over the
+    EL column, evaluated at `n_z` quantiles of the yield `profile`. The counts
+    are then multinomial in these probabilities, or Poisson for a fluctuating yield.
+    """
+
+    def __init__(
+        self,
+        lightmap,
+        height: float,
+        n_z: int = 16,
+        statistics: Literal["multinomial", "poisson"] = "multinomial",
+        seed: int = None,
+        profile: ELProfile = None,
+    ):
+        if statistics not in ("multinomial", "poisson"):
+            raise ValueError(f"unknown statistics {statistics!r}")
+        self.lightmap = LightmapQuery(lightmap) if isinstance(lightmap, str) else lightmap
+        self.height = height
+        self.n_z = n_z
+        self.profile = ELProfile.uniform(height) if profile is None else profile
+        self.statistics = statistics
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def n_channels(self) -> int:
+        return self.lightmap.n_channels
+
+    def column_pte(self, sites: np.ndarray) -> np.ndarray:
+        """Per-channel detection probability of a photon emitted in the EL
+        column above each site.
+
+        Parameters
+        ----------
+        sites : np.ndarray
+            (..., 3) positions on the liquid surface where the columns start.
+
+        Returns
+        -------
+        np.ndarray
+            (..., n_channels) PTE averaged over the profile.
+        """
+        sites = np.asarray(sites, dtype=float)
+        flat = sites.reshape(-1, 3)
+        pte = np.zeros((len(flat), self.n_channels), dtype=np.float64)
+        # one lightmap query per slice keeps the memory at one (n_sites, n_channels) table
+        for z, weight in zip(*self.profile.quadrature(self.n_z)):
+            pte += weight * self.lightmap(flat + [0, 0, z])
+        return pte.reshape(*sites.shape[:-1], self.n_channels)
+
+    def expected(self, sites: np.ndarray, n_photons) -> np.ndarray:
+        """Mean per-channel counts of events, shape (n_events, n_channels).
+
+        Parameters
+        ----------
+        sites : np.ndarray
+            (n_events, n_sites, 3) EL column positions.
+        n_photons : int or np.ndarray
+            The number of photons per site, broadcastable to (n_events, n_sites).
+        """
+        sites = np.asarray(sites, dtype=float)
+        n_photons = np.broadcast_to(n_photons, sites.shape[:2])
+        return np.einsum("es,esc->ec", n_photons, self.column_pte(sites))
+
+    def sample(self, sites: np.ndarray, n_photons) -> np.ndarray:
+        """Samples per-channel counts of events, shape (n_events, n_channels).
+
+        `sites` and `n_photons` are as in `expected`.
+        """
+        sites = np.asarray(sites, dtype=float)
+        n_photons = np.broadcast_to(n_photons, sites.shape[:2])
+        pte = self.column_pte(sites)
+        if self.statistics == "poisson":
+            return self.rng.poisson(np.einsum("es,esc->ec", n_photons, pte))
+
+        counts = np.zeros((len(sites), self.n_channels), dtype=np.int64)
+        for s in range(sites.shape[1]):
+            counts += self._multinomial(n_photons[:, s], pte[:, s])
+        return counts
+
+    def _multinomial(self, n_photons: np.ndarray, pte: np.ndarray) -> np.ndarray:
+        """Detected counts of `n_photons` photons per row with the per-channel
+        probabilities `pte`."""
+        p = np.clip(pte, 0, 1)
+        # the last category collects the undetected photons
+        pvals = np.column_stack((p, np.clip(1 - p.sum(axis=1), 0, 1)))
+        pvals /= pvals.sum(axis=1, keepdims=True)
+        return self.rng.multinomial(np.asarray(n_photons, dtype=np.int64), pvals)[:, :-1]
+
+    def expected_sites(self, sites: np.ndarray) -> np.ndarray:
+        """Mean per-channel counts of the events of a site table (see
+        `generator.sites`), shape (n_events, n_channels) in table order."""
+        starts = event_bounds(sites)[:-1]
+        return np.add.reduceat(sites["n"][:, None] * self.column_pte(sites["pos"]), starts, axis=0)
+
+    def sample_sites(self, sites: np.ndarray) -> np.ndarray:
+        """Samples per-channel counts of the events of a site table, with any
+        number of sites and photons per event, shape (n_events, n_channels)."""
+        if self.statistics == "poisson":
+            return self.rng.poisson(self.expected_sites(sites))
+        counts = self._multinomial(sites["n"], self.column_pte(sites["pos"]))
+        return np.add.reduceat(counts, event_bounds(sites)[:-1], axis=0)
+
+
+def split_photons(n: int, n_sites: int) -> np.ndarray:
+    """Splits `n` photons evenly over the sites, the remainder going to the last
+    site, like `generator.photons.create_multisite_electroluminescence_photons`."""
+    per_site = np.full(n_sites, n // n_sites)
+    per_site[-1] += n - per_site.sum()
+    return per_site
+
+
+def validate_fast_sim(sim: FastS2Sim, chroma_file: str, replicas: int = 20) -> dict:
+    """Compares the fast simulation to a full chroma simulation written by
+    `macros/s2_sim.py`, at the same sites: those of its `sites` table, if it
+    has one, or its site positions with the photons split evenly.
+
+    Returns summary statistics: the mean and width of the pulls of the total
+    detected counts per event, the chi2 per channel of the counts summed over
+    all events, the ratio of the total counts and a KS test of the distribution
+    of the total counts per event against `replicas` fast simulations.
+    """
+    from scipy.stats import ks_2samp
+
+    with LightmapFile(chroma_file) as f:
+        observed = f.detected().astype(np.float64)
+        if "sites" in f:
+            sites = f["sites"][()]
+        else:
+            positions = [f.positions]
+            if "posX_2" in f:
+                positions.append(np.column_stack([f[k][()] for k in ("posX_2", "posY_2", "posZ_2")]))
+            positions = np.stack(positions, axis=1)
+            n = f.n.astype(np.int64)
+            n_photons = np.stack([split_photons(int(n_event), positions.shape[1]) for n_event in n])
+            sites = make_sites(positions, n_photons)
+    starts = event_bounds(sites)[:-1]
+    logger.info(f"comparing {len(starts)} chroma events with {len(sites)} sites")
+    if observed.shape[1] != sim.n_channels:
+        raise ValueError(f"{chroma_file} has {observed.shape[1]} channels, the lightmap {sim.n_channels}")
+
+    pte = sim.column_pte(sites["pos"])
+    expected = np.add.reduceat(sites["n"][:, None] * pte, starts, axis=0)
+    # variance of the total of a multinomial (or Poisson) count per event
+    p_total = np.clip(pte.sum(axis=1), 0, 1)
+    if sim.statistics == "poisson":
+        var_total = expected.sum(axis=1)
+    else:
+        var_total = np.add.reduceat(sites["n"] * p_total * (1 - p_total), starts)
+    pulls = (observed.sum(axis=1) - expected.sum(axis=1)) / np.sqrt(np.maximum(var_total, 1e-12))
+
+    channel_observed = observed.sum(axis=0)
+    channel_expected = expected.sum(axis=0)
+    lit = channel_expected > 0
+    chi2 = ((channel_observed - channel_expected)[lit] ** 2 / channel_expected[lit]).sum()
+
+    fast_totals = np.concatenate([sim.sample_sites(sites).sum(axis=1) for _ in range(replicas)])
+    ks = ks_2samp(observed.sum(axis=1), fast_totals)
+
+    return dict(
+        n_events=len(starts),
+        total_ratio=float(observed.sum() / max(expected.sum(), 1e-12)),
+        pull_mean=float(pulls.mean()),
+        pull_std=float(pulls.std()),
+        channel_chi2_per_ndf=float(chi2 / max(lit.sum(), 1)),
+        ks_statistic=float(ks.statistic),
+        ks_pvalue=float(ks.pvalue),
+    )
+
+
+def main():
+    import argparse
+
+    from utils.output import print_table
+
+    parser = argparse.ArgumentParser(description="Validate the lightmap-driven fast S2 simulation against chroma")
+    parser.add_argument("lightmap", type=str, help="Path to the PhotonLib (or compressed) lightmap")
+    parser.add_argument("chroma", type=str, help="Path to an s2_sim output file simulated with chroma")
+    parser.add_argument("--height", type=float, default=6.5, help="Height of the EL column in mm")
+    parser.add_argument("--n-z", type=int, default=16, help="Number of points along the EL column")
+    parser.add_argument("--profile", type=str, default="uniform", choices=["uniform", "linear", "table"], help="Longitudinal EL yield profile")
+    parser.add_argument("--gradient", type=float, default=0.0, help="Relative yield increase from bottom to top of a linear profile")
+    parser.add_argument("--profile-table", type=str, default=None, help=".npy file with the (n, 2) heights and yields of a tabulated profile")
+    parser.add_argument("--statistics", type=str, default="multinomial", choices=["multinomial", "poisson"])
+    parser.add_argument("--replicas", type=int, default=20, help="Fast simulations per chroma event for the KS test")
+    parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+
+    profile = ELProfile.from_config(args.height, args.profile, args.gradient, args.profile_table)
+    sim = FastS2Sim(
+        args.lightmap, args.height, n_z=args.n_z, statistics=args.statistics, seed=args.seed, profile=profile
+    )
+    print_table(**validate_fast_sim(sim, args.chroma, replicas=args.replicas))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import re
+from typing import Union
+
+import h5py
+import numpy as np
+
+__all__ = ["LightmapFile"]
+
+_CHANNEL_KEY = re.compile(r"ch(\d+)_detected")
+
+
+class LightmapFile:
+    """Read-only view of a lightmap file in either the ``columns`` layout (two
+    datasets per channel) or the ``matrix`` layout (one ``detected`` dataset,
+    PTE derived as ``detected / n``).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.f = h5py.File(path, "r")
+        if "numvox" in self.f:
+            self.f.close()
+            raise ValueError("This file is already in PhotonLib format.")
+
+        self.layout = self.f.attrs.get("layout", "columns")
+        if self.layout == "matrix":
+            self.n_channels = self.f["detected"].shape[1]
+        else:
+            matches = [m for m in map(_CHANNEL_KEY.fullmatch, self.f.keys()) if m]
+            matches.sort(key=lambda m: int(m.group(1)))
+            self._channel_keys = [f"ch{m.group(1)}" for m in matches]
+            self.n_channels = len(matches)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.f["posX"].shape[0]
+
+    def close(self):
+        self.f.close()
+
+    def __getitem__(self, key):
+        return self.f[key]
+
+    def __contains__(self, key):
+        return key in self.f
+
+    @property
+    def attrs(self):
+        """File-level attributes, e.g. the metadata of a coarse-to-fine scan."""
+        return self.f.attrs
+
+    @property
+    def positions(self) -> np.ndarray:
+        """Photon source positions, shape (n_events, 3)."""
+        return np.column_stack([self.f[k][()] for k in ("posX", "posY", "posZ")])
+
+    @property
+    def n(self) -> np.ndarray:
+        """Number of photons simulated per event, shape (n_events,)."""
+        return self.f["n"][()]
+
+    def _channel_indices(self, channels) -> np.ndarray:
+        return np.arange(self.n_channels)[channels]
+
+    def detected(self, rows: Union[slice, np.ndarray] = slice(None), channels=slice(None)) -> np.ndarray:
+        """Per-channel detected counts, shape (n_rows, n_selected_channels).
+
+        `rows` and `channels` may be slices or increasing index arrays.
+        """
+        if self.layout == "matrix":
+            if isinstance(channels, slice) or isinstance(rows, slice):
+                # h5py supports an index array along one axis only
+                return self.f["detected"][rows, channels]
+            return self.f["detected"][rows][:, channels]
+        keys = [self._channel_keys[c] + "_detected" for c in self._channel_indices(channels)]
+        return self._stack_columns(keys, rows)
+
+    def pte(self, rows: Union[slice, np.ndarray] = slice(None), channels=slice(None)) -> np.ndarray:
+        """Per-channel photon transport efficiency, shape (n_rows, n_selected_channels).
+
+        Files without per-channel data (`single_channel` runs) return the total
+        PTE as a single channel.
+        """
+        if self.layout == "matrix":
+            n = self.f["n"][rows].astype(np.float32)
+            return np.divide(self.detected(rows, channels), n[:, None], dtype=np.float32)
+        if self.n_channels == 0:
+            return self.f["pte"][rows][:, None]
+        keys = [self._channel_keys[c] + "_pte" for c in self._channel_indices(channels)]
+        return self._stack_columns(keys, rows)
+
+    def total_detected(self, rows: Union[slice, np.ndarray] = slice(None)) -> np.ndarray:
+        """Total number of detected photons per event, shape (n_rows,)."""
+        if self.layout == "matrix":
+            return self.f["detected"][rows].sum(axis=1)
+        return self.f["detected"][rows]
+
+    def _stack_columns(self, keys, rows) -> np.ndarray:
+        n_rows = len(np.arange(len(self))[rows])
+        out = np.empty((n_rows, len(keys)), dtype=np.float32)
+        for i, k in enumerate(keys):
+            out[:, i] = self.f[k][rows]
+        return out
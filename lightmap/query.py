@@ -0,0 +1,222 @@
+import time
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+from lightmap.compress import LogQuantizer
+
+__all__ = ["LightmapQuery"]
+
+# corner offsets of a voxel cell, x fastest
+CORNERS = np.array([[i, j, k] for k in (0, 1) for j in (0, 1) for i in (0, 1)], dtype=np.int64)
+
+
+class _MemmapTable:
+    """The `vis` table of a contiguous, uncompressed PhotonLib file mapped into
+    memory. Rows are paged in by the OS on access."""
+
+    def __init__(self, path: str, offset: int, shape, dtype):
+        self.shape = shape
+        self.vis = np.memmap(path, mode="r", dtype=dtype, shape=shape, offset=offset)
+
+    def rows(self, voxels: np.ndarray, channels) -> np.ndarray:
+        # float16 tables are interpolated in float32
+        return self.vis[voxels][:, channels].astype(np.float32, copy=False)
+
+
+class _LowRankTable:
+    """A table stored as `voxel_factors @ channel_factors.T + mean` (see
+    `lightmap.compress`). Only the rows and channels queried are reconstructed."""
+
+    def __init__(self, f: h5py.File):
+        self.voxel_factors = f["voxel_factors"][()]
+        self.channel_factors = f["channel_factors"][()].astype(np.float32)
+        self.mean = f["mean"][()].astype(np.float32)
+        self.shape = (len(self.voxel_factors), len(self.channel_factors))
+
+    def rows(self, voxels: np.ndarray, channels) -> np.ndarray:
+        U = self.voxel_factors[voxels].astype(np.float32)
+        values = U @ self.channel_factors[channels].T + self.mean[channels]
+        return np.maximum(values, 0, out=values)
+
+
+class _BlockCache:
+    """The `vis` table of a chunked PhotonLib file, read in blocks of voxels (by
+    default one HDF5 chunk long) kept in an LRU cache of `cache_bytes`.
+    """
+
+    def __init__(self, vis: h5py.Dataset, block_size: int = None, cache_bytes: int = 2**30, decode=None):
+        self.vis = vis
+        self.decode = decode
+        self.shape = vis.shape
+        self.block_size = block_size or (vis.chunks[0] if vis.chunks else 4096)
+        block_bytes = self.block_size * self.shape[1] * vis.dtype.itemsize
+        self.max_blocks = max(1, cache_bytes // block_bytes)
+        self._blocks = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _block(self, b: int) -> np.ndarray:
+        block = self._blocks.get(b)
+        if block is not None:
+            self._blocks.move_to_end(b)
+            self.hits += 1
+            return block
+        self.misses += 1
+        block = self.vis[b * self.block_size : (b + 1) * self.block_size]
+        self._blocks[b] = block
+        if len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def rows(self, voxels: np.ndarray, channels) -> np.ndarray:
+        n_channels = len(np.arange(self.shape[1])[channels])
+        out = np.empty((len(voxels), n_channels), dtype=self.vis.dtype)
+        blocks = voxels // self.block_size
+        # voxels are grouped by block so that each block is looked up once
+        order = np.argsort(blocks, kind="stable")
+        bounds = np.flatnonzero(np.diff(blocks[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+            b = blocks[group[0]]
+            out[group] = self._block(b)[voxels[group] - b * self.block_size][:, channels]
+        if self.decode is not None:
+            return self.decode(out)
+        return out.astype(np.float32, copy=False)
+
+
+class LightmapQuery:
+    """Batched trilinear or nearest-voxel PTE lookups in a PhotonLib file.
+
+    Files written with `h5_to_plib --contiguous` are memory-mapped; otherwise the
+    table is read in blocks of voxels through an LRU cache. Files compressed with
+    `lightmap.compress` are evaluated directly.
+    """
+
+    def __init__(self, path: str, cache_bytes: int = 2**30, block_size: int = None):
+        self.path = path
+        self.f = h5py.File(path, "r")
+        self.shape = self.f["numvox"][()].astype(np.int64)
+        self.min = self.f["min"][()].astype(float)
+        self.max = self.f["max"][()].astype(float)
+        self.pitch = (self.max - self.min) / self.shape
+
+        self.format = self.f.attrs.get("format", "plib")
+        if self.format == "lowrank":
+            self.table = _LowRankTable(self.f)
+        elif self.format == "log":
+            decode = LogQuantizer.from_attrs(self.f.attrs).decode
+            self.table = _BlockCache(self.f["vis_log"], block_size, cache_bytes, decode=decode)
+        else:
+            # plain PhotonLib files and float16 tables store the `vis` table as is
+            vis = self.f["vis"]
+            offset = vis.id.get_offset()
+            if vis.chunks is None and vis.compression is None and offset is not None:
+                self.table = _MemmapTable(path, offset, vis.shape, vis.dtype)
+            else:
+                self.table = _BlockCache(vis, block_size=block_size, cache_bytes=cache_bytes)
+        self.n_channels = self.table.shape[1]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.f.close()
+
+    def voxel_index(self, ijk: np.ndarray) -> np.ndarray:
+        """Table row of integer voxel coordinates, x fastest."""
+        return ijk[..., 0] + self.shape[0] * (ijk[..., 1] + self.shape[1] * ijk[..., 2])
+
+    def _gather(self, voxels: np.ndarray, channels) -> np.ndarray:
+        """Rows of the table for an array of voxels of any shape, reading
+        every distinct voxel once."""
+        unique, inverse = np.unique(voxels, return_inverse=True)
+        rows = self.table.rows(unique, channels)
+        return rows[inverse.reshape(voxels.shape)]
+
+    def __call__(self, positions: np.ndarray, channels=slice(None), method: str = "linear") -> np.ndarray:
+        """PTE at the positions for all channels or a subset.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            (n, 3) query positions in mm. Positions outside the map are clamped
+            to its boundary.
+        channels : slice or array-like
+            The channels to return.
+        method : {"linear", "nearest"}
+            Trilinear interpolation between voxel centers or the value of the
+            voxel containing the position.
+
+        Returns
+        -------
+        np.ndarray
+            (n, n_selected_channels) PTE.
+        """
+        positions = np.atleast_2d(np.asarray(positions, dtype=float))
+        if method == "nearest":
+            ijk = np.floor((positions - self.min) / self.pitch).astype(np.int64)
+            ijk = np.clip(ijk, 0, self.shape - 1)
+            return self._gather(self.voxel_index(ijk), channels)
+        if method != "linear":
+            raise ValueError(f"unknown interpolation method {method!r}")
+
+        # coordinates in units of voxels, relative to the first voxel center
+        u = np.clip((positions - self.min) / self.pitch - 0.5, 0, self.shape - 1)
+        lower = np.minimum(np.floor(u).astype(np.int64), np.maximum(self.shape - 2, 0))
+        frac = u - lower
+        corners = np.minimum(lower[:, None, :] + CORNERS, self.shape - 1)
+        weights = np.prod(np.where(CORNERS, frac[:, None, :], 1 - frac[:, None, :]), axis=-1)
+
+        values = self._gather(self.voxel_index(corners), channels)
+        return np.einsum("nc,ncm->nm", weights.astype(np.float32), values)
+
+    def benchmark(self, n: int = 100_000, batch_size: int = 10_000, channels=slice(None), method: str = "linear", seed: int = 0) -> dict:
+        """Times batched queries at uniformly random positions in the map."""
+        rng = np.random.default_rng(seed)
+        positions = rng.uniform(self.min, self.max, size=(n, 3))
+        start = time.perf_counter()
+        for i in range(0, n, batch_size):
+            self(positions[i : i + batch_size], channels=channels, method=method)
+        elapsed = time.perf_counter() - start
+        results = dict(
+            backend=type(self.table).__name__.lstrip("_"),
+            n_queries=n,
+            batch_size=batch_size,
+            n_channels=len(np.arange(self.n_channels)[channels]),
+            method=method,
+            total_time=elapsed,
+            queries_per_sec=n / elapsed,
+        )
+        if isinstance(self.table, _BlockCache):
+            results["cache_hit_rate"] = self.table.hits / max(self.table.hits + self.table.misses, 1)
+        return results
+
+
+def main():
+    import argparse
+
+    from utils.output import print_table
+
+    parser = argparse.ArgumentParser(description="Benchmark lightmap queries on a PhotonLib file")
+    parser.add_argument("plib", type=str, help="Path to the PhotonLib file")
+    parser.add_argument("-n", type=int, default=100_000, help="Number of random query positions")
+    parser.add_argument("--batch", type=int, default=10_000, help="Number of positions per query")
+    parser.add_argument("--channels", type=int, default=None, help="Query only the first CHANNELS channels")
+    parser.add_argument("--method", type=str, default="linear", choices=["linear", "nearest"])
+    parser.add_argument("--cache", type=float, default=1.0, help="Block cache size in GiB")
+
+    args = parser.parse_args()
+
+    channels = slice(None) if args.channels is None else slice(0, args.channels)
+    with LightmapQuery(args.plib, cache_bytes=int(args.cache * 2**30)) as lm:
+        print_table(**lm.benchmark(args.n, args.batch, channels=channels, method=args.method))
+
+
+if __name__ == "__main__":
+    main()
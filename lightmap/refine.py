@@ -0,0 +1,247 @@
+from typing import Tuple
+
+import numpy as np
+
+__all__ = ["RefinementGrid", "resample", "grid_points"]
+
+# corner offsets of a unit cell, in the order used for trilinear interpolation
+CORNERS = np.array(
+    [[i, j, k] for k in (0, 1) for j in (0, 1) for i in (0, 1)], dtype=np.int64
+)
+
+
+def _lattice_keys(ijk: np.ndarray, shape: np.ndarray) -> np.ndarray:
+    """Linear keys of integer lattice coordinates, x fastest."""
+    ijk = np.asarray(ijk, dtype=np.int64)
+    return ijk[..., 0] + shape[0] * (ijk[..., 1] + shape[1] * ijk[..., 2])
+
+
+def _lookup(sorted_keys: np.ndarray, order: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    """Indices of `keys` in the array sorted by `order`, -1 for missing keys."""
+    pos = np.searchsorted(sorted_keys, keys)
+    pos = np.minimum(pos, len(sorted_keys) - 1)
+    found = sorted_keys[pos] == keys
+    return np.where(found, order[pos], -1)
+
+
+class RefinementGrid:
+    """Coarse-to-fine sampling of lightmap positions.
+
+    The scan starts with the corners of a grid of cells of spacing `pitch`. Level
+    by level, the center of every cell is simulated and compared to the mean of its
+    corners; cells off by more than `tolerance` (relative to the brightest channel,
+    at least `floor`) are split into 8, down to `pitch / 2**max_level`. Point ids
+    are assigned in the order points have to be simulated in.
+    """
+
+    def __init__(
+        self,
+        bounds: np.ndarray,
+        pitch,
+        max_level: int,
+        tolerance: float,
+        floor: float = 1e-4,
+    ):
+        bounds = np.asarray(bounds, dtype=float)
+        pitch = np.broadcast_to(np.asarray(pitch, dtype=float), (3,))
+        n_cells = np.maximum(np.ceil((bounds[1] - bounds[0]) / pitch - 1e-9), 1).astype(np.int64)
+
+        self.max_level = int(max_level)
+        self.tolerance = tolerance
+        self.floor = floor
+        self.scale = 2**self.max_level
+        self.origin = bounds[0]
+        self.spacing = pitch / self.scale
+        self.shape = n_cells * self.scale + 1
+
+        self._lattice = np.empty((0, 3), dtype=np.int64)
+        self._keys = np.empty(0, dtype=np.int64)
+        self._order = np.empty(0, dtype=np.int64)
+        self._sorted_keys = np.empty(0, dtype=np.int64)
+        self._values = []
+
+        self.level = -1
+        self._stage = None
+        self._cells = np.empty((0, 3), dtype=np.int64)
+        self.refined_cells = []
+
+    def __len__(self):
+        return len(self._lattice)
+
+    @property
+    def positions(self) -> np.ndarray:
+        """Positions of all points created so far, shape (n_points, 3)."""
+        return self.origin + self._lattice * self.spacing
+
+    @property
+    def cell_size(self) -> int:
+        """Size of the cells at the current level in lattice units."""
+        return self.scale >> self.level
+
+    def record(self, point_id: int, values: np.ndarray):
+        """Stores the simulated per-channel PTE of a point."""
+        self._values[point_id] = np.asarray(values, dtype=float)
+
+    def refine(self) -> np.ndarray:
+        """Advances the scan and returns the ids of the next points to simulate.
+
+        All previously returned points must have been recorded. An empty array
+        means the scan is finished.
+        """
+        missing = [i for i, v in enumerate(self._values) if v is None]
+        if missing:
+            raise RuntimeError(
+                f"{len(missing)} points were not recorded before refining, e.g. point {missing[0]}"
+            )
+
+        if self._stage is None:
+            self.level = 0
+            n_cells = (self.shape - 1) // self.scale
+            cells = np.stack(
+                np.meshgrid(*(np.arange(n) for n in n_cells), indexing="ij"), axis=-1
+            ).reshape(-1, 3)
+            self._cells = cells * self.scale
+            self._stage = "corners"
+            return self._add_corners(self._cells)
+
+        if self._stage == "corners":
+            if self.level == self.max_level:
+                return self._finish()
+            self._stage = "centers"
+            return self._add(self._cells + self.cell_size // 2)
+
+        # compare each cell center with the interpolation of its corners
+        size = self.cell_size
+        corner_values = self._values_at(self._cells[:, None, :] + CORNERS * size)
+        center_values = self._values_at(self._cells + size // 2)
+        error = np.abs(center_values - corner_values.mean(axis=1)).max(axis=1)
+        norm = np.maximum(center_values.max(axis=1), self.floor)
+        refine = error / norm > self.tolerance
+        if not refine.any():
+            return self._finish()
+
+        parents = self._cells[refine]
+        self.refined_cells.extend((self.level, *c) for c in parents)
+        self._cells = (parents[:, None, :] + CORNERS * (size // 2)).reshape(-1, 3)
+        self.level += 1
+        self._stage = "corners"
+        return self._add_corners(self._cells)
+
+    def _finish(self) -> np.ndarray:
+        self._stage = "done"
+        self._cells = np.empty((0, 3), dtype=np.int64)
+        return np.empty(0, dtype=np.int64)
+
+    def _add_corners(self, cells: np.ndarray) -> np.ndarray:
+        return self._add((cells[:, None, :] + CORNERS * self.cell_size).reshape(-1, 3))
+
+    def _add(self, ijk: np.ndarray) -> np.ndarray:
+        """Adds lattice points that do not exist yet and returns their ids."""
+        keys = _lattice_keys(ijk, self.shape)
+        keys, first = np.unique(keys, return_index=True)
+        new = _lookup(self._sorted_keys, self._order, keys) < 0 if len(self._keys) else np.ones(len(keys), bool)
+        # keep the order in which the points were requested
+        new_idx = np.sort(first[new])
+        start = len(self._lattice)
+        self._lattice = np.concatenate((self._lattice, ijk[new_idx]))
+        self._keys = np.concatenate((self._keys, _lattice_keys(ijk[new_idx], self.shape)))
+        self._order = np.argsort(self._keys, kind="stable")
+        self._sorted_keys = self._keys[self._order]
+        self._values.extend([None] * len(new_idx))
+        return np.arange(start, len(self._lattice))
+
+    def _values_at(self, ijk: np.ndarray) -> np.ndarray:
+        ids = _lookup(self._sorted_keys, self._order, _lattice_keys(ijk, self.shape))
+        values = np.stack([self._values[i] for i in ids.ravel()])
+        return values.reshape(*ids.shape, -1)
+
+    @property
+    def attrs(self) -> dict:
+        """Metadata needed to resample the scan, see `resample`."""
+        return dict(
+            refine_origin=self.origin,
+            refine_spacing=self.spacing,
+            refine_shape=self.shape,
+            refine_levels=self.max_level,
+        )
+
+
+def resample(
+    positions: np.ndarray,
+    values: np.ndarray,
+    origin: np.ndarray,
+    spacing: np.ndarray,
+    shape: np.ndarray,
+    max_level: int,
+    refined_cells: np.ndarray,
+    points: np.ndarray,
+) -> np.ndarray:
+    """Evaluates a refined scan at arbitrary points.
+
+    Every point is located in the finest cell of the scan that contains it and
+    the value is trilinearly interpolated from that cell's corners.
+
+    Parameters
+    ----------
+    positions, values : np.ndarray
+        The simulated positions (n, 3) and their per-channel values (n, n_channels).
+    origin, spacing, shape, max_level :
+        The lattice metadata of the scan, see `RefinementGrid.attrs`.
+    refined_cells : np.ndarray
+        (m, 4) array of (level, i, j, k) of every cell that was subdivided.
+    points : np.ndarray
+        (p, 3) query points.
+
+    Returns
+    -------
+    np.ndarray
+        (p, n_channels) interpolated values.
+    """
+    origin = np.asarray(origin, dtype=float)
+    spacing = np.asarray(spacing, dtype=float)
+    shape = np.asarray(shape, dtype=np.int64)
+    scale = 2**int(max_level)
+
+    lattice = np.round((np.asarray(positions) - origin) / spacing).astype(np.int64)
+    keys = _lattice_keys(lattice, shape)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    n_lattice = np.prod(shape)
+    refined_cells = np.asarray(refined_cells, dtype=np.int64).reshape(-1, 4)
+    refined_keys = np.sort(refined_cells[:, 0] * n_lattice + _lattice_keys(refined_cells[:, 1:], shape))
+
+    u = np.clip((np.asarray(points, dtype=float) - origin) / spacing, 0, shape - 1)
+    size = np.full(len(u), scale, dtype=np.int64)
+    cell = np.minimum(np.floor(u / scale).astype(np.int64) * scale, shape - 1 - scale)
+
+    for level in range(int(max_level)):
+        cell_keys = level * n_lattice + _lattice_keys(cell, shape)
+        is_refined = (size == scale >> level) & np.isin(cell_keys, refined_keys)
+        if not is_refined.any():
+            break
+        half = size[is_refined, None] // 2
+        cell[is_refined] += (u[is_refined] >= cell[is_refined] + half) * half
+        size[is_refined] //= 2
+
+    corners = cell[:, None, :] + CORNERS * size[:, None, None]
+    ids = _lookup(sorted_keys, order, _lattice_keys(corners, shape))
+    if (ids < 0).any():
+        raise ValueError("refined scan is missing cell corners")
+
+    f = np.clip((u - cell) / size[:, None], 0, 1)
+    weights = np.prod(np.where(CORNERS, f[:, None, :], 1 - f[:, None, :]), axis=-1)
+    return np.einsum("pc,pcn->pn", weights, np.asarray(values)[ids])
+
+
+def grid_points(bounds: np.ndarray, pitch) -> Tuple[np.ndarray, Tuple[int, int, int]]:
+    """Centers of a uniform voxel grid with the given pitch covering `bounds`.
+
+    Returns the (n, 3) points, x fastest, and the grid shape.
+    """
+    bounds = np.asarray(bounds, dtype=float)
+    pitch = np.broadcast_to(np.asarray(pitch, dtype=float), (3,))
+    axes = [np.arange(bounds[0, i] + pitch[i] / 2, bounds[1, i], pitch[i]) for i in range(3)]
+    Z, Y, X = np.meshgrid(axes[2], axes[1], axes[0], indexing="ij")
+    points = np.column_stack((X.ravel(), Y.ravel(), Z.ravel()))
+    return points, tuple(len(a) for a in axes)
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import List, Tuple
+
+import h5py
+import numpy as np
+
+from utils.files import atomic_write
+from utils.output import ROWS_ATTR
+
+__all__ = [
+    "file_md5",
+    "shard_range",
+    "shard_path",
+    "range_path",
+    "ShardManifest",
+    "check_shards",
+    "merge_shards",
+]
+
+# datasets are copied between files in blocks of this many rows
+COPY_ROWS = 65536
+
+
+def file_md5(path) -> str:
+    """MD5 of a file's contents, read in blocks."""
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def shard_range(n_positions: int, shard_index: int, num_shards: int) -> Tuple[int, int]:
+    """The [start, stop) positions of a shard when splitting `n_positions` into
+    `num_shards` contiguous ranges whose lengths differ by at most one."""
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"shard index {shard_index} is not in [0, {num_shards})")
+    size, extra = divmod(n_positions, num_shards)
+    start = shard_index * size + min(shard_index, extra)
+    stop = start + size + (shard_index < extra)
+    return start, stop
+
+
+def shard_path(output_file: str, shard_index: int) -> str:
+    """The output file of a shard, e.g. `lightmap.shard003.h5` for `lightmap.h5`."""
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.shard{shard_index:03d}{ext}"
+
+
+def range_path(output_file: str, start: int, stop: int) -> str:
+    """The output file of an explicit position range, e.g. `lightmap.0-50000.h5`
+    for `lightmap.h5`."""
+    root, ext = os.path.splitext(output_file)
+    return f"{root}.{start}-{stop}{ext}"
+
+
+@dataclass
+class ShardManifest:
+    """Describes one shard of a lightmap scan, stored as JSON next to its output file.
+
+    `merge_shards` uses the manifests to check that shards belong to the same
+    scan (`geometry_hash` is `geometry.builder.geometry_key`) and cover it. With
+    `folded`, `start` and `stop` index the folded positions. `complete` is set
+    once the shard is written.
+    """
+
+    output_file: str
+    start: int
+    stop: int
+    n_positions: int
+    geometry_hash: str
+    positions_hash: str
+    positions_path: str
+    folded: bool = False
+    shard_index: int = None
+    num_shards: int = None
+    complete: bool = False
+
+    @staticmethod
+    def path_for(output_file: str) -> str:
+        return os.path.splitext(output_file)[0] + ".json"
+
+    def save(self, path: str):
+        with atomic_write(path) as f:
+            json.dump(asdict(self), f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "ShardManifest":
+        with open(path) as f:
+            return cls(**json.load(f))
+
+
+def check_shards(manifest_paths: List[str]) -> List[Tuple[ShardManifest, str]]:
+    """Verifies that the shards belong to one scan and cover it exactly once.
+
+    Returns the manifests and the absolute paths of their output files, sorted
+    by range. Raises a ValueError describing the first inconsistency found.
+    """
+    shards = []
+    for path in manifest_paths:
+        manifest = ShardManifest.load(path)
+        output = Path(path).parent / manifest.output_file
+        shards.append((manifest, str(output)))
+    if not shards:
+        raise ValueError("no shards given")
+    shards.sort(key=lambda s: s[0].start)
+
+    first = shards[0][0]
+    for manifest, output in shards:
+        for key in ("geometry_hash", "positions_hash", "n_positions", "folded"):
+            if getattr(manifest, key) != getattr(first, key):
+                raise ValueError(
+                    f"{output} has a different {key} ({getattr(manifest, key)}) "
+                    f"than {shards[0][1]} ({getattr(first, key)})"
+                )
+        if not manifest.complete:
+            raise ValueError(f"{output} is incomplete")
+        with h5py.File(output, "r") as f:
+            n_rows = f["posX"].shape[0]
+        if n_rows != manifest.stop - manifest.start:
+            raise ValueError(
+                f"{output} has {n_rows} rows, its manifest covers {manifest.stop - manifest.start} positions"
+            )
+
+    expected = 0
+    for manifest, output in shards:
+        if manifest.start > expected:
+            raise ValueError(f"positions [{expected}, {manifest.start}) are not covered by any shard")
+        if manifest.start < expected:
+            raise ValueError(f"{output} overlaps the previous shard at position {manifest.start}")
+        expected = manifest.stop
+    if expected != first.n_positions:
+        raise ValueError(f"positions [{expected}, {first.n_positions}) are not covered by any shard")
+
+    if not first.folded and os.path.exists(first.positions_path):
+        if file_md5(first.positions_path) != first.positions_hash:
+            raise ValueError(f"{first.positions_path} changed since the scan was run")
+        positions = np.load(first.positions_path, mmap_mode="r")
+        for manifest, output in shards:
+            with h5py.File(output, "r") as f:
+                written = np.column_stack([f[k][()] for k in ("posX", "posY", "posZ")])
+            if not np.allclose(written, positions[manifest.start : manifest.stop], atol=1e-3):
+                raise ValueError(f"positions in {output} do not match {first.positions_path}")
+
+    return shards
+
+
+def merge_shards(manifest_paths: List[str], output_file: str):
+    """Concatenates verified shards into a single lightmap file.
+
+    The datasets of every shard are appended in range order, so the merged file
+    is identical to the output of an unsharded run apart from the timings.
+    File attributes, e.g. the symmetry spec, are taken from the first shard.
+    """
+    shards = check_shards(manifest_paths)
+    n_total = shards[0][0].n_positions
+
+    with h5py.File(shards[0][1], "r") as f:
+        attrs = dict(f.attrs)
+        layout = {k: (f[k].shape[1:], f[k].dtype, f[k].chunks, f[k].compression) for k in f.keys()}
+
+    with h5py.File(output_file, "w") as out:
+        out.attrs.update(attrs)
+        for key, (shape, dtype, chunks, compression) in layout.items():
+            # resizable like the shards, so a merged scan can be resumed and
+            # chunks longer than a small scan are valid
+            out.create_dataset(
+                key, shape=(n_total, *shape), maxshape=(None, *shape), dtype=dtype, chunks=chunks, compression=compression
+            )
+        for manifest, path in shards:
+            with h5py.File(path, "r") as f:
+                if set(f.keys()) != set(layout):
+                    raise ValueError(f"{path} has different datasets than {shards[0][1]}")
+                for key in layout:
+                    for i in range(0, manifest.stop - manifest.start, COPY_ROWS):
+                        rows = slice(i, min(i + COPY_ROWS, manifest.stop - manifest.start))
+                        out[key][manifest.start + rows.start : manifest.start + rows.stop] = f[key][rows]
+        out.attrs[ROWS_ATTR] = n_total
@@ -0,0 +1,264 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import yaml
+
+__all__ = ["SymmetryOperator", "SymmetryGroup", "compare_unfolded"]
+
+# no finite 3D point group has more elements than the full octahedral group
+MAX_GROUP_ORDER = 48
+
+
+def _rotation_matrix(angle: float, axis) -> np.ndarray:
+    """The matrix rotating by `angle` radians about `axis`, in the convention of
+    `chroma.transform.make_rotation_matrix` (Rodrigues' formula)."""
+    n = np.asarray(axis, dtype=float)
+    n = n / np.linalg.norm(n)
+    cross = np.array([[0, n[2], -n[1]], [-n[2], 0, n[0]], [n[1], -n[0], 0]])
+    return np.cos(angle) * np.eye(3) + (1 - np.cos(angle)) * np.outer(n, n) + np.sin(angle) * cross
+
+
+@dataclass
+class SymmetryOperator:
+    """An orthogonal transformation, about the group origin, that maps the detector
+    onto itself and the sensor of channel `c` onto that of `channels[c]`.
+    """
+
+    matrix: np.ndarray
+    channels: np.ndarray
+    name: str = ""
+
+    def compose(self, other: "SymmetryOperator") -> "SymmetryOperator":
+        """The operator applying `other` first and then `self`."""
+        return SymmetryOperator(
+            self.matrix @ other.matrix,
+            self.channels[other.channels],
+            f"{self.name}*{other.name}",
+        )
+
+    def same_as(self, other: "SymmetryOperator") -> bool:
+        return np.allclose(self.matrix, other.matrix, atol=1e-9) and np.array_equal(
+            self.channels, other.channels
+        )
+
+    @classmethod
+    def from_config(cls, config: dict, n_channels: int, base_dir: Path) -> "SymmetryOperator":
+        if "rotation" in config:
+            rotation = config["rotation"]
+            matrix = _rotation_matrix(rotation["angle"] * np.pi / 180.0, rotation["dir"])
+        elif "reflection" in config:
+            normal = np.asarray(config["reflection"], dtype=float)
+            normal /= np.linalg.norm(normal)
+            matrix = np.eye(3) - 2 * np.outer(normal, normal)
+        else:
+            matrix = np.asarray(config["matrix"], dtype=float)
+
+        channels = config["channels"]
+        if isinstance(channels, str):
+            channels = np.load(base_dir / channels)
+        channels = np.asarray(channels, dtype=np.int64)
+        if n_channels is not None and len(channels) != n_channels:
+            raise ValueError(
+                f"operator {config.get('name')} permutes {len(channels)} channels, "
+                f"the detector has {n_channels}"
+            )
+        if not np.array_equal(np.sort(channels), np.arange(len(channels))):
+            raise ValueError(f"channels of operator {config.get('name')} are not a permutation")
+        return cls(np.asarray(matrix, dtype=float), channels, config.get("name", ""))
+
+
+class SymmetryGroup:
+    """The symmetry group of a detector, generated by a list of operators.
+
+    Used to simulate lightmap positions in a fundamental domain only (`fold`)
+    and to rebuild the full lightmap from them (`unfold`). If the detector is
+    invariant under an operator g that maps the sensor of channel c onto that of
+    channel π(c), then PTE(g x, π(c)) = PTE(x, c).
+
+    The specification is a yaml file listing generators of the group. The group
+    is closed under composition automatically, so a 4-fold rotational symmetry
+    needs a single 90 degree rotation:
+
+        ```yaml
+        origin: [0, 0, 0]   # point the operators act around, in mm
+        decimals: 3         # positions are matched after rounding to this many decimals
+        operators:
+          - name: rot90
+            rotation:
+              dir: [0, 0, 1]
+              angle: 90     # in degrees
+            channels: [1, 2, 3, 0]   # channel c is mapped onto channels[c]
+          - name: mirror_x
+            reflection: [1, 0, 0]    # normal of the mirror plane
+            channels: mirror_x.npy   # or a .npy file relative to this file
+        ```
+
+    Operators may also be given as a 3x3 `matrix`.
+    """
+
+    def __init__(self, generators: List[SymmetryOperator], origin=(0, 0, 0), decimals: int = 3):
+        self.origin = np.asarray(origin, dtype=float)
+        self.decimals = decimals
+        if not generators:
+            raise ValueError("a symmetry group needs at least one operator")
+        n_channels = len(generators[0].channels)
+        identity = SymmetryOperator(np.eye(3), np.arange(n_channels), "identity")
+
+        self.elements = [identity]
+        frontier = [identity]
+        while frontier:
+            new = []
+            for element in frontier:
+                for generator in generators:
+                    candidate = generator.compose(element)
+                    if not any(candidate.same_as(e) for e in self.elements):
+                        self.elements.append(candidate)
+                        new.append(candidate)
+            frontier = new
+            if len(self.elements) > MAX_GROUP_ORDER:
+                raise ValueError(
+                    "symmetry operators do not generate a finite point group; "
+                    "check the rotation angles and channel permutations"
+                )
+
+    def __len__(self):
+        return len(self.elements)
+
+    @property
+    def n_channels(self) -> int:
+        return len(self.elements[0].channels)
+
+    @classmethod
+    def from_yaml(cls, path: str, n_channels: int = None) -> "SymmetryGroup":
+        path = Path(path)
+        return cls.from_string(path.read_text(), n_channels=n_channels, base_dir=path.parent)
+
+    @classmethod
+    def from_string(cls, text: str, n_channels: int = None, base_dir: Path = Path(".")) -> "SymmetryGroup":
+        config = yaml.safe_load(text)
+        generators = [
+            SymmetryOperator.from_config(op, n_channels, Path(base_dir))
+            for op in config["operators"]
+        ]
+        return cls(generators, config.get("origin", (0, 0, 0)), config.get("decimals", 3))
+
+    def apply(self, element: SymmetryOperator, positions: np.ndarray) -> np.ndarray:
+        return (np.asarray(positions) - self.origin) @ element.matrix.T + self.origin
+
+    def _round(self, positions: np.ndarray) -> np.ndarray:
+        # adding zero turns -0.0 into 0.0 so that mirrored points compare equal
+        return np.round(positions, self.decimals) + 0.0
+
+    def fold(self, positions: np.ndarray) -> np.ndarray:
+        """Maps positions into the fundamental domain.
+
+        Every position is replaced by the lexicographically smallest point of its
+        orbit. Returns the unique representatives, shape (n_rep, 3), in order of
+        first appearance.
+        """
+        positions = np.asarray(positions, dtype=float)
+        images = np.stack([self.apply(g, positions) for g in self.elements])
+        rounded = self._round(images)
+
+        # lexicographic argmin over the group axis
+        best = np.zeros(len(positions), dtype=np.intp)
+        for g in range(1, len(self.elements)):
+            a, b = rounded[g], rounded[best, np.arange(len(positions))]
+            diff = a != b
+            first = np.argmax(diff, axis=1)
+            smaller = diff.any(axis=1) & (
+                a[np.arange(len(a)), first] < b[np.arange(len(b)), first]
+            )
+            best[smaller] = g
+
+        canonical = rounded[best, np.arange(len(positions))]
+        _, first = np.unique(canonical, axis=0, return_index=True)
+        first = np.sort(first)
+        return images[best[first], first]
+
+    def unfold(self, positions: np.ndarray, values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Rebuilds the full lightmap from the fundamental domain.
+
+        Parameters
+        ----------
+        positions : np.ndarray
+            (n, 3) positions in the fundamental domain.
+        values : np.ndarray
+            (n, n_channels) per-channel values at those positions.
+
+        Returns
+        -------
+        positions, values : np.ndarray
+            All distinct images of the positions and their values with the
+            channels permuted accordingly.
+        """
+        values = np.asarray(values)
+        images, element_idx, source_idx = self.images(positions)
+        all_values = np.empty((len(images), values.shape[1]), dtype=values.dtype)
+        for e, g in enumerate(self.elements):
+            mask = element_idx == e
+            all_values[mask] = values[source_idx[mask]][:, np.argsort(g.channels)]
+        return images, all_values
+
+    def images(self, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """All distinct images of the positions under the group.
+
+        Returns the (m, 3) images, and for each the index of the group element
+        and of the position it is the image of.
+        """
+        positions = np.asarray(positions, dtype=float)
+        all_positions = np.concatenate([self.apply(g, positions) for g in self.elements])
+        _, first = np.unique(self._round(all_positions), axis=0, return_index=True)
+        first = np.sort(first)
+        element_idx, source_idx = np.divmod(first, len(positions))
+        return all_positions[first], element_idx, source_idx
+
+    def locate(self, rep_positions: np.ndarray, positions: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Finds for every position a representative and a group element mapping
+        the representative onto it.
+
+        Returns the indices into `rep_positions` and into `elements`.
+        """
+        keys = {}
+        for e, g in enumerate(self.elements):
+            for r, p in enumerate(self._round(self.apply(g, rep_positions))):
+                keys.setdefault(tuple(p), (r, e))
+        try:
+            found = [keys[tuple(p)] for p in self._round(np.asarray(positions, dtype=float))]
+        except KeyError as e:
+            raise ValueError(f"position {e.args[0]} is not the image of a simulated position") from e
+        rep_idx, element_idx = np.array(found, dtype=np.intp).reshape(-1, 2).T
+        return rep_idx, element_idx
+
+    def lookup(self, rep_positions: np.ndarray, rep_values: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """Values predicted by symmetry at arbitrary `positions` whose orbits
+        contain one of `rep_positions`."""
+        rep_idx, element_idx = self.locate(rep_positions, positions)
+        values = np.empty((len(rep_idx), np.shape(rep_values)[1]), dtype=np.asarray(rep_values).dtype)
+        for e, g in enumerate(self.elements):
+            mask = element_idx == e
+            values[mask] = np.asarray(rep_values)[rep_idx[mask]][:, np.argsort(g.channels)]
+        return values
+
+
+def compare_unfolded(pte_pred, n_pred, pte_direct, n_direct) -> dict:
+    """Compares PTE predicted by symmetry with a direct simulation.
+
+    Returns summary statistics of the binomial pulls between the two.
+    """
+    pte_pred, pte_direct = np.asarray(pte_pred, float), np.asarray(pte_direct, float)
+    n_pred = np.asarray(n_pred, float).reshape(-1, 1)
+    n_direct = np.asarray(n_direct, float).reshape(-1, 1)
+    var = pte_pred * (1 - pte_pred) / n_pred + pte_direct * (1 - pte_direct) / n_direct
+    diff = pte_pred - pte_direct
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pulls = np.where(var > 0, diff / np.sqrt(var), 0.0)
+    ndf = np.count_nonzero(var > 0)
+    return dict(
+        n_checked=len(pte_direct),
+        max_abs_diff=float(np.abs(diff).max()),
+        max_abs_pull=float(np.abs(pulls).max()),
+        chi2_per_ndf=float((pulls**2).sum() / max(ndf, 1)),
+    )
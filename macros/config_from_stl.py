@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import json
 import yaml
 import argparse
 import os
@@ -42,11 +43,38 @@ PART_TEMPLATE = """
       color: lightgrey
 """
 
+BUNDLE_PART_TEMPLATE = """
+  - name: {name}
+    is_detector: false
+    path: {path}
+    members: {members}
+    scale: 1.0
+    translation: [0,0,0]
+    rotation:
+      angle: 0
+      dir: [0,0,1]
+    material:
+      surface: null
+      material1: null
+      material2: null
+      color: lightgrey
+"""
+
+def quote(value: str) -> str:
+    # a double-quoted yaml string, so names like 0001 are not loaded as numbers
+    return json.dumps(value)
+
 def generate_part_config(path: str) -> str:
     name = os.path.splitext(os.path.basename(path))[0]
-    return PART_TEMPLATE.format(name=name, path=path)
+    return PART_TEMPLATE.format(name=quote(name), path=quote(path))
+
+def generate_bundle_part_config(bundle: str, path: str) -> str:
+    name = os.path.splitext(os.path.basename(path))[0]
+    return BUNDLE_PART_TEMPLATE.format(name=quote(name), path=quote(bundle), members=quote(name))
 
-def generate_config(files: List[str]) -> str:
+def generate_config(files: List[str], bundle: str = None) -> str:
+    if bundle is not None:
+        return ''.join(generate_bundle_part_config(bundle, f) for f in files)
     return ''.join(map(generate_part_config, files))
 
 def validate_and_dump_config(config: str, output_path: str) -> None:
@@ -67,12 +95,20 @@ def main():
     parser = argparse.ArgumentParser(description='Build and view a detector from a yaml file')
     parser.add_argument('name', type=str, help='yaml file name')
     parser.add_argument('files', type=str, nargs='+', help='space separated list of stl files (can use *)')
+    parser.add_argument('--bundle', type=str, help='pack the stl files into a mesh bundle at this path and refer to it')
 
     args = parser.parse_args()
     stl_files = [os.path.abspath(f) for f in args.files]
 
+    bundle = None
+    if args.bundle is not None:
+        from geometry.bundle import write_bundle
+
+        bundle = os.path.abspath(args.bundle)
+        write_bundle(bundle, sorted(stl_files))
+
     output_path = Path('config') / f"{args.name}.yaml"
-    config = generate_config(stl_files)
+    config = generate_config(stl_files, bundle)
     validate_and_dump_config(config, output_path.resolve())
 
 if __name__ == "__main__":
@@ -1,25 +1,128 @@
 #!/usr/bin/env python
 import numpy as np
 import h5py
-from photonlib import PhotonLib, VoxelMeta
+from photonlib import PhotonLib
+from lightmap.io import LightmapFile
+from lightmap.refine import grid_points, resample
+from lightmap.symmetry import SymmetryGroup
 from utils.log import logger
 
-def h5_to_plib(file_path: str, output_path: str):
+# default peak memory of the conversion in bytes
+MEMORY_BUDGET = 2**32
+# target size of a single chunk of the `vis` dataset in bytes
+CHUNK_BYTES = 2**20
+# float32-sized values per channel and grid point held while resampling a
+# coarse-to-fine scan: the 8-corner gather, its float64 copy and the float64
+# interpolated values (see `lightmap.refine.resample`)
+RESAMPLE_ROWS = 8 + 2 * 8 + 2
+
+def h5_to_plib(
+    file_path: str,
+    output_path: str,
+    pitch: float = None,
+    symmetry: str = None,
+    memory_budget: int = MEMORY_BUDGET,
+    compression: str = "gzip",
+    contiguous: bool = False,
+):
+    """Converts a lightmap file to a PhotonLib file.
+
+    The conversion streams blocks of channels from the lightmap to the PhotonLib
+    file, so the peak memory is set by `memory_budget` rather than by the size
+    of the lightmap. Symmetry-folded and coarse-to-fine scans are unfolded and
+    resampled block by block. The table is gzip-compressed by default; with
+    `contiguous`, it is stored unchunked and uncompressed so that
+    `lightmap.query.LightmapQuery` can memory-map it.
+    """
     
     logger.info(f"reading {file_path}")
-    with h5py.File(file_path, "r") as f:
-        if 'numvox' in f:
-            raise ValueError("This file is already in PhotonLib format.")
-
-        x = f["posX"]
-        y = f["posY"]
-        z = f["posZ"]
-        positions = np.array([x, y, z]).T
-        pte = np.array(
-            [f[k] for k in f.keys() if k.startswith("ch")]
-        ).T
-    logger.info(f"read {positions.shape[0]} positions and {pte.shape[1]} channels")
-    
+    with LightmapFile(file_path) as f:
+        logger.info(f"found {f.layout} layout")
+        positions = f.positions
+        n_channels = max(f.n_channels, 1)
+        n_read = len(positions)
+
+        def read(channels):
+            return f.pte(channels=channels)
+
+        if symmetry is not None:
+            group = SymmetryGroup.from_yaml(symmetry, n_channels=n_channels)
+        elif "symmetry" in f.attrs:
+            group = SymmetryGroup.from_string(
+                f.attrs["symmetry"], n_channels=n_channels, base_dir=f.attrs["symmetry_dir"]
+            )
+        else:
+            group = None
+        logger.info(f"found {positions.shape[0]} positions and {n_channels} channels")
+
+        if group is not None:
+            positions, read = unfold_reader(group, positions, read)
+            # a block of output channels may need as many input channels per element
+            n_read *= len(group)
+            logger.info(f"unfolding to {positions.shape[0]} positions with a {len(group)}-element symmetry group")
+
+        refined = "refine_cells" in f
+        if refined:
+            n_read += len(positions)
+            positions, read = resample_reader(positions, read, dict(f.attrs), f["refine_cells"][()], pitch)
+
+        bounds, shape, voxels = voxel_grid(positions)
+        rows_per_channel = n_read + len(positions) + 2 * int(np.prod(shape))
+        if refined:
+            rows_per_channel += RESAMPLE_ROWS * len(positions)
+        write_plib(
+            output_path, bounds, shape, voxels, read, n_channels,
+            memory_budget // (4 * rows_per_channel), compression=compression, contiguous=contiguous,
+        )
+
+def unfold_reader(group: SymmetryGroup, positions: np.ndarray, read):
+    """Unfolds a symmetry-folded scan. Returns all images of the positions and a
+    function reading the unfolded values of a block of channels."""
+    full_positions, element_idx, rep_idx = group.images(positions)
+    inverse = [np.argsort(g.channels) for g in group.elements]
+
+    def read_unfolded(channels):
+        channels = np.arange(group.n_channels)[channels]
+        # input channels needed by any element, read once in increasing order
+        needed = np.unique(np.concatenate([inv[channels] for inv in inverse]))
+        values = read(needed)
+        out = np.empty((len(full_positions), len(channels)), dtype=values.dtype)
+        for e, inv in enumerate(inverse):
+            mask = element_idx == e
+            out[mask] = values[rep_idx[mask]][:, np.searchsorted(needed, inv[channels])]
+        return out
+
+    return full_positions, read_unfolded
+
+def resample_reader(positions, read, attrs, refined_cells, pitch=None):
+    """Resamples a coarse-to-fine scan onto a uniform grid. The default pitch
+    is the finest spacing of the scan. Returns the grid points and a function
+    reading the resampled values of a block of channels."""
+    spacing = attrs["refine_spacing"]
+    origin = attrs["refine_origin"]
+    shape = attrs["refine_shape"]
+    pitch = spacing if pitch is None else pitch
+
+    bounds = np.array([origin, origin + (shape - 1) * spacing])
+    # voxel centers are on the scanned lattice when the pitch is the finest spacing
+    bounds += np.array([-1, 1])[:, None] * np.broadcast_to(pitch, (3,)) / 2
+    grid, grid_shape = grid_points(bounds, pitch)
+    logger.info(f"resampling {len(positions)} refined positions onto a {grid_shape} grid")
+
+    def read_resampled(channels):
+        return resample(
+            positions, read(channels), origin, spacing, shape, attrs["refine_levels"], refined_cells, grid
+        ).astype(np.float32)
+
+    return grid, read_resampled
+
+def voxel_grid(positions: np.ndarray):
+    """Finds the regular voxel grid the positions lie on.
+
+    Returns the (2, 3) bounds, the grid shape and the PhotonLib voxel index
+    (x fastest) of every position.
+    """
+
     # 1. find pitch per coordinate, i.e. smallest non-zero difference
     # between any two positions
     diffs = positions - positions[0]
@@ -40,33 +143,77 @@ def h5_to_plib(file_path: str, output_path: str):
     logger.info(f"found bounds: {bounds.tolist()}")
 
     # 3. Create lightmap grid
-    x = np.arange(bounds[0, 0] + pitch[0] / 2, bounds[1, 0], pitch[0])
-    y = np.arange(bounds[0, 1] + pitch[1] / 2, bounds[1, 1], pitch[1])
-    z = np.arange(bounds[0, 2] + pitch[2] / 2, bounds[1, 2], pitch[2])
-
-    # create grid of all positions
-    X, Y, Z = np.meshgrid(x, y, z, indexing="ij")
-    all_pos = np.column_stack((X.ravel(), Y.ravel(), Z.ravel()))
-    voxel_shape = (len(x), len(y), len(z))
-    
-    # we need to reverse the order of the positions to match the order that
-    # PhotonLib expects. we'll also need to sort the pte values.
-    sorted_indices = np.lexsort((all_pos[:, 0], all_pos[:, 1], all_pos[:, 2]))
-    all_pos = all_pos[sorted_indices]
-
-    # 4. Fill lightmap grid with values, setting zero for missing values
-    voxel_shape = (len(x), len(y), len(z))
-    full_values = np.full(shape=(all_pos.shape[0], pte.shape[1]), fill_value=0, dtype=float)
-    starting_point = bbox_min + pitch / 2
-    indices = np.round((positions - starting_point) / pitch).astype(int)
-    linear_indices = np.ravel_multi_index(indices.T, voxel_shape)
-    full_values[linear_indices] = pte
-    full_values = full_values[sorted_indices]
-    logger.info(f"lightmap {100*len(positions)/len(all_pos):.1f}% filled with PTE values")
-
-    # 5. Create PhotonLib object
-    meta = VoxelMeta(shape=voxel_shape, ranges=bounds.T)
-    PhotonLib.save(output_path, full_values, meta)
+    shape = tuple(len(np.arange(bounds[0, i] + pitch[i] / 2, bounds[1, i], pitch[i])) for i in range(3))
+
+    # 4. Index of every position in the voxel order PhotonLib expects
+    starting_point = bounds[0] + pitch / 2
+    indices = np.round((positions - starting_point) / pitch).astype(np.int64)
+    voxels = indices[:, 0] + shape[0] * (indices[:, 1] + shape[1] * indices[:, 2])
+    logger.info(f"lightmap {100*len(positions)/np.prod(shape):.1f}% filled with PTE values")
+    return bounds, shape, voxels
+
+def write_plib(
+    output_path: str,
+    bounds: np.ndarray,
+    shape,
+    voxels: np.ndarray,
+    read,
+    n_channels: int,
+    block_size: int,
+    compression: str = "gzip",
+    contiguous: bool = False,
+):
+    """Writes a PhotonLib file block of channels by block of channels.
+
+    Parameters
+    ----------
+    bounds, shape, voxels :
+        The voxel grid, see `voxel_grid`.
+    read : callable
+        Returns the (n_positions, n_block) PTE of a slice of channels.
+    n_channels : int
+        The number of channels.
+    block_size : int
+        The max. number of channels held in memory at once. Rounded to a
+        multiple of the HDF5 chunk width.
+    compression : str, optional
+        HDF5 compression filter for `vis`, e.g. "gzip" (default) or "lzf", or
+        None for no compression.
+    contiguous : bool
+        Store `vis` unchunked and uncompressed, so that it can be memory-mapped.
+        Overrides `compression`.
+    """
+    if contiguous:
+        compression = None
+    n_voxels = int(np.prod(shape))
+    channel_chunk = min(n_channels, 64)
+    row_chunk = max(1, min(n_voxels, CHUNK_BYTES // (4 * channel_chunk)))
+    block_size = max(channel_chunk, block_size // channel_chunk * channel_chunk)
+
+    with h5py.File(output_path, "w") as out:
+        out.create_dataset("numvox", data=np.asarray(shape, dtype=np.int64))
+        out.create_dataset("min", data=bounds[0])
+        out.create_dataset("max", data=bounds[1])
+        vis = out.create_dataset(
+            "vis",
+            (n_voxels, n_channels),
+            dtype="f4",
+            chunks=None if contiguous else (row_chunk, channel_chunk),
+            compression=compression,
+        )
+
+        for start in range(0, n_channels, block_size):
+            stop = min(start + block_size, n_channels)
+            # voxels without a simulated position stay at zero
+            block = np.zeros((n_voxels, stop - start), dtype=np.float32)
+            block[voxels] = read(slice(start, stop))
+            vis[:, start:stop] = block
+            logger.info(f"wrote channels {start} to {stop - 1} of {n_channels}")
+
+def positions_to_plib(positions: np.ndarray, pte: np.ndarray, output_path: str):
+    """Places the per-position PTE on a regular voxel grid and saves it as a PhotonLib file."""
+    bounds, shape, voxels = voxel_grid(positions)
+    write_plib(output_path, bounds, shape, voxels, lambda channels: pte[:, channels], pte.shape[1], pte.shape[1])
 
 def plot_photonlib(plib_path):
     import trimesh
@@ -89,10 +236,23 @@ def main():
     parser.add_argument("positions", type=str, help="Path to photon library HDF5 file")
     parser.add_argument("output", type=str, help="Path to output PhotonLib file")
     parser.add_argument("--vis", action="store_true", help="Visualize the lightmap")    
+    parser.add_argument("--pitch", type=float, default=None, help="Voxel pitch in mm when resampling a coarse-to-fine scan")
+    parser.add_argument("--symmetry", type=str, default=None, help="Symmetry spec (yaml) to unfold the lightmap with, if not stored in the file")
+    parser.add_argument("--memory", type=float, default=MEMORY_BUDGET / 2**30, help="Approximate peak memory of the conversion in GiB")
+    parser.add_argument("--compression", type=str, default="gzip", help="HDF5 compression filter of the PhotonLib table, e.g. gzip or lzf, or none")
+    parser.add_argument("--contiguous", action="store_true", help="Store the table unchunked and uncompressed so that it can be memory-mapped")
     
     args = parser.parse_args()
 
-    h5_to_plib(args.positions, args.output)
+    h5_to_plib(
+        args.positions,
+        args.output,
+        pitch=args.pitch,
+        symmetry=args.symmetry,
+        memory_budget=int(args.memory * 2**30),
+        compression=None if args.compression.lower() == "none" else args.compression,
+        contiguous=args.contiguous,
+    )
     
     if args.vis:
         plot_photonlib(args.output)
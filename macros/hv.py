@@ -6,7 +6,6 @@ from typing import Generator
 
 import chroma
 import numpy as np
-import yaml
 from chroma.event import (
     Photons,
     SURFACE_DETECT,
@@ -19,7 +18,10 @@ from chroma.loader import load_bvh
 from chroma.sim import Simulation
 from tqdm import tqdm
 
+from generator.buffers import PhotonBufferPool, pool_size
+from generator.rng import RandomStreams
 from geometry.fiber import M114L01
+from geometry.fiberbase import FiberArray
 from geometry.builder import build_detector_from_yaml
 from utils.output import H5Logger, print_table
 
@@ -32,8 +34,9 @@ def __configure__(db):
     """Modify fields in the database here"""
 
     db.n_photons_per_fiber = 100_000
+    db.batch_size = 100_000                # photons of all fibers per event
     db.fiber = M114L01
-    db.seed = None
+    db.seed = None                         # run seed of the per-batch random streams (logged if None)
     db.config_file = (
         "/home/sam/sw/chroma-lxe/geometry/config/ea-hv_4_fibers_100mm_extended.yaml"
     )
@@ -61,39 +64,29 @@ def __define_geometry__(db):
 
 def __event_generator__(db) -> Generator[Photons, None, None]:
     """A generator to yield chroma Events"""
-    posdir = yaml.safe_load(open(db.fiber_positions_file, "r"))
-    fibers = [
-        db.fiber(
-            position=posdir[f"fiber_{i}"]["position"],
-            direction=posdir[f"fiber_{i}"]["direction"],
-        )
-        for i in range(4)
-    ]
-    for i in range(4):
-        np.set_printoptions(precision=3)
-        # print(fibers[i].rotation_matrix)
-    
-    batch_size = 100_000
+    fibers = db.fibers
+    batch_size = db.batch_size
     total_photons = db.n_photons_per_fiber * len(fibers)
+    # all fibers of a batch are sampled together into one pooled buffer
+    pool = PhotonBufferPool(batch_size, size=pool_size(db.chroma_photons_per_batch, batch_size))
+    streams = RandomStreams(db.seed)
     
+    event = 0
     while total_photons > 0:
         current_batch = min(batch_size, total_photons)
         photons_per_fiber = current_batch // len(fibers)
         remainder = current_batch % len(fibers)
         
-        batch = Photons()
-        for i, fiber in enumerate(fibers):
-            fiber_photons = photons_per_fiber + (1 if i < remainder else 0)
-            if fiber_photons > 0:
-                batch += fiber.generate_photons(fiber_photons)
-                print('actual direction\n', fiber.direction)
-        yield batch
+        counts = photons_per_fiber + (np.arange(len(fibers)) < remainder)
+        yield fibers.generate_photons(counts, out=pool.get(current_batch), rng=streams.stream(event))
         total_photons -= current_batch
+        event += 1
 
 def __simulation_start__(db):
     """Called at the start of the event loop"""
-    total_photons = db.n_photons_per_fiber * 4
-    db.num_events = np.ceil(total_photons / 100_000)
+    db.fibers = FiberArray.from_yaml(db.fiber_positions_file, db.fiber)
+    total_photons = db.n_photons_per_fiber * len(db.fibers)
+    db.num_events = np.ceil(total_photons / db.batch_size)
     db.start_time = time.time()
     db.total_detected = 0
     db.total_photons = 0
@@ -1,10 +1,12 @@
 import argparse
-import math
+import os
 import sys
 import time
+from collections import deque
 from typing import List, Tuple
 
 import chroma
+import h5py
 import numpy as np
 from chroma.event import Photons
 from chroma.loader import load_bvh
@@ -12,27 +14,60 @@ from chroma.sample import uniform_sphere
 from chroma.sim import Simulation
 from tqdm import tqdm
 
-from geometry.builder import build_detector_from_yaml
-from generator.photons import create_photon_bomb
+from geometry.builder import build_detector_from_yaml, geometry_key, load_config_from_yaml
+from generator.buffers import PhotonBufferPool, pool_size
+from generator.photons import create_photon_bomb, create_photon_bombs, max_time_tags, source_index
+from generator.rng import RandomStreams
+from lightmap.adaptive import AdaptiveBudget
+from lightmap.io import LightmapFile
+from lightmap.refine import RefinementGrid
+from lightmap.sharding import ShardManifest, file_md5, range_path, shard_path, shard_range
+from lightmap.symmetry import SymmetryGroup, compare_unfolded
 from utils.log import logger
-from utils.output import H5Logger, print_table
+from utils.output import AsyncWriter, H5Logger, MatrixH5Logger, print_table
+from utils.tally import ChannelTally
 
 
 def __configure__(db):
     """Modify fields in the database here"""
-    db.seed = None
+    db.seed = None                         # run seed of the per-position random streams (logged and stored in the output if None)
     db.dry = False
     db.n_photons = 100_000
     db.single_channel = False
     db.output_file = "test.h5"
+    db.output_flush_size = 1024
+    db.output_layout = "columns"           # "columns" (two datasets per channel) or "matrix"
+    db.output_dtype = "i4"                 # dtype of the per-channel counts in the matrix layout
+    db.output_compression = None           # e.g. "gzip" or "lzf" in the matrix layout
+    db.output_async = False                # write output on a background thread
+    db.output_queue_size = 64              # max. number of pending rows for the background writer
     db.wavelength = 175
+    db.pack_size = 1                       # number of positions simulated per chroma event
+    db.pack_time_offset = 2.0**20          # ns between packed positions (~1 ms, exact in float32), must exceed any photon's travel time
+    db.max_travel_time = 1e4               # ns, bound on a photon's travel time used to check pack_size
+    db.generator_workers = 1               # threads generating the photons of packed positions
+    db.adaptive = False                    # simulate each position in increments of n_photons until...
+    db.adaptive_target = 0.01              # ...the relative binomial error of the PTE is below this...
+    db.adaptive_metric = "total"           # ...for the "total" or the "max_channel" PTE...
+    db.adaptive_max_photons = 1_000_000    # ...or this many photons have been simulated
+    db.refine = False                      # coarse-to-fine scan instead of the positions file
+    db.refine_bounds = None                # (2, 3) scanned volume, defaults to the bounding box of the positions file
+    db.refine_pitch = 10.0                 # coarse grid pitch in mm
+    db.refine_levels = 2                   # max. number of subdivisions of a coarse cell
+    db.refine_tolerance = 0.05             # max. relative interpolation error at a cell center
+    db.symmetry_file = None                # yaml symmetry spec, only positions in the fundamental domain are simulated
+    db.symmetry_validate = 0               # number of other positions simulated directly to check the symmetry
+    db.shard_index = None                  # simulate only this shard of the positions...
+    db.num_shards = 1                      # ...split evenly into this many shards...
+    db.position_range = None               # ...or only the positions [start, stop)
+    db.resume = False                      # continue an interrupted scan from the positions in output_file
     db.positions_path = (
         "/home/sam/sw/chroma-lxe/data/lightmap_points_2.5mm_orthofill.npy"
     )
     db.config_file = "/home/sam/sw/chroma-lxe/geometry/config/detector.yaml"
     
     db.chroma_g4_processes = 0
-    db.chroma_keep_hits = not db.single_channel
+    db.chroma_keep_hits = False                # per-channel counts come from the flat hits
     db.chroma_keep_flat_hits = True
     db.chroma_photon_tracking = db.dry
     db.chroma_daq = db.dry
@@ -49,29 +84,179 @@ def __define_geometry__(db):
 def __event_generator__(db):
     """A generator to yield chroma Events (or something a chroma Simulation can
     convert to a chroma Event)."""
-    yield from (
-        create_photon_bomb(db.n_photons, db.wavelength, position)
-        for position in db.photon_positions
-    )
+    n_positions = len(db.photon_positions)
+    if db.refine:
+        # the next points depend on the results of the previous ones. with one
+        # event per chroma batch (checked in __simulation_start__), they have all
+        # been processed by the time the generator is resumed
+        new = db.grid.refine()
+        while len(new):
+            db.photon_positions = db.grid.positions
+            for i in new:
+                yield create_photon_bomb(
+                    db.n_photons, db.wavelength, db.photon_positions[i], rng=position_rng(db, i), out=db.pool.get(db.n_photons)
+                )
+            new = db.grid.refine()
+    elif db.adaptive:
+        # keep simulating a position until __process_event__ has written it. every
+        # event is tagged with its position so that increments generated ahead of
+        # that decision are not attributed to the next position. no position
+        # needs more than `max_increments`, at which the budget is exhausted
+        for i in range(db.first_position, n_positions):
+            rng = position_rng(db, i)
+            for _ in range(db.max_increments):
+                if db.event_idx != i:
+                    break
+                db.pending.append(i)
+                yield create_photon_bomb(
+                    db.n_photons, db.wavelength, db.photon_positions[i], rng=rng, out=db.pool.get(db.n_photons)
+                )
+    elif db.pack_size == 1:
+        yield from (
+            create_photon_bomb(
+                db.n_photons, db.wavelength, db.photon_positions[i], rng=position_rng(db, i), out=db.pool.get(db.n_photons)
+            )
+            for i in range(db.first_position, n_positions)
+        )
+    else:
+        yield from (
+            create_photon_bombs(
+                db.n_photons,
+                db.wavelength,
+                db.photon_positions[i : i + db.pack_size],
+                db.pack_time_offset,
+                rngs=[position_rng(db, j) for j in range(i, min(i + db.pack_size, n_positions))],
+                out=db.pool.get(db.n_photons * db.pack_size),
+                workers=db.generator_workers,
+            )
+            for i in range(db.first_position, n_positions, db.pack_size)
+        )
+
+def start_streams(db):
+    """Seeds the per-position random streams. A resumed scan continues with the
+    seed stored in its output file unless `seed` is given. `db.seed` is set to
+    the run seed, which is stored in the output file (as a string, since fresh
+    entropy does not fit an HDF5 integer)."""
+    seed = db.seed
+    if db.resume and os.path.exists(db.output_file):
+        with h5py.File(db.output_file, "r") as f:
+            stored = f.attrs.get("seed")
+        if stored is None:
+            logger.warning(f"{db.output_file} has no seed, the resumed positions use new random streams")
+        elif seed is None:
+            seed = int(stored)
+        elif seed != int(stored):
+            raise ValueError(f"cannot resume {db.output_file} with seed {seed}, it was started with seed {stored}")
+    db.streams = RandomStreams(seed)
+    db.seed = db.streams.seed
+
+def position_rng(db, i):
+    """The generator for the photons of position `i`. Every position gets its own
+    stream so that a resumed, sharded or packed scan with the same seed draws the
+    same photons as an uninterrupted one."""
+    return db.streams.stream(db.position_offset + i)
 
 
 def __simulation_start__(db):
     """Called at the start of the event loop"""
-    db.photon_positions = np.load(db.positions_path)[:100]
-    db.num_events = len(db.photon_positions)
+    db.photon_positions = np.load(db.positions_path)
     db.n_channels = db.geometry.num_channels()
+    db.sharded = db.shard_index is not None or db.position_range is not None
+    if not db.sharded:
+        # before folding, which picks the validation positions with the seed
+        start_streams(db)
+    if db.symmetry_file is not None:
+        if db.refine:
+            raise ValueError("coarse-to-fine scans do not support symmetry folding")
+        fold_positions(db)
+    db.position_offset = 0
+    if db.sharded:
+        start_shard(db)
+        start_streams(db)
+    if db.refine:
+        if db.adaptive or db.pack_size > 1:
+            raise ValueError("coarse-to-fine scans do not support adaptive budgets or packed events")
+        if db.resume:
+            raise ValueError("coarse-to-fine scans cannot be resumed")
+        if db.chroma_photons_per_batch > db.n_photons:
+            # chroma would pull the points of the next level before recording the last ones
+            raise ValueError(
+                "coarse-to-fine scans need one event per chroma batch, set "
+                f"chroma_photons_per_batch ({db.chroma_photons_per_batch}) to at most n_photons ({db.n_photons})"
+            )
+        bounds = db.refine_bounds
+        if bounds is None:
+            bounds = [db.photon_positions.min(axis=0), db.photon_positions.max(axis=0)]
+        db.grid = RefinementGrid(bounds, db.refine_pitch, db.refine_levels, db.refine_tolerance)
+        db.photon_positions = db.grid.positions
+    elif db.adaptive:
+        if db.pack_size > 1:
+            raise ValueError("adaptive photon budgets do not support packed events")
+        if db.chroma_photons_per_batch > db.n_photons:
+            # chroma pulls events until a batch is full, so the generator would
+            # run several increments ahead of the budget and most would be discarded
+            raise ValueError(
+                "adaptive photon budgets need one event per chroma batch, set "
+                f"chroma_photons_per_batch ({db.chroma_photons_per_batch}) to at most n_photons ({db.n_photons})"
+            )
+        db.max_increments = max(1, int(np.ceil(db.adaptive_max_photons / db.n_photons)))
+        db.budget = AdaptiveBudget(
+            db.n_channels,
+            db.adaptive_target,
+            db.adaptive_max_photons,
+            min_photons=db.n_photons,
+            metric=db.adaptive_metric,
+        )
+        db.pending = deque()
+        db.budget_time = 0
+    if db.pack_size > 1:
+        # hits are traced back to their positions through float32 times
+        max_pack = max_time_tags(db.pack_time_offset, db.max_travel_time, db.chroma_max_steps)
+        if db.pack_size > max_pack:
+            raise ValueError(
+                f"pack_size {db.pack_size} exceeds the {max_pack} positions that can be time tagged "
+                f"{db.pack_time_offset} ns apart, lower it or use a power of two as pack_time_offset"
+            )
     
+    db.tally = ChannelTally(db.n_channels)
+    # photons are generated into reused buffers instead of fresh arrays per event
+    event_photons = db.n_photons * db.pack_size
+    db.pool = PhotonBufferPool(event_photons, size=pool_size(db.chroma_photons_per_batch, event_photons))
+
     # create variable labels
-    variables = ["posX", "posY", "posZ", "n", "detected", "pte"]
-    if not db.single_channel:
-        zfill_width = int(math.log10(db.n_channels)) + 1
-        for i in range(db.n_channels):
-            channel_id = str(i).zfill(zfill_width)
-            variables += [f"ch{channel_id}_detected", f"ch{channel_id}_pte"]
-    variables += ["time_spent"]
-    db.writer = H5Logger(db.output_file, variables)
-
-    db.event_idx = 0
+    if db.output_layout == "matrix":
+        if db.single_channel:
+            raise ValueError("the matrix output layout requires per-channel hits")
+        variables = ["posX", "posY", "posZ", "n", "time_spent"]
+        db.writer = MatrixH5Logger(
+            db.output_file,
+            variables,
+            db.n_channels,
+            dtype=db.output_dtype,
+            compression=db.output_compression,
+            flush_size=db.output_flush_size,
+            resume=db.resume,
+        )
+    else:
+        db.scalar_variables = ["posX", "posY", "posZ", "n", "detected", "pte"]
+        variables = list(db.scalar_variables)
+        if not db.single_channel:
+            variables += db.tally.column_names
+        variables += ["time_spent"]
+        db.writer = H5Logger(db.output_file, variables, flush_size=db.output_flush_size, resume=db.resume)
+    db.writer.f.attrs["seed"] = str(db.seed)
+    db.first_position = resume_position(db) if db.resume else 0
+    if db.adaptive:
+        # an upper bound, positions that reach the target early take fewer events
+        db.num_events = (len(db.photon_positions) - db.first_position) * db.max_increments
+    elif not db.refine:
+        db.num_events = int(np.ceil((len(db.photon_positions) - db.first_position) / db.pack_size))
+    if db.output_async:
+        db.writer = AsyncWriter(db.writer, maxsize=db.output_queue_size)
+
+    db.event_idx = db.first_position
+    db.n_written = 0
+    db.total_photons = 0
     db.total_detected = 0
     db.total_pte = 0
     db.total_time = 0
@@ -79,51 +264,185 @@ def __simulation_start__(db):
 
 def __process_event__(db, ev):
     """Called for each generated event"""
+    ev_time = time.time() - db.start_time
+    hits = ev.flat_hits
+
+    # an event holds `pack_size` positions (fewer for the last one), whose hits
+    # are told apart by their time
+    n_sources = max(1, min(db.pack_size, len(db.photon_positions) - db.event_idx))
+    if n_sources > 1:
+        sources = source_index(hits.t, db.pack_time_offset)
+    else:
+        sources = np.zeros(len(hits), dtype=np.intp)
+    channel_detected = db.tally.count_sources(hits.channel, sources, n_sources)
+
+    if db.adaptive:
+        if db.pending.popleft() == db.event_idx:
+            db.budget.add(channel_detected[0], db.n_photons)
+            db.budget_time += ev_time
+            if db.budget.done:
+                write_position(db, db.budget.counts, db.budget_time, db.budget.n)
+                db.budget.reset()
+                db.budget_time = 0
+    else:
+        for counts in channel_detected:
+            if db.refine:
+                db.grid.record(db.event_idx, counts / db.n_photons)
+            write_position(db, counts, ev_time / n_sources, db.n_photons)
+
+    db.start_time += ev_time
+    db.total_time += ev_time
+
+def fold_positions(db):
+    """Replaces the positions by their representatives in the fundamental domain
+    of the detector's symmetry group, followed by `symmetry_validate` positions
+    to simulate directly for comparison"""
+    db.symmetry = SymmetryGroup.from_yaml(db.symmetry_file, n_channels=db.n_channels)
+    full_positions = db.photon_positions
+    db.photon_positions = db.symmetry.fold(full_positions)
+    db.n_folded = len(db.photon_positions)
+    logger.info(
+        f"simulating {db.n_folded} of {len(full_positions)} positions using a "
+        f"{len(db.symmetry)}-element symmetry group"
+    )
+
+    # only positions that are images of a representative test the unfolding
+    _, element_idx = db.symmetry.locate(db.photon_positions, full_positions)
+    candidates = np.flatnonzero(element_idx != 0)
+    rng = np.random.default_rng(db.seed)
+    n_check = min(db.symmetry_validate, len(candidates))
+    check = rng.choice(candidates, size=n_check, replace=False)
+    db.photon_positions = np.concatenate((db.photon_positions, full_positions[check]))
+    db.validation_rows = []
+
+def start_shard(db):
+    """Restricts the scan to one shard of the positions and writes its manifest"""
+    if db.refine:
+        raise ValueError("coarse-to-fine scans cannot be sharded")
+    if db.symmetry_file is not None and db.symmetry_validate:
+        raise ValueError("symmetry validation is not supported in sharded scans")
+
+    n_positions = len(db.photon_positions)
+    if db.position_range is not None:
+        start, stop = db.position_range
+        if not 0 <= start < stop <= n_positions:
+            raise ValueError(f"position range [{start}, {stop}) is not within [0, {n_positions})")
+        db.output_file = range_path(db.output_file, start, stop)
+    else:
+        start, stop = shard_range(n_positions, db.shard_index, db.num_shards)
+        db.output_file = shard_path(db.output_file, db.shard_index)
+    db.photon_positions = db.photon_positions[start:stop]
+    db.position_offset = start
+    logger.info(f"simulating positions [{start}, {stop}) of {n_positions} into {db.output_file}")
+
+    db.manifest = ShardManifest(
+        output_file=os.path.basename(db.output_file),
+        start=start,
+        stop=stop,
+        n_positions=n_positions,
+        geometry_hash=geometry_key(load_config_from_yaml(db.config_file)),
+        positions_hash=file_md5(db.positions_path),
+        positions_path=os.path.abspath(db.positions_path),
+        folded=db.symmetry_file is not None,
+        shard_index=db.shard_index,
+        num_shards=db.num_shards if db.position_range is None else None,
+    )
+    db.manifest.save(ShardManifest.path_for(db.output_file))
+
+def resume_position(db):
+    """Checks the rows already in the output file against the positions and
+    returns the index of the first position left to simulate"""
+    n_done = db.writer.n_resumed
+    if n_done > len(db.photon_positions):
+        raise ValueError(f"{db.output_file} has more rows than there are positions to simulate")
+    written = np.column_stack([db.writer.f[k][:n_done] for k in ("posX", "posY", "posZ")])
+    if not np.allclose(written, db.photon_positions[:n_done], atol=1e-3):
+        raise ValueError(f"the positions in {db.output_file} do not match {db.positions_path}")
+    logger.info(f"resuming at position {n_done} of {len(db.photon_positions)}")
+    return n_done
+
+def validate_symmetry(db):
+    """Compares the directly simulated validation positions to the values
+    unfolded from the fundamental domain"""
+    with LightmapFile(db.output_file) as f:
+        rep_positions = f.positions
+        rep_pte = f.pte()
+        rep_n = f.n
+    check_positions = db.photon_positions[db.n_folded:]
+    rep_idx, _ = db.symmetry.locate(rep_positions, check_positions)
+    pte_pred = db.symmetry.lookup(rep_positions, rep_pte, check_positions)
+    pte_direct = np.array([pte for pte, _ in db.validation_rows])
+    n_direct = np.array([n for _, n in db.validation_rows])
+    print_table(**compare_unfolded(pte_pred, rep_n[rep_idx], pte_direct, n_direct))
+
+def write_position(db, channel_detected, time_spent, n_photons):
+    """Writes the row of the next position given its per-channel counts"""
+    if db.symmetry_file is not None and db.event_idx >= db.n_folded:
+        # validation positions are only kept for the comparison at the end
+        db.validation_rows.append((channel_detected / n_photons, n_photons))
+        db.event_idx += 1
+        return
+
     output = {}
     position = db.photon_positions[db.event_idx]
     output["posX"] = position[0]
     output["posY"] = position[1]
     output["posZ"] = position[2]
-    output["n"] = db.n_photons
+    output["n"] = n_photons
 
-    detected = len(ev.flat_hits)
+    detected = channel_detected.sum()
     output["detected"] = detected
-    output["pte"] = detected / db.n_photons
+    output["pte"] = detected / n_photons
+    output["time_spent"] = time_spent
 
-    if not db.single_channel:
-        zfill_width = int(math.log10(db.n_channels)) + 1
-        for c in range(db.n_channels):
-            channel_id = str(c).zfill(zfill_width)
-            hits = ev.hits
-            channel_detected = len(hits.get(c, []))
-            output[f"ch{channel_id}_detected"] = channel_detected
-            output[f"ch{channel_id}_pte"] = channel_detected / db.n_photons
-
-    ev_time = time.time() - db.start_time
-    output["time_spent"] = ev_time
-    db.writer.write(**output)
+    if db.output_layout == "matrix":
+        db.writer.write_row([output[var] for var in db.writer.variables], channel_detected)
+    elif db.single_channel:
+        db.writer.write(**output)
+    else:
+        row = [output[var] for var in db.scalar_variables]
+        db.writer.write_row(np.concatenate((row, db.tally.columns(channel_detected, n_photons), [time_spent])))
 
+    db.n_written += 1
+    db.total_photons += n_photons
     db.total_detected += output["detected"]
     db.total_pte += output["pte"]
-    db.start_time += ev_time
-    db.total_time += ev_time
     db.event_idx += 1
 
 def __simulation_end__(db):
     """Called at the end of the event loop"""
     db.writer.close()
 
-    n_positions = len(db.photon_positions)
+    if db.refine:
+        # store what is needed to resample the scan onto a uniform grid
+        with h5py.File(db.output_file, "a") as f:
+            f.attrs.update(db.grid.attrs)
+            f.create_dataset("refine_cells", data=np.array(db.grid.refined_cells, dtype=np.int64).reshape(-1, 4))
+
+    if db.symmetry_file is not None:
+        # store the spec so that h5_to_plib can unfold the lightmap
+        with h5py.File(db.output_file, "a") as f:
+            with open(db.symmetry_file) as spec:
+                f.attrs["symmetry"] = spec.read()
+            f.attrs["symmetry_dir"] = os.path.dirname(os.path.abspath(db.symmetry_file))
+        if db.validation_rows:
+            validate_symmetry(db)
+
+    if db.sharded:
+        db.manifest.complete = True
+        db.manifest.save(ShardManifest.path_for(db.output_file))
+
+    n_positions = db.n_written
     results = dict(
         output_path=db.output_file,
         n_positions=n_positions,
-        n_photons_per_position=db.n_photons,
+        n_photons_per_position=db.total_photons / n_positions,
         n_detected=db.total_detected,
         n_detected_per_position=db.total_detected / n_positions,
         avg_pte_per_position=db.total_pte / n_positions,
         total_time=db.total_time,
         sec_per_position=db.total_time / n_positions,
         positions_per_sec=n_positions / db.total_time,
-        photons_per_sec=n_positions * db.n_photons / db.total_time,
+        photons_per_sec=db.total_photons / db.total_time,
     )
     print_table(**results)
\ No newline at end of file
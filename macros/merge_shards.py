@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+from lightmap.sharding import check_shards, merge_shards
+from utils.log import logger
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Merge the shards of a lightmap scan into one file")
+    parser.add_argument("manifests", type=str, nargs="+", help="Paths to the JSON manifests of the shards")
+    parser.add_argument("-o", "--output", type=str, required=True, help="Path to the merged lightmap HDF5 file")
+    parser.add_argument("--plib", type=str, default=None, help="Also convert the merged lightmap to this PhotonLib file")
+    parser.add_argument("--check", action="store_true", help="Only verify the shards, do not merge them")
+
+    args = parser.parse_args()
+
+    if args.check:
+        shards = check_shards(args.manifests)
+        logger.info(f"{len(shards)} shards cover all {shards[0][0].n_positions} positions")
+        return
+
+    merge_shards(args.manifests, args.output)
+    logger.info(f"merged {len(args.manifests)} shards into {args.output}")
+
+    if args.plib is not None:
+        from macros.h5_to_plib import h5_to_plib
+
+        h5_to_plib(args.output, args.plib)
+
+if __name__ == "__main__":
+    main()
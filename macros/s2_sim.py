@@ -1,10 +1,16 @@
 from timeit import default_timer as timer
 
+import h5py
 import numpy as np
-from chroma.event import *
-from generator.photons import create_photon_bomb, create_electroluminescence_photons, create_multisite_electroluminescence_photons
-from geometry.builder import build_detector_from_yaml
-from utils.output import H5Logger, print_table
+from generator.buffers import PhotonBufferPool, pool_size
+from generator.photons import create_photon_bomb, create_electroluminescence_photons, create_event_photons, \
+                              create_multisite_electroluminescence_photons, max_time_tags, source_index
+from generator.profile import ELProfile
+from generator.rng import RandomStreams
+from generator.sites import batch_events, event_bounds, load_sites
+from lightmap.fastsim import FastS2Sim, split_photons
+from utils.output import AsyncWriter, H5Logger, MatrixH5Logger, print_table
+from utils.tally import ChannelTally
 import time
 
 
@@ -25,7 +31,7 @@ def __configure__(db):
     """Modify fields in the database here"""
 
     db.chroma_g4_processes = 0
-    db.chroma_keep_hits = True
+    db.chroma_keep_hits = False                # per-channel counts come from the flat hits
     db.chroma_keep_flat_hits = True
     db.chroma_photon_tracking = False          # saves photons at each step of propagation
     db.chroma_particle_tracking = False        # saves particles at each step of propagation (e-, ...)
@@ -37,22 +43,50 @@ def __configure__(db):
 
     db.positions_path = "/home/clarke/chroma-lxe/data/XeNu_LXe_surface_points.npy"
     db.positions_path_2 = "/home/clarke/chroma-lxe/data/XeNu_LXe_surface_points_site2.npy"
+    db.sites_file = None                   # site table of events with any number of sites (see generator/sites.py), replaces the position files
+    db.photons_per_kev = None              # converts the site energies of a site table to photons
+    db.batch_photons = 10_000_000          # max. photons of the site-table events simulated together
+    db.site_time_offset = 2.0**20          # ns between the sites of a batch (~1 ms, exact in float32), must exceed any photon's travel time
+    db.max_travel_time = 1e4               # ns, bound on a photon's travel time used to cap the sites per batch
     db.extraction_height = 6.5 # mm
+    db.el_profile = "uniform"              # longitudinal EL yield: "uniform", "linear" or "table"
+    db.el_gradient = 0.0                   # relative yield increase from bottom to top of the "linear" profile
+    db.el_profile_table = None             # .npy file with (n, 2) heights and yields of the "table" profile
+    db.el_diffusion = 0.0                  # transverse smearing of the emission points in mm
     db.wavelength = 175
     db.single_site = False
     pmts = False
     db.sensors = 'PMTs' if pmts else 'SiPMs'
     db.output_file = "s2_sim_test_" + db.sensors + ["_m","_s"][int(db.single_site)] + "s.h5"
+    db.output_flush_size = 1024
+    db.output_layout = "columns"           # "columns" (two datasets per channel) or "matrix"
+    db.output_dtype = "i4"                 # dtype of the per-channel counts in the matrix layout
+    db.output_compression = None           # e.g. "gzip" or "lzf" in the matrix layout
+    db.output_async = False                # write output on a background thread
+    db.output_queue_size = 64              # max. number of pending rows for the background writer
 
     db.config_file = "/home/clarke/chroma-lxe/geometry/config/XeNu_" + db.sensors + ".yaml"
     db.num_events = 10_000
     db.n_photons = 50_000
     db.notify_event = 10
     db.single_channel = False
+    db.seed = None                         # run seed of the per-event random streams (logged if None)
+    db.generator_workers = 1               # threads generating the photons of the sites of a batch
+    db.fast_lightmap = None                # PhotonLib lightmap to sample counts from instead of propagating photons
+    db.fast_n_z = 16                       # number of lightmap samples along the EL column
+    db.fast_statistics = "multinomial"     # "multinomial" (fixed photon count) or "poisson"
+    db.fast_batch_size = 1000              # events sampled at once
 
 
 def __define_geometry__(db):
     """Returns a chroma Detector or Geometry"""
+    if db.fast_lightmap is not None:
+        # no photons are propagated, pyrat passes the sampled counts straight to __process_event__
+        db.geometry = None
+        return None
+    # imported here so that the fast simulation runs without the GPU stack
+    from geometry.builder import build_detector_from_yaml
+
     geometry = build_detector_from_yaml(db.config_file, flat=True)
     db.geometry = geometry
     return geometry
@@ -60,16 +94,38 @@ def __define_geometry__(db):
 def __event_generator__(db):
     """A generator to yield chroma Events (or something a chroma Simulation can
     convert to a chroma Event)."""
-    if db.single_site:
+    if db.sites_file is not None:
+        # yields all photons (or the per-channel counts of all events) of each batch
+        for batch in db.batches:
+            if db.fast_lightmap is not None:
+                yield db.fast_sim.sample_sites(db.sites[batch])
+            else:
+                sites = db.sites[batch]
+                yield create_event_photons(sites, db.wavelength, db.extraction_height, db.site_time_offset, \
+                                           profile=db.profile, diffusion=db.el_diffusion, out=db.pool.get(sites["n"].sum()), \
+                                           streams=db.streams, workers=db.generator_workers)
+    elif db.fast_lightmap is not None:
+        # yields the per-channel counts of each event
+        sites = db.photon_positions[:, None]
+        if not db.single_site:
+            sites = np.stack((db.photon_positions, db.photon_positions_2), axis=1)
+        n_photons = split_photons(db.n_photons, sites.shape[1])
+        for i in range(0, len(sites), db.fast_batch_size):
+            yield from db.fast_sim.sample(sites[i : i + db.fast_batch_size], n_photons)
+    elif db.single_site:
         yield from (
             create_electroluminescence_photons(n=db.n_photons, wavelength=db.wavelength, pos=position, \
-                                               height=db.extraction_height) for position in db.photon_positions
+                                               height=db.extraction_height, profile=db.profile, \
+                                               diffusion=db.el_diffusion, out=db.pool.get(db.n_photons), \
+                                               rng=db.streams.stream(i)) for i, position in enumerate(db.photon_positions)
         )
     else:
         yield from (
             create_multisite_electroluminescence_photons(n=db.n_photons, wavelength=db.wavelength, pos_1=position, \
-                                                         pos_2=position_2, height=db.extraction_height) for position, position_2 \
-                                                         in zip(db.photon_positions, db.photon_positions_2)
+                                                         pos_2=position_2, height=db.extraction_height, profile=db.profile, \
+                                                         diffusion=db.el_diffusion, out=db.pool.get(db.n_photons), \
+                                                         rngs=db.streams.streams(i, 2)) for i, (position, position_2) \
+                                                         in enumerate(zip(db.photon_positions, db.photon_positions_2))
         )
 
 
@@ -78,32 +134,102 @@ def __simulation_start__(db):
     db.ev_idx = 0
     db.t_sim_start = timer()
 
-    db.photon_positions = np.load(db.positions_path)[:db.num_events]
-    db.num_events = len(db.photon_positions)
-    db.n_channels = db.geometry.num_channels()
-    db.photon_positions_2 = np.load(db.positions_path_2)[:db.num_events]
+    if db.sites_file is not None:
+        load_events(db)
+    else:
+        db.photon_positions = np.load(db.positions_path)[:db.num_events]
+        db.num_events = len(db.photon_positions)
+        db.photon_positions_2 = np.load(db.positions_path_2)[:db.num_events]
+    db.streams = RandomStreams(db.seed)
+    db.profile = ELProfile.from_config(db.extraction_height, db.el_profile, db.el_gradient, db.el_profile_table)
+    if db.fast_lightmap is not None:
+        db.fast_sim = FastS2Sim(
+            db.fast_lightmap,
+            db.extraction_height,
+            n_z=db.fast_n_z,
+            statistics=db.fast_statistics,
+            seed=db.seed,
+            profile=db.profile,
+        )
+        db.n_channels = db.fast_sim.n_channels
+    else:
+        db.n_channels = db.geometry.num_channels()
+        # photons are generated into reused buffers instead of fresh arrays per event
+        event_photons = queued_photons = db.n_photons
+        if db.sites_file is not None:
+            # sized from the actual batches, not the batch_photons limit. all but
+            # the last batch are about as large, so they set how many chroma queues
+            batch_photons = [int(db.sites["n"][batch].sum()) for batch in db.batches] or [0]
+            event_photons = max(batch_photons)
+            queued_photons = min(batch_photons[:-1] or batch_photons)
+        db.pool = PhotonBufferPool(event_photons, size=pool_size(db.chroma_photons_per_batch, queued_photons))
     
+    db.tally = ChannelTally(db.n_channels)
+
     # create variable labels
-    variables = ["posX", "posY", "posZ", "n", "detected", "pte"]
-    if not db.single_site:
-        variables += ["posX_2", "posY_2", "posZ_2"]
-    if not db.single_channel:
-        zfill_width = int(np.log10(db.n_channels)) + 1
-        for i in range(db.n_channels):
-            channel_id = str(i).zfill(zfill_width)
-            variables += [f"ch{channel_id}_detected", f"ch{channel_id}_pte"]
-    variables += ["time_spent"]
-    db.writer = H5Logger(db.output_file, variables)
+    if db.output_layout == "matrix":
+        if db.single_channel:
+            raise ValueError("the matrix output layout requires per-channel hits")
+        variables = ["posX", "posY", "posZ", "n"]
+        if db.sites_file is not None:
+            variables = ["n_sites"] + variables
+        elif not db.single_site:
+            variables += ["posX_2", "posY_2", "posZ_2"]
+        variables += ["time_spent"]
+        db.writer = MatrixH5Logger(
+            db.output_file,
+            variables,
+            db.n_channels,
+            dtype=db.output_dtype,
+            compression=db.output_compression,
+            flush_size=db.output_flush_size,
+        )
+    else:
+        db.scalar_variables = ["posX", "posY", "posZ", "n", "detected", "pte"]
+        if db.sites_file is not None:
+            db.scalar_variables = ["n_sites"] + db.scalar_variables
+        elif not db.single_site:
+            db.scalar_variables += ["posX_2", "posY_2", "posZ_2"]
+        variables = list(db.scalar_variables)
+        if not db.single_channel:
+            variables += db.tally.column_names
+        variables += ["time_spent"]
+        db.writer = H5Logger(db.output_file, variables, flush_size=db.output_flush_size)
+    if db.output_async:
+        db.writer = AsyncWriter(db.writer, maxsize=db.output_queue_size)
 
     db.event_idx = 0
     db.total_detected = 0
+    db.total_photons = 0
     db.total_pte = 0
     db.total_time = 0
     db.start_time = time.time()
 
 
+def load_events(db):
+    """Loads the first `num_events` events of the site table and splits them
+    into batches that are simulated together"""
+    sites = load_sites(db.sites_file, db.photons_per_kev)
+    bounds = event_bounds(sites)
+    db.sites = sites[: bounds[min(db.num_events, len(bounds) - 1)]]
+    starts = event_bounds(db.sites)[:-1]
+    # the first site of each event stands for it in the position columns
+    db.photon_positions = db.sites["pos"][starts]
+    max_sites = None
+    if db.fast_lightmap is None:
+        # hits are traced back to their sites through float32 times, which caps the sites per batch
+        max_sites = max_time_tags(db.site_time_offset, db.max_travel_time, db.chroma_max_steps)
+    db.batches = batch_events(db.sites, db.batch_photons, max_sites)
+    db.batch_idx = 0
+    db.num_events = len(db.batches)
+
+
 def __process_event__(db, ev):
     """Called for each generated event"""
+    if db.sites_file is not None:
+        process_batch(db, ev)
+        return
+
     output = {}
     position = db.photon_positions[db.event_idx]
     output["posX"] = position[0]
@@ -117,45 +243,87 @@ def __process_event__(db, ev):
         output["posY_2"] = position2[1]
         output["posZ_2"] = position2[2]
 
-    detected = len(ev.flat_hits)
-    output["detected"] = detected
-    output["pte"] = detected / db.n_photons
-
-    if not db.single_channel:
-        zfill_width = int(np.log10(db.n_channels)) + 1
-        for c in range(db.n_channels):
-            channel_id = str(c).zfill(zfill_width)
-            hits = ev.hits
-            channel_detected = len(hits.get(c, []))
-            output[f"ch{channel_id}_detected"] = channel_detected
-            output[f"ch{channel_id}_pte"] = channel_detected / db.n_photons
+    if db.fast_lightmap is not None:
+        channel_detected = ev
+    elif db.single_channel:
+        channel_detected = None
+        output["detected"] = len(ev.flat_hits)
+    else:
+        channel_detected = db.tally.count(ev)
 
     ev_time = time.time() - db.start_time
     output["time_spent"] = ev_time
-    db.writer.write(**output)
+    write_event(db, output, channel_detected)
+    db.start_time += ev_time
+    db.total_time += ev_time
 
-    db.total_detected += output["detected"]
-    db.total_pte += output["pte"]
+
+def process_batch(db, ev):
+    """Splits a batch of site-table events into per-event rows. The hits of
+    each site are told apart by their time."""
+    sites = db.sites[db.batches[db.batch_idx]]
+    starts = event_bounds(sites)[:-1]
+    if db.fast_lightmap is not None:
+        channel_detected = ev
+    else:
+        hits = ev.flat_hits
+        site_detected = db.tally.count_sources(hits.channel, source_index(hits.t, db.site_time_offset), len(sites))
+        channel_detected = np.add.reduceat(site_detected, starts, axis=0)
+    n_sites = np.diff(np.append(starts, len(sites)))
+    n = np.add.reduceat(sites["n"], starts)
+
+    ev_time = time.time() - db.start_time
+    for k, start in enumerate(starts):
+        output = dict(n_sites=n_sites[k], n=n[k], time_spent=ev_time / len(starts))
+        output["posX"], output["posY"], output["posZ"] = sites["pos"][start]
+        write_event(db, output, channel_detected[k])
+    db.batch_idx += 1
     db.start_time += ev_time
     db.total_time += ev_time
+
+
+def write_event(db, output, channel_detected):
+    """Writes the row of one event given its per-channel counts (or only its
+    total count `output["detected"]` for single-channel output)"""
+    if channel_detected is not None:
+        output["detected"] = channel_detected.sum()
+    output["pte"] = output["detected"] / output["n"]
+
+    if db.output_layout == "matrix":
+        db.writer.write_row([output[var] for var in db.writer.variables], channel_detected)
+    elif db.single_channel:
+        db.writer.write(**{var: output[var] for var in db.writer.variables})
+    else:
+        row = [output[var] for var in db.scalar_variables]
+        db.writer.write_row(np.concatenate((row, db.tally.columns(channel_detected, output["n"]), [output["time_spent"]])))
+
+    db.total_detected += output["detected"]
+    db.total_pte += output["pte"]
+    db.total_photons += output["n"]
     db.event_idx += 1
 
 
 def __simulation_end__(db):
     """Called at the end of the event loop"""
     db.writer.close()
+    if db.sites_file is not None:
+        # keeps the sites of every event next to the per-event rows, and the
+        # event ids as integers since the float32 rows cannot hold ids above 2**24
+        with h5py.File(db.output_file, "a") as f:
+            f.create_dataset("sites", data=db.sites)
+            f.create_dataset("event", data=db.sites["event"][event_bounds(db.sites)[:-1]][: db.event_idx])
 
     n_positions = len(db.photon_positions)
     results = dict(
         output_path=db.output_file,
         n_positions=n_positions,
-        n_photons_per_position=db.n_photons,
+        n_photons_per_position=db.total_photons / n_positions,
         n_detected=db.total_detected,
         n_detected_per_position=db.total_detected / n_positions,
         avg_pte_per_position=db.total_pte / n_positions,
         total_time=db.total_time,
         sec_per_position=db.total_time / n_positions,
         positions_per_sec=n_positions / db.total_time,
-        photons_per_sec=n_positions * db.n_photons / db.total_time,
+        photons_per_sec=db.total_photons / db.total_time,
     )
     print_table(**results)
\ No newline at end of file
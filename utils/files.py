@@ -0,0 +1,33 @@
+import os
+import shutil
+from contextlib import contextmanager
+
+__all__ = ["atomic_path", "atomic_write"]
+
+
+@contextmanager
+def atomic_path(path):
+    """Yields a temporary path next to `path` and renames it to `path` once the
+    block exits without an error, so that readers never see a partially written
+    file or directory. An existing directory at `path` is replaced."""
+    path = os.path.normpath(os.fspath(path))
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        yield tmp
+    except BaseException:
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        elif os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    if os.path.isdir(tmp) and os.path.isdir(path):
+        shutil.rmtree(path)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def atomic_write(path, mode: str = "w"):
+    """Opens a file that replaces `path` once it is written, see `atomic_path`."""
+    with atomic_path(path) as tmp:
+        with open(tmp, mode) as f:
+            yield f
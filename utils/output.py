@@ -2,33 +2,252 @@ from rich.console import Console
 from rich.table import Table
 
 import h5py
+import numpy as np
 import os
+import queue
+import threading
 from .log import logger
 from typing import List
 
+# file attribute holding the number of rows written by completed flushes
+ROWS_ATTR = "n_rows"
+
 class H5Logger:
-    def __init__(self, filename: str, variables: List[str]):
+    """Writes rows of scalar variables to an HDF5 file, one 1-D float dataset per variable.
+
+    Rows are buffered and appended `flush_size` at a time. With `resume`, an
+    existing file is kept and truncated to its last completed flush, whose
+    number of rows is `n_resumed`.
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        variables: List[str],
+        flush_size: int = 1024,
+        chunk_size: int = None,
+        resume: bool = False,
+    ):
         self.filename = filename
         self.variables = variables
+        self.flush_size = max(int(flush_size), 1)
+        chunk_size = chunk_size or self.flush_size
 
         if os.path.exists(filename):
-            logger.warning(f"File {filename} already exists. Overwriting.")
-            os.remove(filename)
+            if resume:
+                logger.info(f"Resuming {filename}.")
+            else:
+                logger.warning(f"File {filename} already exists. Overwriting.")
+                os.remove(filename)
         self.f = h5py.File(filename, "a")
 
+        if resume and len(self.f.keys()) and set(self.variables) - set(self.f.keys()):
+            missing = sorted(set(self.variables) - set(self.f.keys()))
+            raise ValueError(f"cannot resume {filename}, it has no datasets {missing}")
+        if not len(self.f.keys()):
+            self.f.attrs[ROWS_ATTR] = 0
         for var in self.variables:
             if var not in self.f:
-                self.f.create_dataset(var, (0,), maxshape=(None,), dtype="f")
+                self.f.create_dataset(
+                    var, (0,), maxshape=(None,), dtype="f", chunks=(chunk_size,)
+                )
+        self.n_resumed = self._truncate(self.variables)
+
+        # one contiguous row of the buffer per variable so that each flush
+        # writes a contiguous block into each dataset
+        self._buffer = np.empty((len(self.variables), self.flush_size), dtype="f")
+        self._n_buffered = 0
+
+    def _truncate(self, keys: List[str]) -> int:
+        """Drop rows beyond the last completed flush, e.g. a partial flush
+        interrupted by a crash, and return the remaining number of rows.
+
+        Datasets are resized before they are written, so equal lengths do not
+        mean that a flush completed; the number of rows is taken from the
+        `ROWS_ATTR` attribute, which is only updated once a flush is on disk.
+        Files written without it are truncated to the shortest dataset.
+        """
+        n = min(self.f[key].shape[0] for key in keys)
+        n = min(n, int(self.f.attrs.get(ROWS_ATTR, n)))
+        for key in keys:
+            if self.f[key].shape[0] > n:
+                logger.warning(f"Dropping {self.f[key].shape[0] - n} incomplete rows of {key}.")
+                self.f[key].resize(n, axis=0)
+        return n
 
     def write(self, **kwargs):
-        for var in self.variables:
+        """Write a single row given as keyword arguments, one per variable."""
+        self.write_row([kwargs[var] for var in self.variables])
+
+    def write_row(self, row):
+        """Write a single row given as a sequence ordered like `variables`."""
+        self._buffer[:, self._n_buffered] = row
+        self._n_buffered += 1
+        if self._n_buffered == self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """Append all buffered rows to the file."""
+        n = self._n_buffered
+        if n == 0:
+            return
+        self._flush(n)
+        self.f.flush()
+        self.f.attrs[ROWS_ATTR] = self.f[self.variables[0]].shape[0]
+        self.f.flush()
+        self._n_buffered = 0
+
+    def _flush(self, n: int):
+        for i, var in enumerate(self.variables):
             data = self.f[var]
-            data.resize((data.shape[0] + 1,))
-            data[-1] = kwargs[var]
+            start = data.shape[0]
+            data.resize((start + n,))
+            data[start:] = self._buffer[i, :n]
 
     def close(self):
+        self.flush()
         self.f.close()
 
+
+class MatrixH5Logger(H5Logger):
+    """Writes the per-channel counts of each row to a 2-D `detected[n_events, n_channels]`
+    dataset next to the scalar datasets of `H5Logger`.
+
+    PTE is not stored but derived on read (see `lightmap.io.LightmapFile`). The
+    file is tagged with the attribute `layout = "matrix"`.
+    """
+
+    # target size of a single chunk of the `detected` dataset in bytes
+    CHUNK_BYTES = 2**20
+
+    def __init__(
+        self,
+        filename: str,
+        variables: List[str],
+        n_channels: int,
+        dtype: str = "i4",
+        compression: str = None,
+        flush_size: int = 1024,
+        resume: bool = False,
+    ):
+        if "detected" in variables:
+            raise ValueError("`detected` is reserved for the channel matrix")
+        super().__init__(filename, variables, flush_size=flush_size, resume=resume)
+        self.n_channels = n_channels
+
+        dtype = np.dtype(dtype)
+        if "detected" in self.f:
+            if self.f["detected"].shape[1:] != (n_channels,):
+                raise ValueError(
+                    f"cannot resume {filename}, its `detected` dataset does not have {n_channels} channels"
+                )
+            dtype = self.f["detected"].dtype
+        else:
+            channel_chunk = min(n_channels, 1024)
+            row_chunk = max(1, min(self.flush_size, self.CHUNK_BYTES // (channel_chunk * dtype.itemsize)))
+            self.f.create_dataset(
+                "detected",
+                (0, n_channels),
+                maxshape=(None, n_channels),
+                dtype=dtype,
+                chunks=(row_chunk, channel_chunk),
+                compression=compression,
+            )
+        self.f.attrs["layout"] = "matrix"
+        self.n_resumed = self._truncate(self.variables + ["detected"])
+
+        self._matrix_buffer = np.empty((self.flush_size, n_channels), dtype=dtype)
+
+    def write(self, detected, **kwargs):
+        """Write a single row given the per-channel counts and the scalar variables."""
+        self.write_row([kwargs[var] for var in self.variables], detected)
+
+    def write_row(self, row, detected):
+        """Write a single row given as a sequence ordered like `variables` and
+        the per-channel counts."""
+        self._matrix_buffer[self._n_buffered] = detected
+        super().write_row(row)
+
+    def _flush(self, n: int):
+        super()._flush(n)
+        data = self.f["detected"]
+        start = data.shape[0]
+        data.resize((start + n, self.n_channels))
+        data[start:] = self._matrix_buffer[:n]
+
+
+class AsyncWriter:
+    """Runs the writes of an `H5Logger` on a background thread, through a queue of
+    at most `maxsize` pending calls.
+
+    An error on the writer thread is re-raised by the next call and by `close`.
+    Rows are passed by reference, so arrays must not be modified after writing them.
+    """
+
+    _STOP = object()
+
+    def __init__(self, writer: H5Logger, maxsize: int = 64):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="h5-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def variables(self) -> List[str]:
+        return self.writer.variables
+
+    def write(self, *args, **kwargs):
+        self._put("write", args, kwargs)
+
+    def write_row(self, *args, **kwargs):
+        self._put("write_row", args, kwargs)
+
+    def flush(self):
+        self._put("flush", (), {})
+
+    def close(self):
+        """Wait for all pending writes, close the wrapped logger and re-raise
+        any error from the writer thread."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(self._STOP)
+            self._thread.join()
+        self._raise_if_failed()
+
+    def _put(self, method: str, args, kwargs):
+        if self._closed:
+            raise RuntimeError("write to a closed AsyncWriter")
+        self._raise_if_failed()
+        self._queue.put((method, args, kwargs))
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(
+                f"background writer for {self.writer.filename} failed"
+            ) from self._error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            if self._error is not None:
+                # keep draining so that the main thread never blocks on a full queue
+                continue
+            method, args, kwargs = item
+            try:
+                getattr(self.writer, method)(*args, **kwargs)
+            except BaseException as e:
+                logger.error(f"background writer failed: {e!r}")
+                self._error = e
+        try:
+            self.writer.close()
+        except BaseException as e:
+            if self._error is None:
+                self._error = e
+
 def print_table(**kwargs):
     """Print a summary table of the simulation"""
     console = Console()
@@ -37,4 +256,4 @@ def print_table(**kwargs):
     table.add_column("value", style="bold red")
     for key, value in kwargs.items():
         table.add_row(key, str(value))
-    console.print(table)
\ No newline at end of file
+    console.print(table)
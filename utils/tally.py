@@ -0,0 +1,74 @@
+import math
+from typing import List
+
+import numpy as np
+
+__all__ = ["ChannelTally"]
+
+
+class ChannelTally:
+    """Counts detected photons per channel with one bincount over the flat hits.
+
+    The per-channel column names of the column layout are built once, so events
+    need no per-channel Python work.
+    """
+
+    def __init__(self, n_channels: int):
+        self.n_channels = n_channels
+        zfill_width = int(math.log10(n_channels)) + 1 if n_channels > 0 else 1
+        self.channel_ids = [str(c).zfill(zfill_width) for c in range(n_channels)]
+        self.detected_names = [f"ch{c}_detected" for c in self.channel_ids]
+        self.pte_names = [f"ch{c}_pte" for c in self.channel_ids]
+
+    @property
+    def column_names(self) -> List[str]:
+        """Interleaved per-channel column names, ``[ch0_detected, ch0_pte, ch1_detected, ...]``."""
+        names = [None] * (2 * self.n_channels)
+        names[0::2] = self.detected_names
+        names[1::2] = self.pte_names
+        return names
+
+    def count_channels(self, channels: np.ndarray) -> np.ndarray:
+        """Counts hits per channel given the channel id of every hit.
+
+        Returns an integer array of shape (n_channels,).
+        """
+        channels = self._check_channels(channels)
+        return np.bincount(channels, minlength=self.n_channels)
+
+    def count_sources(self, channels: np.ndarray, sources: np.ndarray, n_sources: int) -> np.ndarray:
+        """Counts hits per source and channel given the channel and source id of
+        every hit, e.g. for events packed from several photon sources.
+
+        Returns an integer array of shape (n_sources, n_channels).
+        """
+        sources = np.asarray(sources, dtype=np.intp)
+        if sources.size and (sources.min() < 0 or sources.max() >= n_sources):
+            raise ValueError(
+                f"hit source ids outside [0, {n_sources}); are the sources tagged correctly?"
+            )
+        flat = sources * self.n_channels + self._check_channels(channels)
+        counts = np.bincount(flat, minlength=n_sources * self.n_channels)
+        return counts.reshape(n_sources, self.n_channels)
+
+    def _check_channels(self, channels: np.ndarray) -> np.ndarray:
+        channels = np.asarray(channels, dtype=np.intp)
+        if channels.size and (channels.min() < 0 or channels.max() >= self.n_channels):
+            raise ValueError(
+                f"hit channel ids outside [0, {self.n_channels}); does the detector have {self.n_channels} channels?"
+            )
+        return channels
+
+    def count(self, ev) -> np.ndarray:
+        """Counts the flat hits of a chroma Event per channel.
+
+        Requires ``db.chroma_keep_flat_hits = True``.
+        """
+        return self.count_channels(ev.flat_hits.channel)
+
+    def columns(self, counts: np.ndarray, n_photons: float) -> np.ndarray:
+        """Interleaved per-channel detected and PTE values matching `column_names`."""
+        out = np.empty(2 * self.n_channels, dtype=np.float64)
+        out[0::2] = counts
+        out[1::2] = counts / n_photons
+        return out